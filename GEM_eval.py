@@ -8,10 +8,167 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
-
-from graphdb_handler import GraphDBHandler
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import numpy as np
+
+from cache import shared_cache
+from cascade_policy import CascadePolicy
+from cassette import is_recording
+from graphdb_handler import GraphDBHandler, virtual_deletion
+from kg_vec_calc import publish_gem_store
+from lazy_loader import load_conf
+from profiling import term_timer
 from term_mapper import TermMapper
 
+# evaluator of a worker process, see _init_worker
+_worker_evaluator = None
+
+
+def _init_worker(test_data, do_not_delete, exp_prefix, params):
+    global _worker_evaluator
+    _worker_evaluator = TermMapperEvaluator(test_data, do_not_delete, exp_prefix)
+    if params is not None:
+        _worker_evaluator._set_params(params)
+
+
+def _evaluate_term(test_entry):
+    return timed_evaluation(_worker_evaluator.evaluate_term, test_entry)
+
+
+def _record_term_candidates(test_entry):
+    return timed_evaluation(_worker_evaluator.record_term_candidates, test_entry)
+
+
+def timed_evaluation(evaluate, test_entry):
+    """ Evaluate a test entry and add the wall and CPU time it took to the result (as "timing") """
+    timing = {}
+    with term_timer(timing):
+        result = evaluate(*test_entry)
+    result["timing"] = timing
+    return result
+
+
+def _json_default(value):
+    # similarities may be numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def write_result(results_file, index, result):
+    """ Append the result of a test term (with its line index in the test data) and flush it to disk """
+    results_file.write(json.dumps(dict(result, index=index), ensure_ascii=False, default=_json_default) + "\n")
+    results_file.flush()
+
+
+def read_results(results_path):
+    """ All complete result lines of a results file, a line cut off by a crash is skipped """
+    results = []
+    with open(results_path, "r", encoding="utf-8") as results_file:
+        for line in results_file:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Warning: Skipping incomplete result line in {results_path}")
+    return results
+
+
+def load_results(results_path):
+    """ Results of a results file in test data order, the last result per term wins """
+    results = {result["index"]: result for result in read_results(results_path)}
+    return [results[index] for index in sorted(results)]
+
+
+def load_finished_results(results_path, test_data):
+    """
+    Results of an earlier run that can be reused for the given test data.
+
+    Returns:
+        Dict of line index in the test data to result
+    """
+    if not os.path.exists(results_path):
+        return {}
+
+    finished = {}
+    for result in read_results(results_path):
+        index = result["index"]
+        if index < len(test_data) and test_data[index][:2] == [result["record"], result["base_word"]]:
+            finished[index] = result
+        else:
+            print(f"Warning: Result {index} ({result['base_word']}) does not match the test data, evaluating again")
+    return finished
+
+
+def open_results_file(results_path, finished):
+    """ Open the results file for writing, only keeping the given finished results """
+    directory = os.path.dirname(results_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    results_file = open(results_path, "w", encoding="utf-8")
+    for result in finished:
+        write_result(results_file, result["index"], result)
+    return results_file
+
+
+class TreeNumberEncoder:
+    """
+    Encodes MeSH tree numbers as integer paths: the category letter, then one id per level
+    (e.g. "C04.588" -> [id("C"), id("C04"), id("588")]). Ids are only comparable within one encoder.
+    """
+
+    def __init__(self):
+        self._component_ids = {}
+        self._paths = {}
+
+    def path(self, tree_number):
+        path = self._paths.get(tree_number)
+        if path is None:
+            components = [tree_number[0:1]] + tree_number.split(".")
+            path = [self._component_ids.setdefault(component, len(self._component_ids)) for component in components]
+            self._paths[tree_number] = path
+        return path
+
+    def encode(self, tree_numbers, padding=-1):
+        """
+        Returns:
+            Tuple of the path matrix (one row per tree number, padded with the padding value) and the path lengths
+        """
+        paths = [self.path(tree_number) for tree_number in tree_numbers]
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        matrix = np.full((len(paths), lengths.max(initial=0)), padding, dtype=np.int64)
+        for row, path in enumerate(paths):
+            matrix[row, :len(path)] = path
+        return matrix, lengths
+
+
+def tree_distances(match_paths, match_lengths, base_paths, base_lengths):
+    """
+    Conceptual similarity and hops for all pairs of encoded tree numbers, same results as
+    TermMapperEvaluator.mesh_conceptual_sim and calc_hops.
+    With c the number of common leading levels and n1, n2 the path lengths:
+    conceptual similarity = 2c / (n1 + n2) (the LCS depth is c, the root is not counted) and hops = n1 + n2 - 2c.
+
+    Args:
+        match_paths, match_lengths: encoded match tree numbers (padded with -1)
+        base_paths, base_lengths: encoded base tree numbers (padded with -2, so padding never matches)
+
+    Returns:
+        Tuple of the similarity and hops matrix (match tree numbers x base tree numbers)
+    """
+    width = max(match_paths.shape[1], base_paths.shape[1])
+    match_paths = np.pad(match_paths, ((0, 0), (0, width - match_paths.shape[1])), constant_values=-1)
+    base_paths = np.pad(base_paths, ((0, 0), (0, width - base_paths.shape[1])), constant_values=-2)
+
+    equal = match_paths[:, None, :] == base_paths[None, :, :]
+    common = np.cumprod(equal, axis=2).sum(axis=2)
+    total = match_lengths[:, None] + base_lengths[None, :]
+
+    return 2 * common / total, total - 2 * common
+
 
 class TermMapperEvaluator:
     def __init__(self, test_data, do_not_delete=False, exp_prefix=None):
@@ -23,6 +180,14 @@ class TermMapperEvaluator:
 
         self.exp_prefix = exp_prefix
 
+        conf = load_conf()
+        # tree numbers of records do not change during an evaluation
+        self.tree_number_cache = shared_cache("tree_numbers", int(conf.get("tree_number_cache_size", 100000)))
+        self.tree_number_encoder = TreeNumberEncoder()
+        # hide the evaluated term from the lookups instead of deleting it from GraphDB
+        self.virtual_deletion = conf.get("eval_virtual_deletion", "true").lower() == "true"
+        self.workers = int(conf.get("eval_workers", 1))
+
     def _set_params(self, params):
         self.TermMapper.set_conf_values(params)
         self.DBHandler.set_conf_values(params)
@@ -101,12 +266,17 @@ class TermMapperEvaluator:
         return hops_in_avg
 
     def get_mesh_record_indices(self, record_id):
+        extracted_listings = self.tree_number_cache.get(record_id)
+        if extracted_listings is not None:
+            return list(extracted_listings)
+
         result = self.DBHandler.get_all_index_listings_of_a_mesh_record(record_id)
         extracted_listings = []
 
         for binding in result["results"]["bindings"]:
             extracted_listings.append(self.DBHandler.remove_uri(binding["index"]["value"]))
 
+        self.tree_number_cache.put(record_id, tuple(extracted_listings))
         return extracted_listings
 
     def find_mesh_lcs(self, index_one, index_two):
@@ -156,22 +326,25 @@ class TermMapperEvaluator:
             conceptual_sims[match_listing] = ("", -99)
             hop_listings[match_listing] = ("", 99999)
 
-            for base_listing in base_listings_of_record:
-                similarity = self.mesh_conceptual_sim(match_listing, base_listing)
-                hops = self.calc_hops(match_listing, base_listing)
-
-                if conceptual_sims[match_listing][1] < similarity:
-                    conceptual_sims[match_listing] = (base_listing, similarity)
+        if len(match_listings) > 0 and len(base_listings_of_record) > 0:
+            # all pairs at once, the first base listing with the highest similarity (fewest hops) wins
+            similarities, hops = tree_distances(*self.tree_number_encoder.encode(match_listings, -1),
+                                                *self.tree_number_encoder.encode(base_listings_of_record, -2))
+            best_similarity = similarities.argmax(axis=1)
+            fewest_hops = hops.argmin(axis=1)
 
-                if hop_listings[match_listing][1] > hops:
-                    hop_listings[match_listing] = (base_listing, hops)
+            for row, match_listing in enumerate(match_listings):
+                conceptual_sims[match_listing] = (base_listings_of_record[best_similarity[row]],
+                                                  float(similarities[row, best_similarity[row]]))
+                hop_listings[match_listing] = (base_listings_of_record[fewest_hops[row]],
+                                               int(hops[row, fewest_hops[row]]))
 
         match["conceptual_similarities"] = conceptual_sims
         match["hops"] = hop_listings
 
         self._clean_match_info(match)
 
-    def try_delete_term(self, term):
+    def find_term_id(self, term):
         result = self.DBHandler.get_id_from_mesh_term(term)
         term_id = None
         for binding in result["results"]["bindings"]:
@@ -184,6 +357,11 @@ class TermMapperEvaluator:
             print(f"Warning: No term ID found for: {term}")
             raise KeyError("Please re-insert term to graphdb")
 
+        return term_id
+
+    def try_delete_term(self, term):
+        term_id = self.find_term_id(term)
+
         # Delete 'hasTermName' relation before evaluation
         with open("sparql_insert_log.txt", "a") as ifile:
             ifile.write(f"mesh:{term_id} mesh_entity:hasTermName '{term}' .\n")
@@ -191,57 +369,197 @@ class TermMapperEvaluator:
 
         return term_id
 
-    def eval_mesh_mapping(self, params=None):  # noqa: C901
-        if params is not None:
-            self._set_params(params)
-
+    def map_test_term(self, term, sentence, record_candidates=False):
+        """ Run the matching cascade for a test term, with the term removed from the graph in reinsert mode """
+        policy = CascadePolicy.exhaustive()
+        if self.do_not_delete:
+            return self.TermMapper.map_term(term, sentence, policy, record_candidates)
+
+        if self.virtual_deletion:
+            with virtual_deletion(term, self.find_term_id(term)):
+                return self.TermMapper.map_term(term, sentence, policy, record_candidates)
+
+        deleted_term_id = self.try_delete_term(term)
+        try:
+            return self.TermMapper.map_term(term, sentence, policy, record_candidates)
+        finally:
+            # Re-insert term after evaluation
+            self.DBHandler.insert_specific_term_into_mesh(term, deleted_term_id)
+
+    def evaluate_term(self, descriptor_id, term, sentence):
+        """
+        Map a test term (with the term itself removed from the graph in reinsert mode) and measure the
+        distance of all matches to the expected record.
+
+        Args:
+            descriptor_id: str MeSH Record ID the term belongs to
+            term: str term to map
+            sentence: str context sentence of the term
+
+        Returns:
+            Dict with the matches of all stages
+        """
+        mesh_direct_match, mesh_similar_matches, mesh_compound_matches, _, _, gem_matches = \
+            self.map_test_term(term, sentence).results()
+
+        base_record_listings = self.get_mesh_record_indices(descriptor_id)
+        if len(base_record_listings) == 0:
+            print("Descriptor ID not found in DB:", descriptor_id)
+
+        for match in mesh_direct_match:
+            self._measure_match_distance(match, base_record_listings)
+
+        for match_tuple in mesh_similar_matches:
+            match = match_tuple[0]
+            self._measure_match_distance(match, base_record_listings)
+
+        for match in mesh_compound_matches:
+            self._measure_match_distance(match, base_record_listings)
+
+        for match_tuple in gem_matches:
+            match = match_tuple[0]
+            self._measure_match_distance(match, base_record_listings)
+
+        return {
+            "base_word": term,
+            "context_sentence": sentence,
+            "record": descriptor_id,
+            "direct_match": mesh_direct_match,
+            "similar_matches": mesh_similar_matches,
+            "compound_matches": mesh_compound_matches,
+            "gem_matches": gem_matches
+        }
+
+    def _record_scores(self, record_id, base_record_listings):
+        """ Best conceptual similarity and hops of a record, as used by analyse_results """
+        match = {"corresponding_id": record_id}
+        self._measure_match_distance(match, base_record_listings)
+        if len(match["conceptual_similarities"]) == 0:
+            # record without tree numbers
+            return 0.0, 0
+        return self._best_concept_sim(match["conceptual_similarities"].values()), \
+            self._best_concept_sim(match["hops"].values())
+
+    def record_term_candidates(self, descriptor_id, term, sentence):
+        """
+        Map a test term without applying the walk thresholds and record all candidates with their scores
+        and the distance of their record to the expected record (see threshold_sweep).
+
+        Returns:
+            Dict with the candidates of all stages
+        """
+        ctx = self.map_test_term(term, sentence, record_candidates=True)
+
+        base_record_listings = self.get_mesh_record_indices(descriptor_id)
+        if len(base_record_listings) == 0:
+            print("Descriptor ID not found in DB:", descriptor_id)
+
+        record_scores = {}
+        for candidate in ctx.candidates:
+            record_id = candidate["record"]
+            if record_id is not None and record_id not in record_scores:
+                record_scores[record_id] = self._record_scores(record_id, base_record_listings)
+
+            candidate["conceptual_sim"], candidate["hops"] = record_scores.get(record_id, (None, None))
+
+        return {
+            "base_word": term,
+            "context_sentence": sentence,
+            "record": descriptor_id,
+            # candidates were only tried above these thresholds
+            "thresholds": {key: float(self.TermMapper._conf.get(key))
+                           for key in ("min_similarity_threshold", "min_gem_sim_threshold")},
+            "candidates": ctx.candidates
+        }
+
+    def load_test_data(self):
         with open(self.test_data_path) as f:
-            test_data = [line.split("\t") for line in f.read().split("\n")]
-
-        test_results = []
-
-        for descriptor_id, term, sentence in test_data:
-            deleted_term_id = None
-            if not self.do_not_delete:
-                deleted_term_id = self.try_delete_term(term)
-
-            mesh_direct_match, mesh_similar_matches, mesh_compound_matches, _, _, gem_matches = \
-                self.TermMapper.find_matches(term, sentence)
-
-            base_record_listings = self.get_mesh_record_indices(descriptor_id)
-            if len(base_record_listings) == 0:
-                print("Descriptor ID not found in DB:", descriptor_id)
-
-            for match in mesh_direct_match:
-                self._measure_match_distance(match, base_record_listings)
-
-            for match_tuple in mesh_similar_matches:
-                match = match_tuple[0]
-                self._measure_match_distance(match, base_record_listings)
-
-            for match in mesh_compound_matches:
-                self._measure_match_distance(match, base_record_listings)
-
-            for match_tuple in gem_matches:
-                match = match_tuple[0]
-                self._measure_match_distance(match, base_record_listings)
-
-            current_results = {
-                    "base_word": term,
-                    "context_sentence": sentence,
-                    "record": descriptor_id,
-                    "direct_match": mesh_direct_match,
-                    "similar_matches": mesh_similar_matches,
-                    "compound_matches": mesh_compound_matches,
-                    "gem_matches": gem_matches
-                }
-            test_results.append(current_results)
+            return [line.split("\t") for line in f.read().split("\n")]
+
+    def _evaluate_all(self, test_entries, params, record_candidates=False):
+        """ Evaluate the test entries, yields the results in order as soon as they are available """
+        # deleting terms from GraphDB changes the graph for all workers, so that mode runs serially.
+        # A cassette is only saved by the process that records it.
+        parallel = self.workers > 1 and (self.do_not_delete or self.virtual_deletion) and not is_recording()
+
+        if parallel:
+            # published once here, the workers map the same store instead of loading their own copy
+            if self.TermMapper._conf.get("gem_store_path"):
+                publish_gem_store(self.TermMapper._conf.get("gem_store_path"))
+
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                     initargs=(self.test_data_path, self.do_not_delete, self.exp_prefix,
+                                               params)) as executor:
+                yield from executor.map(_record_term_candidates if record_candidates else _evaluate_term,
+                                        test_entries)
+        else:
+            evaluate = self.record_term_candidates if record_candidates else self.evaluate_term
+            for test_entry in test_entries:
+                yield timed_evaluation(evaluate, test_entry)
 
-            if not self.do_not_delete:
-                # Re-insert term after evaluation
-                self.DBHandler.insert_specific_term_into_mesh(term, deleted_term_id)
+    def _run(self, params, results_path, resume, record_candidates=False):
+        """ Evaluate all test terms, streaming the results to results_path, and return them in test data order """
+        if params is not None:
+            self._set_params(params)
 
-        self.analyse_results(test_results)
+        test_data = self.load_test_data()
+
+        finished = {}
+        if resume and results_path is not None:
+            finished = load_finished_results(results_path, test_data)
+            print(f"Resuming: {len(finished)} of {len(test_data)} terms already evaluated")
+
+        pending = [index for index in range(len(test_data)) if index not in finished]
+        test_results = dict(finished)
+
+        results_file = None
+        if results_path is not None:
+            results_file = open_results_file(results_path, finished.values())
+
+        try:
+            test_entries = [test_data[i] for i in pending]
+            for index, result in zip(pending, self._evaluate_all(test_entries, params, record_candidates)):
+                test_results[index] = result
+                if results_file is not None:
+                    write_result(results_file, index, result)
+        finally:
+            if results_file is not None:
+                results_file.close()
+
+        return [test_results[index] for index in sorted(test_results)]
+
+    def eval_mesh_mapping(self, params=None, results_path=None, resume=False):
+        """
+        Evaluate all test terms and print the metrics.
+
+        Args:
+            params: dict of config values to use for this evaluation
+            results_path: str JSONL file the result of every term is written to as soon as it is finished
+            resume: bool, keep the finished terms of an earlier run in results_path and only evaluate the rest
+
+        Returns:
+            None
+        """
+        self.analyse_results(self._run(params, results_path, resume))
+
+    def record_candidates(self, results_path, params=None, resume=False):
+        """
+        Record the candidates of all test terms for offline threshold sweeps (see threshold_sweep).
+        The similarity thresholds in params (or the config) are the lowest values a sweep can use.
+
+        Args:
+            results_path: str JSONL file the candidates of every term are written to
+            params: dict of config values to use for recording
+            resume: bool, keep the finished terms of an earlier run in results_path and only record the rest
+
+        Returns:
+            List of the recorded candidates per term
+        """
+        return self._run(params, results_path, resume, record_candidates=True)
+
+    def analyse_results_file(self, results_path):
+        """ Print the metrics of stored results without running the mapping again """
+        self.analyse_results(load_results(results_path))
 
     @staticmethod
     def _best_concept_sim(vals):
@@ -249,142 +567,109 @@ class TermMapperEvaluator:
         return max(tmp_vals)
 
     def analyse_results(self, results):
-        lexical_match_cs = []
-        gem_match_cs = []
-        revgem_match_cs = []
-        compound_match_cs = []
-        all_match_cs = []
-
-        lexical_match_hop = []
-        gem_match_hop = []
-        revgem_match_hop = []
-        compound_match_hop = []
-        all_match_hop = []
-
-        correct_lex = 0
-        correct_gem = 0
-        correct_revgem = 0
-        correct_comp = 0
-
-        multi_lex = 0
-        multi_gem = 0
-        multi_revgem = 0
-        multi_comp = 0
+        self.print_metrics(self.compute_metrics(results))
 
+    @staticmethod
+    def compute_metrics(results):  # noqa: C901
+        """
+        Metrics of evaluation results: number of matches, terms with multiple matches, correct matches
+        (conceptual similarity of 1.0), average conceptual similarity and average hops per match type.
+
+        Args:
+            results: list of results per term (see evaluate_term)
+
+        Returns:
+            Flat dict of metric name to value
+        """
+        match_types = {
+            "lexical": "direct_match",
+            "gem": "similar_matches",
+            "revgem": "gem_matches",
+            "compound": "compound_matches"
+        }
+
+        match_cs = {match_type: [] for match_type in match_types}
+        match_hop = {match_type: [] for match_type in match_types}
+        correct = {match_type: 0 for match_type in match_types}
+        multi = {match_type: 0 for match_type in match_types}
         no_match = 0
 
         for term in results:
             matched = False
 
-            if len(term["direct_match"]) > 1:
-                multi_lex += 1
-
-            for exact in term["direct_match"]:
-                matched = True
-                val = self._best_concept_sim(exact["conceptual_similarities"].values())
-                lexical_match_cs.append(val)
-                all_match_cs.append(val)
-
-                if val == 1.0:
-                    correct_lex += 1
-
-                val_hop = self._best_concept_sim(exact["hops"].values())
-                lexical_match_hop.append(val_hop)
-                all_match_hop.append(val_hop)
-
-            if len(term["similar_matches"]) > 1:
-                multi_gem += 1
+            for match_type, key in match_types.items():
+                if len(term[key]) > 1:
+                    multi[match_type] += 1
 
-            for similar in term["similar_matches"]:
-                matched = True
-                similar = similar[0]
-                val = self._best_concept_sim(similar["conceptual_similarities"].values())
-                gem_match_cs.append(val)
-                all_match_cs.append(val)
+                for match in term[key]:
+                    matched = True
+                    if key in ("similar_matches", "gem_matches"):
+                        match = match[0]
 
-                if val == 1.0:
-                    correct_gem += 1
+                    val = TermMapperEvaluator._best_concept_sim(match["conceptual_similarities"].values())
+                    match_cs[match_type].append(val)
 
-                val_hop = self._best_concept_sim(similar["hops"].values())
-                gem_match_hop.append(val_hop)
-                all_match_hop.append(val_hop)
+                    if val == 1.0:
+                        correct[match_type] += 1
 
-            if len(term["gem_matches"]) > 1:
-                multi_revgem += 1
+                    val_hop = TermMapperEvaluator._best_concept_sim(match["hops"].values())
+                    match_hop[match_type].append(val_hop)
 
-            for gem in term["gem_matches"]:
-                matched = True
-                gem = gem[0]
-                val = self._best_concept_sim(gem["conceptual_similarities"].values())
-                revgem_match_cs.append(val)
-                all_match_cs.append(val)
-
-                if val == 1.0:
-                    correct_revgem += 1
-
-                val_hop = self._best_concept_sim(gem["hops"].values())
-                revgem_match_hop.append(val_hop)
-                all_match_hop.append(val_hop)
+            if not matched:
+                no_match += 1
 
-            if len(term["compound_matches"]) > 1:
-                multi_comp += 1
+        all_match_cs = [val for match_type in match_types for val in match_cs[match_type]]
+        all_match_hop = [val for match_type in match_types for val in match_hop[match_type]]
 
-            for compound in term["compound_matches"]:
-                matched = True
-                val = self._best_concept_sim(compound["conceptual_similarities"].values())
-                compound_match_cs.append(val)
-                all_match_cs.append(val)
+        metrics = {"dataset_len": len(results), "no_match": no_match, "matches_all": len(all_match_cs)}
+        for match_type in match_types:
+            metrics[f"matches_{match_type}"] = len(match_cs[match_type])
+            metrics[f"multiple_{match_type}"] = multi[match_type]
+            metrics[f"correct_{match_type}"] = correct[match_type]
 
-                if val == 1.0:
-                    correct_comp += 1
+        for match_type, cs, hops in [("all", all_match_cs, all_match_hop)] + \
+                [(match_type, match_cs[match_type], match_hop[match_type]) for match_type in match_types]:
+            metrics[f"avg_cs_{match_type}"] = sum(cs) / len(cs) if len(cs) > 0 else None
+            metrics[f"avg_hops_{match_type}"] = sum(hops) / len(hops) if len(hops) > 0 else None
 
-                val_hop = self._best_concept_sim(compound["hops"].values())
-                compound_match_hop.append(val_hop)
-                all_match_hop.append(val_hop)
+        return metrics
 
-            if not matched:
-                no_match += 1
+    @staticmethod
+    def print_metrics(metrics):
+        dataset_len = metrics["dataset_len"]
 
-        dataset_len = len(results)
+        def share(count):
+            return round(count / dataset_len * 100, 3)
 
-        len_all = len(all_match_cs)
-        len_exact = len(lexical_match_cs)
-        len_gem = len(gem_match_cs)
-        len_revgem = len(revgem_match_cs)
-        len_compound = len(compound_match_cs)
+        len_all = metrics["matches_all"]
+        len_exact = metrics["matches_lexical"]
+        len_gem = metrics["matches_gem"]
+        len_revgem = metrics["matches_revgem"]
+        len_compound = metrics["matches_compound"]
+        no_match = metrics["no_match"]
 
         print(f"Dataset length: {dataset_len}")
-        print(f"All matches: {len_all} ({round(len_all/dataset_len*100, 3)}%)")
-        print(f"Lexical matches: {len_exact} ({round(len_exact/dataset_len*100, 3)}%) ({multi_lex} multiple)")
-        print(f"GEM matches: {len_gem} ({round(len_gem/dataset_len*100, 3)}%) ({multi_gem} multiple)")
-        print(f"revGEM matches: {len_revgem} ({round(len_revgem/dataset_len*100, 3)}%) ({multi_revgem} multiple)")
-        print(f"Compound matches: {len_compound} ({round(len_compound/dataset_len*100, 3)}%) ({multi_comp} multiple)")
-        print(f"No matches: {no_match} ({round(no_match/dataset_len*100, 3)}%)")
+        print(f"All matches: {len_all} ({share(len_all)}%)")
+        print(f"Lexical matches: {len_exact} ({share(len_exact)}%) ({metrics['multiple_lexical']} multiple)")
+        print(f"GEM matches: {len_gem} ({share(len_gem)}%) ({metrics['multiple_gem']} multiple)")
+        print(f"revGEM matches: {len_revgem} ({share(len_revgem)}%) ({metrics['multiple_revgem']} multiple)")
+        print(f"Compound matches: {len_compound} ({share(len_compound)}%) ({metrics['multiple_compound']} multiple)")
+        print(f"No matches: {no_match} ({share(no_match)}%)")
         print("----------------------------")
-        print(f"Lexical correct: {correct_lex}")
-        print(f"GEM correct: {correct_gem}")
-        print(f"revGEM correct: {correct_revgem}")
-        print(f"Compound correct: {correct_comp}")
+        print(f"Lexical correct: {metrics['correct_lexical']}")
+        print(f"GEM correct: {metrics['correct_gem']}")
+        print(f"revGEM correct: {metrics['correct_revgem']}")
+        print(f"Compound correct: {metrics['correct_compound']}")
         print("----------------------------")
 
-        print(f"Avg. All matches: {round(sum(all_match_cs) / len_all, 3)}")
-        if len_exact > 0:
-            print(f"Avg. Lexical matches: {round(sum(lexical_match_cs) / len_exact, 3)}")
-        if len_gem > 0:
-            print(f"Avg. GEM matches: {round(sum(gem_match_cs) / len_gem, 3)}")
-        if len_revgem > 0:
-            print(f"Avg. revGEM matches: {round(sum(revgem_match_cs) / len_revgem, 3)}")
-        if len_compound > 0:
-            print(f"Avg. Compound matches: {round(sum(compound_match_cs) / len_compound, 3)}")
+        labels = [("all", "All"), ("lexical", "Lexical"), ("gem", "GEM"), ("revgem", "revGEM"),
+                  ("compound", "Compound")]
+        for match_type, label in labels:
+            if metrics[f"avg_cs_{match_type}"] is not None:
+                print(f"Avg. {label} matches: {round(metrics[f'avg_cs_{match_type}'], 3)}")
         print("---------------------------")
 
-        print(f"Avg. Hops All matches: {round(sum(all_match_hop) / len_all, 3)}")
-        if len_exact > 0:
-            print(f"Avg. Hops Lexical matches: {round(sum(lexical_match_hop) / len_exact, 3)}")
-        if len_gem > 0:
-            print(f"Avg. Hops GEM matches: {round(sum(gem_match_hop) / len_gem, 3)}")
-        if len_revgem > 0:
-            print(f"Avg. Hops revGEM matches: {round(sum(revgem_match_hop) / len_revgem, 3)}")
-        if len_compound > 0:
-            print(f"Avg. Hops Compound matches: {round(sum(compound_match_hop) / len_compound, 3)}")
+        for match_type, label in labels:
+            if metrics[f"avg_hops_{match_type}"] is not None:
+                print(f"Avg. Hops {label} matches: {round(metrics[f'avg_hops_{match_type}'], 3)}")
         print("---------------------------")
@@ -0,0 +1,216 @@
+"""
+Throughput and latency benchmark of the term mapping on the test data
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import List
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from cache import clear_shared_caches, shared_cache_stats
+from cascade_policy import CascadePolicy
+from cassette import RECORD, REPLAY, NO_LATENCY, RECORDED_LATENCY, Cassette, count_remote_calls, use_cassette
+
+DATASETS = {
+    "reinsert": (os.path.join("test_data", "reinsert_data.tsv"), False),
+    "enrich": (os.path.join("test_data", "enrich_data.tsv"), True)
+}
+
+# metrics compared with the baseline: name, True if higher is better
+COMPARED_METRICS = [("terms_per_s", True), ("latency_p50_ms", False), ("latency_p95_ms", False),
+                    ("latency_p99_ms", False)]
+
+
+def cassette_path(cassette_dir: str, dataset: str) -> str:
+    return os.path.join(cassette_dir, f"benchmark_{dataset}.json.gz")
+
+
+def _summary(durations: List[float]) -> dict:
+    if len(durations) == 0:
+        return {}
+    durations_ms = np.asarray(durations) * 1000
+    return {
+        "latency_mean_ms": round(float(durations_ms.mean()), 3),
+        "latency_p50_ms": round(float(np.percentile(durations_ms, 50)), 3),
+        "latency_p95_ms": round(float(np.percentile(durations_ms, 95)), 3),
+        "latency_p99_ms": round(float(np.percentile(durations_ms, 99)), 3),
+        "latency_max_ms": round(float(durations_ms.max()), 3)
+    }
+
+
+def benchmark_dataset(dataset: str, cassette: Cassette, limit: int = None) -> dict:
+    """
+    Map all terms of a dataset (cold caches) and measure the time per term and per stage.
+
+    Args:
+        dataset: str name of the dataset (see DATASETS)
+        cassette: Cassette serving (or recording) the requests to the services
+        limit: int maximum number of terms, None for all
+
+    Returns:
+        Dict of the benchmark metrics
+    """
+    from GEM_eval import TermMapperEvaluator
+
+    test_data_path, do_not_delete = DATASETS[dataset]
+    evaluator = TermMapperEvaluator(test_data=test_data_path, do_not_delete=do_not_delete, exp_prefix=dataset)
+    startup = evaluator.TermMapper.warm_up()
+    test_data = [entry for entry in evaluator.load_test_data() if len(entry) == 3][:limit]
+
+    clear_shared_caches()
+
+    durations = []
+    stage_times = {stage: [] for stage in CascadePolicy.STAGES}
+    stage_calls = {stage: {} for stage in CascadePolicy.STAGES}
+    errors = []
+    # all calls, including the ones outside of the stages (e.g. the term ID lookup in reinsert mode)
+    remote_calls = {}
+
+    with use_cassette(cassette):
+        start_time = time.perf_counter()
+        for descriptor_id, term, sentence in test_data:
+            term_start = time.perf_counter()
+            try:
+                with count_remote_calls() as term_calls:
+                    ctx = evaluator.map_test_term(term, sentence)
+            except Exception as e:
+                errors.append({"term": term, "error": repr(e)})
+                continue
+            durations.append(time.perf_counter() - term_start)
+
+            for service, count in term_calls.items():
+                remote_calls[service] = remote_calls.get(service, 0) + count
+
+            for stage, duration in ctx.match_info["stage_times"].items():
+                stage_times[stage].append(duration)
+            for stage, calls in ctx.match_info["stage_calls"].items():
+                for service, count in calls.items():
+                    stage_calls[stage][service] = stage_calls[stage].get(service, 0) + count
+        total_time = time.perf_counter() - start_time
+
+    stages = {}
+    for stage in CascadePolicy.STAGES:
+        times = stage_times[stage]
+        stages[stage] = {
+            "total_s": round(sum(times), 4),
+            "share": round(sum(times) / sum(durations), 4) if sum(durations) > 0 else 0.0,
+            "mean_ms": round(sum(times) / len(times) * 1000, 3) if len(times) > 0 else 0.0,
+            "remote_calls": stage_calls[stage]
+        }
+
+    result = {
+        "terms": len(durations),
+        "errors": errors,
+        "total_s": round(total_time, 4),
+        "terms_per_s": round(len(durations) / total_time, 4) if total_time > 0 else 0.0
+    }
+    result.update(_summary(durations))
+    result.update({
+        "stages": stages,
+        "remote_calls": remote_calls,
+        "remote_calls_per_term": round(sum(remote_calls.values()) / len(durations), 3) if len(durations) > 0 else 0,
+        "caches": shared_cache_stats(),
+        "cassette": cassette.stats(),
+        "startup_s": startup
+    })
+    return result
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Compare benchmark results with a baseline.
+
+    Args:
+        results: dict of the current benchmark results
+        baseline: dict of the baseline results (same format)
+        threshold: float relative change of a metric that counts as a regression (e.g. 0.1 for 10%)
+
+    Returns:
+        List of regressions (empty if there is none)
+    """
+    regressions = []
+    for dataset, current in results["datasets"].items():
+        previous = baseline.get("datasets", {}).get(dataset)
+        if previous is None:
+            continue
+
+        for metric, higher_is_better in COMPARED_METRICS:
+            if metric not in current or not previous.get(metric):
+                continue
+            change = (current[metric] - previous[metric]) / previous[metric]
+            print(f"{dataset} {metric}: {previous[metric]} -> {current[metric]} ({round(change * 100, 1)}%)")
+            if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                regressions.append(f"{dataset} {metric}: {previous[metric]} -> {current[metric]}")
+
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    for dataset, result in results["datasets"].items():
+        print(f"--- {dataset}: {result['terms']} terms in {result['total_s']}s "
+              f"({result['terms_per_s']} terms/s, {len(result['errors'])} errors)")
+        if result["terms"] > 0:
+            print(f"latency ms: p50 {result['latency_p50_ms']}, p95 {result['latency_p95_ms']}, "
+                  f"p99 {result['latency_p99_ms']}, max {result['latency_max_ms']}")
+        for stage, stage_result in result["stages"].items():
+            print(f"  {stage}: {stage_result['total_s']}s ({round(stage_result['share'] * 100, 1)}%), "
+                  f"calls {stage_result['remote_calls']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the term mapping against recorded services")
+    parser.add_argument("datasets", nargs="*", default=list(DATASETS), help="reinsert and/or enrich (default: both)")
+    parser.add_argument("--record", action="store_true",
+                        help="record the cassettes from the live services instead of replaying them")
+    parser.add_argument("--cassette-dir", default="resources", help="directory of the benchmark cassettes")
+    parser.add_argument("--latency", default=NO_LATENCY,
+                        help=f"simulated latency per request: {NO_LATENCY}, {RECORDED_LATENCY} or seconds")
+    parser.add_argument("--limit", type=int, help="only map the first terms of each dataset")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change that counts as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    latency = args.latency if args.latency in (NO_LATENCY, RECORDED_LATENCY) else float(args.latency)
+    benchmark_results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "mode": RECORD if args.record else REPLAY,
+        "latency": latency,
+        "datasets": {}
+    }
+
+    for dataset_name in args.datasets:
+        path = cassette_path(args.cassette_dir, dataset_name)
+        dataset_cassette = Cassette(path, RECORD) if args.record else Cassette(path, REPLAY, latency)
+        benchmark_results["datasets"][dataset_name] = benchmark_dataset(dataset_name, dataset_cassette, args.limit)
+
+    print_results(benchmark_results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(benchmark_results, output_file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            found_regressions = compare(benchmark_results, json.load(baseline_file), args.threshold)
+        if len(found_regressions) > 0:
+            print("Regressions:")
+            for regression in found_regressions:
+                print(f"  {regression}")
+            sys.exit(1)
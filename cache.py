@@ -0,0 +1,120 @@
+""" Cache """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from collections import OrderedDict
+from typing import Any, Hashable
+import threading
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with hit/miss statistics. Safe to share between threads.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = value
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def keys(self) -> list:
+        """ Snapshot of the keys, from least to most recently used """
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """ Returns size, hit/miss counters and hit rate of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else 0.0
+            }
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def shared_cache(name: str, max_size: int = 1024) -> LRUCache:
+    """
+    Get the process-wide cache registered under the given name, create it on first use.
+
+    Args:
+        name: str identifying the cache (e.g. "walks")
+        max_size: int maximum number of entries, only used when the cache is created
+
+    Returns:
+        The shared LRUCache
+    """
+    with _shared_caches_lock:
+        if name not in _shared_caches:
+            _shared_caches[name] = LRUCache(max_size)
+        return _shared_caches[name]
+
+
+def shared_cache_stats() -> dict:
+    """ Returns the statistics of all shared caches by name """
+    with _shared_caches_lock:
+        caches = dict(_shared_caches)
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def clear_shared_caches() -> None:
+    """ Empty all shared caches (statistics are kept) """
+    with _shared_caches_lock:
+        caches = list(_shared_caches.values())
+    for cache in caches:
+        cache.clear()
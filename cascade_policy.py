@@ -0,0 +1,75 @@
+""" Cascade Policy """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Iterable, Optional
+import time
+
+
+class CascadePolicy:
+    """
+    Decides which stages of the matching cascade are run for a term.
+
+    In exhaustive mode every stage runs (the original behaviour). In early exit mode the cascade stops after
+    a stage listed in stop_after has produced at least min_findings findings. The similarity stages stop
+    iterating once the matched word (incl. its artificial relations) is handled, so the stages that ran yield
+    the same findings as in exhaustive mode.
+    Independent of the mode, a wall-clock budget per term can be set. If it runs out, the remaining work is
+    skipped and the result is marked as partial.
+    """
+
+    STAGES = ("fuzzy_direct", "most_similar", "similar", "compound")
+    EXHAUSTIVE = "exhaustive"
+    EARLY_EXIT = "early_exit"
+
+    def __init__(self, mode: str = EXHAUSTIVE,
+                 stop_after: Iterable[str] = (),
+                 min_findings: int = 1,
+                 time_budget: Optional[float] = None):
+        if mode not in (self.EXHAUSTIVE, self.EARLY_EXIT):
+            raise ValueError(f"Unknown cascade mode: {mode}")
+
+        stop_after = set(stop_after)
+        unknown_stages = stop_after.difference(self.STAGES)
+        if len(unknown_stages) > 0:
+            raise ValueError(f"Unknown cascade stages: {', '.join(sorted(unknown_stages))}")
+
+        self.mode = mode
+        self.stop_after = stop_after
+        self.min_findings = min_findings
+        self.time_budget = time_budget if time_budget else None
+
+    @classmethod
+    def from_conf(cls, conf: dict) -> "CascadePolicy":
+        stop_after = [stage.strip() for stage in conf.get("cascade_stop_after", "").split(",") if stage.strip()]
+        return cls(mode=conf.get("cascade_mode", cls.EXHAUSTIVE),
+                   stop_after=stop_after,
+                   min_findings=int(conf.get("cascade_min_findings", 1)),
+                   time_budget=float(conf.get("term_time_budget", 0)))
+
+    @classmethod
+    def exhaustive(cls) -> "CascadePolicy":
+        """ Run every stage without a time budget (batch evaluation) """
+        return cls(mode=cls.EXHAUSTIVE)
+
+    @property
+    def is_exhaustive(self) -> bool:
+        return self.mode == self.EXHAUSTIVE
+
+    def deadline(self) -> Optional[float]:
+        """ Returns the point in time (time.monotonic) at which the budget of a term starting now runs out """
+        if self.time_budget is None:
+            return None
+        return time.monotonic() + self.time_budget
+
+    def stop_after_stage(self, stage: str, num_findings: int) -> bool:
+        """ Returns true if the cascade should not continue after the given stage """
+        if self.is_exhaustive:
+            return False
+        return stage in self.stop_after and num_findings >= self.min_findings
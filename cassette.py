@@ -0,0 +1,253 @@
+"""
+Record and replay of the requests to GraphDB, the fastText server and SECOS
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from contextlib import contextmanager
+from typing import Any, Callable, Optional, Union
+import atexit
+import contextvars
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from lazy_loader import LazyResource, load_conf
+import tracing
+
+RECORD = "record"
+REPLAY = "replay"
+
+NO_LATENCY = "none"
+RECORDED_LATENCY = "recorded"
+
+DEFAULT_SEED = "cassette"
+
+
+class CassetteMissError(KeyError):
+    """ A request that is not on the cassette was made in replay mode """
+
+
+class Cassette:
+    """
+    Requests to the remote services and their responses, stored in a gzipped JSON file.
+
+    In record mode every request is sent to the service and its response (and latency) is stored.
+    In replay mode responses are served from the cassette only, a request that was not recorded raises a
+    CassetteMissError. The latency of the services can be simulated, either with the recorded latency or a
+    fixed latency per request.
+
+    Walks are generated with the seed of the cassette (unless 'walk_random_seed' is set), so a replayed
+    run sends exactly the requests of the recorded run.
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY, latency: Union[str, float] = NO_LATENCY, seed: str = None):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.seed = seed
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.recorded = {}
+
+        if mode == REPLAY:
+            self.load()
+        if self.seed is None:
+            self.seed = DEFAULT_SEED
+
+    @staticmethod
+    def key(service: str, request: Any) -> str:
+        request_str = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(f"{service}\0{request_str}".encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self) -> None:
+        with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+            data = json.load(cassette_file)
+        self._entries = data["entries"]
+        if self.seed is None:
+            self.seed = data.get("seed")
+
+    def save(self) -> None:
+        """ Write the cassette (only in record mode) """
+        if self.mode != RECORD:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            data = {"version": 1, "seed": self.seed, "entries": dict(self._entries)}
+
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as cassette_file:
+            json.dump(data, cassette_file, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def _count(self, counter: dict, service: str) -> None:
+        with self._lock:
+            counter[service] = counter.get(service, 0) + 1
+
+    def _simulate_latency(self, entry: dict) -> None:
+        if self.latency == NO_LATENCY:
+            return
+        duration = entry["t"] if self.latency == RECORDED_LATENCY else float(self.latency)
+        if duration > 0:
+            time.sleep(duration)
+
+    def call(self, service: str, request: Any, send: Callable[[], Any], store_response: bool = True) -> Any:
+        """
+        Replay the response of a request or send the request and record its response.
+
+        Args:
+            service: str name of the service ("sparql", "fasttext", "secos", ...)
+            request: JSON serializable request, identifies the response
+            send: function sending the request to the service, returns the response
+            store_response: bool, False to only record that the request was made (e.g. for updates)
+
+        Returns:
+            The (recorded) response
+        """
+        key = self.key(service, request)
+
+        if self.mode == REPLAY:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(self.misses, service)
+                raise CassetteMissError(f"{service} request not on cassette {self.path}: {str(request)[:200]}")
+            self._count(self.hits, service)
+            self._simulate_latency(entry)
+            return entry["r"]
+
+        start_time = time.perf_counter()
+        response = send()
+        duration = time.perf_counter() - start_time
+
+        # serialized right away, so later changes of the response by the caller are not recorded
+        stored = json.loads(json.dumps(response)) if store_response else None
+        with self._lock:
+            self._entries[key] = {"s": service, "t": round(duration, 6), "r": stored}
+        self._count(self.recorded, service)
+
+        return response
+
+    def stats(self) -> dict:
+        """ Recorded requests, replay hits and misses per service """
+        with self._lock:
+            return {"mode": self.mode, "entries": len(self._entries), "recorded": dict(self.recorded),
+                    "hits": dict(self.hits), "misses": dict(self.misses)}
+
+
+def _latency_from_conf(value: str) -> Union[str, float]:
+    if value in (None, "", NO_LATENCY):
+        return NO_LATENCY
+    if value == RECORDED_LATENCY:
+        return RECORDED_LATENCY
+    return float(value)
+
+
+def _load_cassette_from_conf() -> Optional[Cassette]:
+    conf = load_conf()
+    mode = conf.get("cassette_mode", "")
+    if mode not in (RECORD, REPLAY):
+        return None
+
+    cassette = Cassette(conf.get("cassette_path"), mode, _latency_from_conf(conf.get("cassette_latency")),
+                        conf.get("walk_random_seed") or None)
+    if mode == RECORD:
+        atexit.register(cassette.save)
+    print(f"Cassette: {mode} {cassette.path}")
+    return cassette
+
+
+# configured in config.ini, loaded on the first request
+_conf_cassette = LazyResource("cassette", _load_cassette_from_conf)
+_cassette_override = None
+
+
+def active_cassette() -> Optional[Cassette]:
+    if _cassette_override is not None:
+        return _cassette_override
+    return _conf_cassette.get()
+
+
+def is_recording() -> bool:
+    cassette = active_cassette()
+    return cassette is not None and cassette.mode == RECORD
+
+
+@contextmanager
+def use_cassette(cassette: Cassette):
+    """ Use the given cassette instead of the configured one within the context (saved at the end) """
+    global _cassette_override
+    previous = _cassette_override
+    _cassette_override = cassette
+    try:
+        yield cassette
+    finally:
+        _cassette_override = previous
+        cassette.save()
+
+
+# remote calls by service of the current context, see count_remote_calls
+_call_counts = contextvars.ContextVar("remote_call_counts", default=None)
+
+
+@contextmanager
+def count_remote_calls():
+    """
+    Count the remote calls (by service) made within the context, yields the dict of counts.
+    Counts of nested contexts are added to the enclosing context when they end.
+    """
+    counts = {}
+    token = _call_counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _call_counts.reset(token)
+        parent_counts = _call_counts.get()
+        if parent_counts is not None:
+            for service, count in counts.items():
+                parent_counts[service] = parent_counts.get(service, 0) + count
+
+
+def remote_call(service: str, request: Any, send: Callable[[], Any], store_response: bool = True) -> Any:
+    """ Send a request to a remote service, through the active cassette if there is one """
+    counts = _call_counts.get()
+    if counts is not None:
+        counts[service] = counts.get(service, 0) + 1
+
+    cassette = active_cassette()
+    if not tracing.enabled():
+        if cassette is None:
+            return send()
+        return cassette.call(service, request, send, store_response)
+
+    with tracing.span(f"{service}.request") as call_span:
+        call_span.set("request_bytes", len(json.dumps(request, ensure_ascii=False)))
+        if cassette is None:
+            response = send()
+        else:
+            call_span.set("cassette", cassette.mode)
+            response = cassette.call(service, request, send, store_response)
+        if store_response:
+            call_span.set("response_bytes", len(json.dumps(response, ensure_ascii=False, default=str)))
+        return response
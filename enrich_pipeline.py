@@ -0,0 +1,256 @@
+"""
+Streaming enrichment of raw documents: extract candidate terms with spaCy and map them to the Knowledge Graph
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Hashable, Iterable, Iterator, List, Optional, Tuple
+import argparse
+import json
+import os
+import sys
+
+from lazy_loader import load_conf
+from term_mapper import TermMapper
+
+CANDIDATE_POS = ("NOUN", "PROPN")
+
+
+def read_documents(paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Read documents lazily, one at a time.
+
+    Args:
+        paths: files or directories. A .jsonl file holds one document per line ({"id": ..., "text": ...}),
+            any other file is one document, directories are searched for .txt files. "-" reads JSONL from stdin.
+
+    Returns:
+        Iterator of (document id, text)
+    """
+    for path in paths:
+        if path == "-":
+            yield from _read_jsonl(sys.stdin, "stdin")
+        elif os.path.isdir(path):
+            for directory, sub_directories, file_names in os.walk(path):
+                sub_directories.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith(".txt"):
+                        yield from read_documents([os.path.join(directory, file_name)])
+        elif path.endswith(".jsonl"):
+            with open(path, "r", encoding="utf-8") as jsonl_file:
+                yield from _read_jsonl(jsonl_file, path)
+        else:
+            with open(path, "r", encoding="utf-8") as text_file:
+                yield path, text_file.read()
+
+
+def _read_jsonl(lines: Iterable[str], source: str) -> Iterator[Tuple[str, str]]:
+    for line_number, line in enumerate(lines):
+        if line.strip() == "":
+            continue
+        document = json.loads(line)
+        yield str(document.get("id", f"{source}:{line_number}")), document["text"]
+
+
+def extract_candidates(doc, min_length: int = 4) -> Iterator[Tuple[str, int, int, str]]:
+    """
+    Candidate terms of a spaCy document: nouns and proper nouns, and the same preceded by their adjectives
+    (e.g. "Hypertonie" and "arterielle Hypertonie").
+
+    Args:
+        doc: spaCy Doc (with sentence boundaries)
+        min_length: int minimum length of a noun to be a candidate
+
+    Returns:
+        Iterator of (term, start offset, end offset, sentence)
+    """
+    for sentence in doc.sents:
+        sentence_text = sentence.text
+        tokens = list(sentence)
+        for position, token in enumerate(tokens):
+            if token.pos_ not in CANDIDATE_POS or not token.is_alpha or token.is_stop or len(token.text) < min_length:
+                continue
+
+            yield token.text, token.idx, token.idx + len(token.text), sentence_text
+
+            start = position
+            while start > 0 and tokens[start - 1].pos_ == "ADJ" and tokens[start - 1].is_alpha:
+                start -= 1
+            if start < position:
+                span = doc[tokens[start].i: token.i + 1]
+                yield span.text, span.start_char, span.end_char, sentence_text
+
+
+class DedupeWindow:
+    """
+    Mappings of the terms seen in the last documents. A key (e.g. term and sentence) is mapped once as long as it
+    occurs again within the window, keys that did not occur in the window are forgotten, so memory does not grow
+    with the corpus.
+    """
+
+    def __init__(self, documents: int):
+        self.documents = documents
+        self._entries = {}
+        self._last_seen = {}
+        self._history = deque()
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Future]:
+        return self._entries.get(key)
+
+    def add(self, key: Hashable, value: Future) -> None:
+        self._entries[key] = value
+
+    def end_document(self, keys: Iterable[Hashable]) -> None:
+        """ Mark the keys as seen in the current document and move the window on by one document """
+        keys = set(keys)
+        for key in keys:
+            self._last_seen[key] = self._position
+        self._history.append((self._position, keys))
+        self._position += 1
+
+        while len(self._history) > self.documents:
+            position, old_keys = self._history.popleft()
+            for key in old_keys:
+                if self._last_seen.get(key) == position:
+                    del self._last_seen[key]
+                    self._entries.pop(key, None)
+
+
+def _finding_summary(finding: dict, similarity: float = None) -> dict:
+    summary = {"record": finding["corresponding_id"], "term": finding["corresponding_term"],
+               "queried_term": finding["queried_term"], "finding_type": finding["finding_type"]}
+    if similarity is not None:
+        summary["similarity"] = float(similarity)
+    return summary
+
+
+def summarize_matches(findings: Tuple) -> List[dict]:
+    """ Compact summary (record, term, finding type, similarity) of the findings returned by find_matches """
+    direct, similar, compound, artificial, translated, gem = findings
+
+    matches = [_finding_summary(finding) for finding in direct]
+    matches += [_finding_summary(finding, similarity) for finding, similarity in similar]
+    matches += [_finding_summary(finding) for finding in compound + artificial + translated]
+    matches += [_finding_summary(finding, similarity) for finding, similarity in gem]
+    return matches
+
+
+class EnrichmentPipeline:
+    """
+    Maps the candidate terms of a stream of documents. Documents are parsed in batches with nlp.pipe, candidates
+    are mapped by a pool of threads sharing one TermMapper, results are emitted per document in input order.
+    Only the documents in flight and the dedupe window are held in memory.
+
+    The mapping of a term depends on its context sentence, so a mapping is only reused for the same term in the same
+    sentence. With dedupe_by_term it is reused for the term in any sentence within the window: far fewer terms are
+    mapped, but a term gets the matches of its first occurrence (e.g. from the similar and GEM stages).
+    """
+
+    def __init__(self, term_mapper: TermMapper = None, batch_size: int = None, dedupe_window: int = None,
+                 workers: int = None, max_pending: int = None, min_term_length: int = None,
+                 dedupe_by_term: bool = None):
+        conf = load_conf()
+        self.term_mapper = term_mapper if term_mapper is not None else TermMapper()
+        self.batch_size = batch_size or int(conf.get("enrich_batch_size", 32))
+        self.dedupe_window = dedupe_window if dedupe_window is not None else int(conf.get("enrich_dedupe_window", 100))
+        self.workers = workers or int(conf.get("enrich_workers", 4))
+        self.max_pending = max_pending or int(conf.get("enrich_max_pending", 64))
+        self.min_term_length = min_term_length or int(conf.get("enrich_min_term_length", 4))
+        self.dedupe_by_term = dedupe_by_term if dedupe_by_term is not None \
+            else conf.get("enrich_dedupe_by_term", "false").lower() == "true"
+
+    def map_candidate(self, term: str, sentence: str) -> List[dict]:
+        """ Map a candidate term and return its findings in the order of TermMapper.find_matches """
+        return summarize_matches(self.term_mapper.find_matches(term, sentence))
+
+    @staticmethod
+    def _document_result(document_id: str, candidates: List[tuple]) -> dict:
+        results = []
+        for term, start, end, future, duplicate in candidates:
+            candidate = {"term": term, "start": start, "end": end, "deduplicated": duplicate}
+            try:
+                candidate["matches"] = future.result()
+            except Exception as e:
+                print(f"Mapping of '{term}' in {document_id} failed: {e!r}")
+                candidate["error"] = repr(e)
+            results.append(candidate)
+        return {"document": document_id, "candidates": results}
+
+    def run(self, documents: Iterable[Tuple[str, str]]) -> Iterator[dict]:
+        """
+        Extract and map the candidate terms of all documents.
+
+        Args:
+            documents: iterable of (document id, text), consumed lazily (see read_documents)
+
+        Returns:
+            Iterator of one result per document, in input order, as soon as all its candidates are mapped
+        """
+        nlp = self.term_mapper.nlp
+        window = DedupeWindow(self.dedupe_window)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            texts = ((text, document_id) for document_id, text in documents)
+            for doc, document_id in nlp.pipe(texts, as_tuples=True, batch_size=self.batch_size):
+                candidates = []
+                keys = []
+                for term, start, end, sentence in extract_candidates(doc, self.min_term_length):
+                    key = term if self.dedupe_by_term else (term, sentence)
+                    future = window.get(key)
+                    duplicate = future is not None
+                    if not duplicate:
+                        future = executor.submit(self.map_candidate, term, sentence)
+                        window.add(key, future)
+                    candidates.append((term, start, end, future, duplicate))
+                    keys.append(key)
+                window.end_document(keys)
+
+                pending.append((document_id, candidates))
+                # backpressure: parsing waits for the oldest documents once too many are in flight
+                while len(pending) > self.max_pending:
+                    yield self._document_result(*pending.popleft())
+
+            while len(pending) > 0:
+                yield self._document_result(*pending.popleft())
+
+    def run_to_file(self, documents: Iterable[Tuple[str, str]], output_path: str) -> int:
+        """ Run the pipeline and write one JSON line per document, flushed as soon as it is finished """
+        count = 0
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            for result in self.run(documents):
+                output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output_file.flush()
+                count += 1
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract candidate terms from documents and map them to MeSH")
+    parser.add_argument("inputs", nargs="+", help="text files, directories of .txt files or .jsonl files (- for stdin)")
+    parser.add_argument("--output", required=True, help="JSONL file with the candidates and matches per document")
+    parser.add_argument("--batch-size", type=int, help="documents per nlp.pipe batch (enrich_batch_size)")
+    parser.add_argument("--dedupe-window", type=int,
+                        help="documents a mapped term is reused for (enrich_dedupe_window)")
+    parser.add_argument("--dedupe-by-term", action="store_true", default=None,
+                        help="reuse a mapped term in other sentences, too (enrich_dedupe_by_term)")
+    parser.add_argument("--workers", type=int, help="mapping threads (enrich_workers)")
+    args = parser.parse_args()
+
+    pipeline = EnrichmentPipeline(batch_size=args.batch_size, dedupe_window=args.dedupe_window, workers=args.workers,
+                                  dedupe_by_term=args.dedupe_by_term)
+    pipeline.term_mapper.warm_up(nlp=True)
+    written = pipeline.run_to_file(read_documents(args.inputs), args.output)
+    print(f"{written} documents written to {args.output}")
@@ -0,0 +1,101 @@
+""" Compact query result rows and findings used while mapping a term """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Any, Iterable, List, Optional, Union
+
+
+class Binding:
+    """ A row of a query result with the ?record URI and ?termName (if selected) """
+
+    __slots__ = ("record_uri", "term_name")
+
+    def __init__(self, record_uri: str, term_name: Optional[str] = None):
+        self.record_uri = record_uri
+        self.term_name = term_name
+
+    @property
+    def record_id(self) -> str:
+        """ Record URI without the leading prefix """
+        return self.record_uri[self.record_uri.rfind("#") + 1:]
+
+    @property
+    def stripped_term_name(self) -> Optional[str]:
+        """ Term name without anything up to a "#" (same as TermMapper.get_record_value) """
+        if self.term_name is None:
+            return None
+        return self.term_name[self.term_name.rfind("#") + 1:]
+
+    @classmethod
+    def from_sparql(cls, binding: dict) -> "Binding":
+        term_name = binding.get("termName")
+        return cls(binding["record"]["value"], term_name["value"] if term_name is not None else None)
+
+    def __repr__(self) -> str:
+        return f"Binding({self.record_uri!r}, {self.term_name!r})"
+
+
+def as_bindings(result: Union[dict, List[Binding]]) -> List[Binding]:
+    """ Rows of a SPARQL JSON result as Bindings, lists of Bindings are returned as they are """
+    if isinstance(result, dict):
+        return [Binding.from_sparql(binding) for binding in result["results"]["bindings"]]
+    return result
+
+
+class Finding:
+    """ A record found for a term, converted to the finding dict of TermMapper.find_matches by to_dict """
+
+    __slots__ = ("base_word", "queried_term", "corresponding_id", "corresponding_term", "cor_walk", "finding_type",
+                 "context_sentence", "best_abstraction_path", "all_abstraction_path_similarities")
+
+    def __init__(self, base_word: str, queried_term: str, corresponding_id: str, corresponding_term: str,
+                 cor_walk: Any, finding_type: str, context_sentence: str):
+        self.base_word = base_word
+        self.queried_term = queried_term
+        self.corresponding_id = corresponding_id
+        self.corresponding_term = corresponding_term
+        self.cor_walk = cor_walk
+        self.finding_type = finding_type
+        self.context_sentence = context_sentence
+        self.best_abstraction_path = None
+        self.all_abstraction_path_similarities = None
+
+    def to_dict(self) -> dict:
+        return {
+            "base_word": self.base_word,
+            "queried_term": self.queried_term,
+            "corresponding_id": self.corresponding_id,
+            "corresponding_term": self.corresponding_term,
+            "cor_walk": self.cor_walk,
+            "finding_type": self.finding_type,
+            "context_sentence": self.context_sentence,
+            "best_abstraction_path": self.best_abstraction_path,
+            "all_abstraction_path_similarities": self.all_abstraction_path_similarities
+        }
+
+    def __repr__(self) -> str:
+        return f"Finding({self.corresponding_id!r}, {self.corresponding_term!r}, {self.finding_type!r})"
+
+
+class FindingList(list):
+    """ List of findings that also holds the set of their record IDs, so duplicate checks need no scan """
+
+    __slots__ = ("record_ids",)
+
+    def __init__(self, findings: Iterable[Finding] = ()):
+        super().__init__(findings)
+        self.record_ids = {finding.corresponding_id for finding in self}
+
+    def extend_findings(self, findings: List[Finding]) -> None:
+        self.extend(findings)
+        self.record_ids.update(finding.corresponding_id for finding in findings)
+
+
+def findings_to_dicts(findings: Iterable[Finding]) -> List[dict]:
+    return [finding.to_dict() for finding in findings]
@@ -8,14 +8,24 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
+from contextlib import contextmanager
+import contextvars
 import random
-import configparser
 import json
+import threading
 import time
 import urllib.error as urlerror
 
 from SPARQLWrapper import SPARQLWrapper, JSON, POST
 
+from cache import shared_cache
+from cassette import active_cassette, remote_call
+from lazy_loader import LazyResource, load_conf
+from single_flight import remote_calls
+from term_index import ArtificialRelationIndex, load_term_index
+import tracing
+from tracing import traced
+
 
 def string_variants(string):
     res = [
@@ -31,22 +41,79 @@ def string_variants(string):
     return set(res)
 
 
+def empty_result(variables):
+    return {"head": {"vars": variables}, "results": {"bindings": []}}
+
+
 def escape(term):
     return json.dumps(term)
 
 
 def mesh_str_values(variants):
+    # sorted, so the query is the same in every process (set order depends on the hash seed)
+    variants = sorted(variants)
     search_str = "^^mesh:string ".join(escape(v) for v in variants) + "^^mesh:string"
     search_str += " ".join(escape(v) for v in variants)
     return search_str
 
 
+def _load_term_index():
+    return load_term_index(GraphDBHandler(), load_conf())
+
+
+def _load_artificial_relation_index():
+    return ArtificialRelationIndex.build(GraphDBHandler())
+
+
+# (term id, lowercased term name) pairs hidden from all lookups of the current context, see virtual_deletion
+_hidden_terms = contextvars.ContextVar("hidden_terms", default=frozenset())
+
+
+def hidden_terms():
+    return _hidden_terms.get()
+
+
+@contextmanager
+def virtual_deletion(term, term_id):
+    """
+    Hide the 'hasTermName' relation of a term from all GraphDBHandler lookups (and the local indexes and
+    walk caches) within the context, without modifying the graph. Unlike delete_specific_term_from_mesh
+    this only affects the current thread or task, so many terms can be evaluated at the same time.
+
+    Args:
+        term: str term name to hide (case insensitive)
+        term_id: str MeSH term ID (without URI) the name belongs to
+    """
+    token = _hidden_terms.set(_hidden_terms.get() | {(term_id, term.lower())})
+    try:
+        yield
+    finally:
+        _hidden_terms.reset(token)
+
+
+@contextmanager
+def all_terms_visible():
+    """ Lift virtual_deletion within the context, e.g. to build results that are cached for all requests """
+    token = _hidden_terms.set(frozenset())
+    try:
+        yield
+    finally:
+        _hidden_terms.reset(token)
+
+
+# built from GraphDB on first use, once per process
+_term_index = LazyResource("term_index", _load_term_index)
+_artificial_relation_index = LazyResource("artificial_relation_index", _load_artificial_relation_index)
+
+
 class GraphDBHandler:
 
     def __init__(self):
         self._conf = dict()
         self._set_conf_from_config()
-        self._sparql = None
+        tracing.configure_from_conf(self._conf)
+        # SPARQLWrapper keeps the query on the instance, so every thread gets its own
+        self._local = threading.local()
 
         self._prefix = """
                         PREFIX mesh: <https://www.minds-medical.de/ontologies/tldia#>
@@ -58,39 +125,73 @@ class GraphDBHandler:
                         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
                        """
 
-        self._connection_retries = 0
         self._connection_retry_sleep = 1
         self._connection_max_retries = 10
         self._connection_timeout = 60  # in seconds
 
-        self.init_sparql()
+        # lookups known to have no result, keyed on (lookup type, term). Exact misses are kept per case variant,
+        # so an insert invalidates them with a single pop. The cache is per process: inserts made by another
+        # process (e.g. another evaluation worker) do not invalidate the misses cached here.
+        self.negative_cache = shared_cache("negative_lookups", int(self._conf.get("negative_cache_size", 100000)))
 
     def _set_conf_from_config(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        conf = config["ONTOLOGY_MAPPER"]
-        self._conf = dict(conf.items())
+        self._conf = load_conf()
 
     def set_conf_values(self, values: dict):
         self._conf.update(values)
 
+    @property
+    def term_index(self):
+        """ Local term index if 'use_local_term_index' is enabled, None otherwise """
+        if self._conf.get("use_local_term_index", "false").lower() != "true":
+            return None
+        return _term_index.get()
+
+    @property
+    def artificial_relation_index(self):
+        """ Local artificial relation index if 'use_local_artificial_index' is enabled, None otherwise """
+        if self._conf.get("use_local_artificial_index", "false").lower() != "true":
+            return None
+        return _artificial_relation_index.get()
+
     def init_sparql(self):
-        self._sparql = SPARQLWrapper(f"{self._conf.get('graphdb_repo_url')}{self._conf.get('graphdb_repo_name')}")
-        self._sparql.setCredentials(self._conf.get("graphdb_user"), self._conf.get("graphdb_passwd"))
-        self._sparql.setTimeout(self._connection_timeout)
+        sparql = SPARQLWrapper(f"{self._conf.get('graphdb_repo_url')}{self._conf.get('graphdb_repo_name')}")
+        sparql.setCredentials(self._conf.get("graphdb_user"), self._conf.get("graphdb_passwd"))
+        sparql.setTimeout(self._connection_timeout)
+
+        sparql.setReturnFormat(JSON)  # select the return format (e.g. XML, JSON etc...)
+        self._local.sparql = sparql
+        return sparql
 
-        self._sparql.setReturnFormat(JSON)  # select the return format (e.g. XML, JSON etc...)
+    @property
+    def _sparql(self):
+        sparql = getattr(self._local, "sparql", None)
+        if sparql is None:
+            sparql = self.init_sparql()
+        return sparql
 
     def query_ontology(self, query):
+        if self._conf.get("request_coalescing", "true").lower() == "true":
+            return remote_calls.do(("sparql", self._sparql.endpoint, query), lambda: self._recorded_query(query))
+        return self._recorded_query(query)
+
+    def _recorded_query(self, query):
+        # served from or recorded to the active cassette, if any (see cassette.py)
+        return remote_call("sparql", query, lambda: self._query_ontology(query))
+
+    def _query_ontology(self, query):
         res = None
+        connection_retries = 0
         while res is None:
             try:
-                self._sparql.setQuery(query)
-                res = self._sparql.query().convert()
+                sparql = self._sparql
+                sparql.setQuery(query)
+                res = sparql.query().convert()
             except Exception as e:
-                if self._connection_retries < self._connection_max_retries:
-                    self._connection_retries += 1
-                    print(f"SPARQLConnection Error. Retry {self._connection_retries} of {self._connection_max_retries}")
+                if connection_retries < self._connection_max_retries:
+                    connection_retries += 1
+                    tracing.current_span().add("retries")
+                    print(f"SPARQLConnection Error. Retry {connection_retries} of {self._connection_max_retries}")
                     if urlerror.URLError == type(e):
                         time.sleep(60)
                     else:
@@ -99,10 +200,13 @@ class GraphDBHandler:
                 else:
                     raise
 
-        self._connection_retries = 0
         return res
 
     def insert_into_ontology(self, query):
+        # the graph is not changed when replaying a cassette, updates are only recorded
+        return remote_call("sparql_update", query, lambda: self._insert_into_ontology(query), store_response=False)
+
+    def _insert_into_ontology(self, query):
         sparql = SPARQLWrapper(self._conf.get("graphdb_repo_url") +
                                self._conf.get("graphdb_repo_name") +
                                "/statements")
@@ -118,22 +222,38 @@ class GraphDBHandler:
 
         return results
 
+    @traced("graphdb.get_record_using_exact_matching")
     def get_record_using_exact_matching(self, term):
         term_variants = string_variants(term)
-        term_variants = mesh_str_values(term_variants)
+
+        term_index = self.term_index
+        if term_index is not None:
+            return term_index.lookup(term_variants, hidden_terms())
+
+        negative_keys = [("exact", variant) for variant in term_variants]
+        if all(self.negative_cache.get(negative_key, False) for negative_key in negative_keys):
+            tracing.current_span().set("negative_cache", "hit")
+            return empty_result(["record", "term", "termName"])
+        tracing.current_span().set("negative_cache", "miss")
+
+        search_values = mesh_str_values(term_variants)
 
         query = self._prefix + \
             """
-            SELECT ?record ?termName{
+            SELECT ?record ?term ?termName{
                 ?record rdf:type mesh:Record .
                 ?record mesh_entity:hasConcept ?concept .
                 ?concept mesh_entity:hasTerm ?term .
                 ?term mesh_entity:hasTermName ?termName .
-                VALUES ?termName {""" + term_variants + """}
+                VALUES ?termName {""" + search_values + """}
             }
             """
 
-        return self.query_ontology(query)
+        result = self.query_ontology(query)
+        if len(result["results"]["bindings"]) == 0:
+            for negative_key in negative_keys:
+                self.negative_cache.put(negative_key, True)
+        return self.without_hidden_terms(result)
 
     # def get_record_using_exact_matching_for_mesh_translated_terms(self, term):
     #     term_variants = string_variants(term)
@@ -164,22 +284,37 @@ class GraphDBHandler:
     #         """
     #     return self.query_ontology(query)
 
+    @traced("graphdb.get_id_from_mesh_term")
     def get_id_from_mesh_term(self, term):
         term_variants = string_variants(term)
         term_variants = mesh_str_values(term_variants)
 
         query = self._prefix + \
             f"""
-            SELECT ?term {{
+            SELECT ?term ?termName {{
                 ?concept mesh_entity:hasTerm ?term .
                 ?term mesh_entity:hasTermName ?termName .
                 VALUES ?termName {{{term_variants}}}
             }}
             """
 
-        return self.query_ontology(query)
+        return self.without_hidden_terms(self.query_ontology(query))
+
+    def invalidate_negative_lookups(self, term):
+        """
+        Forget the known miss of exact lookups that would find the given term name. Only the cache of this
+        process is updated, misses cached by other processes stay until they are evicted.
+        """
+        self.negative_cache.pop(("exact", term))
 
+    @traced("graphdb.insert_specific_term_into_mesh")
     def insert_specific_term_into_mesh(self, term, term_id):
+        self.invalidate_negative_lookups(term)
+        if _term_index.loaded:
+            result = self.get_record_id_of_term(term_id)
+            for binding in result["results"]["bindings"]:
+                _term_index.get().add(binding["record"]["value"], term_id, term)
+
         query = self._prefix + \
             f"""
             INSERT DATA{{
@@ -188,7 +323,11 @@ class GraphDBHandler:
             """
         return self.insert_into_ontology(query)
 
+    @traced("graphdb.delete_specific_term_from_mesh")
     def delete_specific_term_from_mesh(self, term, term_id):
+        if _term_index.loaded:
+            _term_index.get().remove(term_id, term)
+
         query = self._prefix + \
             f"""
             DELETE {{
@@ -205,6 +344,58 @@ class GraphDBHandler:
             """
         return self.insert_into_ontology(query)
 
+    @traced("graphdb.get_all_mesh_record_ids")
+    def get_all_mesh_record_ids(self):
+        query = self._prefix + \
+            """
+            SELECT ?record {
+                ?record rdf:type mesh:Record .
+            }
+            """
+        return self.query_ontology(query)
+
+    @traced("graphdb.get_all_record_term_names")
+    def get_all_record_term_names(self):
+        query = self._prefix + \
+            """
+            SELECT ?record ?term ?termName {
+                ?record rdf:type mesh:Record .
+                ?record mesh_entity:hasConcept ?concept .
+                ?concept mesh_entity:hasTerm ?term .
+                ?term mesh_entity:hasTermName ?termName .
+            }
+            """
+        return self.query_ontology(query)
+
+    @traced("graphdb.graph_fingerprint")
+    def graph_fingerprint(self):
+        """ Repository and number of record term names, to notice that a saved index no longer matches the graph """
+        query = self._prefix + \
+            """
+            SELECT (COUNT(*) AS ?count) {
+                ?record rdf:type mesh:Record .
+                ?record mesh_entity:hasConcept ?concept .
+                ?concept mesh_entity:hasTerm ?term .
+                ?term mesh_entity:hasTermName ?termName .
+            }
+            """
+        result = self.query_ontology(query)
+        return {"repository": f"{self._conf.get('graphdb_repo_url')}{self._conf.get('graphdb_repo_name')}",
+                "term_names": int(result["results"]["bindings"][0]["count"]["value"])}
+
+    @traced("graphdb.get_record_id_of_term")
+    def get_record_id_of_term(self, term_id):
+        query = self._prefix + \
+            f"""
+            SELECT ?record {{
+                ?record rdf:type mesh:Record .
+                ?record mesh_entity:hasConcept ?concept .
+                ?concept mesh_entity:hasTerm mesh:{term_id} .
+            }}
+            """
+        return self.query_ontology(query)
+
+    @traced("graphdb.get_all_index_listings_of_a_mesh_record")
     def get_all_index_listings_of_a_mesh_record(self, record_id):
         query = self._prefix + \
             f"""
@@ -214,6 +405,7 @@ class GraphDBHandler:
             """
         return self.query_ontology(query)
 
+    @traced("graphdb.get_term_from_mesh_group")
     def get_term_from_mesh_group(self, group_name):
         query = self._prefix + \
             f"""
@@ -225,6 +417,7 @@ class GraphDBHandler:
             """
         return self.query_ontology(query)
 
+    @traced("graphdb.get_record_id_from_mesh_listing_index")
     def get_record_id_from_mesh_listing_index(self, listing_index):
         query = self._prefix + \
             f"""
@@ -235,6 +428,7 @@ class GraphDBHandler:
             """
         return self.query_ontology(query)
 
+    @traced("graphdb.get_record_using_fuzzy_matching")
     def get_record_using_fuzzy_matching(self, term, method):
         threshold = 0
         comparison_sign = ">"
@@ -259,7 +453,7 @@ class GraphDBHandler:
 
         query = self._prefix + \
             """
-            SELECT ?record ?termName {
+            SELECT ?record ?term ?termName {
                 ?record rdf:type mesh:Record ;
                         mesh_entity:hasConcept ?concept .
                 ?concept mesh_entity:hasTerm ?term .
@@ -271,9 +465,20 @@ class GraphDBHandler:
             }
             """
 
-        return self.query_ontology(query)
+        return self.without_hidden_terms(self.query_ontology(query))
 
+    @traced("graphdb.get_records_with_artificial_relation")
     def get_records_with_artificial_relation(self, term):
+        artificial_relation_index = self.artificial_relation_index
+        if artificial_relation_index is not None:
+            return artificial_relation_index.lookup(term)
+
+        negative_key = ("artificial", term.lower())
+        if self.negative_cache.get(negative_key, False):
+            tracing.current_span().set("negative_cache", "hit")
+            return empty_result(["record", "relation", "termName"])
+        tracing.current_span().set("negative_cache", "miss")
+
         relation_iri = "mesh"
         relation_name = "hasNameGer"
         term = escape(term)
@@ -301,6 +506,32 @@ class GraphDBHandler:
                 }
             }
             """
+        result = self.query_ontology(query)
+        if len(result["results"]["bindings"]) == 0:
+            self.negative_cache.put(negative_key, True)
+        return result
+
+    @traced("graphdb.get_all_artificial_relations")
+    def get_all_artificial_relations(self):
+        """ All records with an artificial relation, including the ?searchTerm of the relation """
+        subqueries = []
+        for relation in ["artificial_similar_term", "artificial_compound_from"]:
+            subqueries.append(
+                """
+                {
+                    SELECT ?searchTerm ?record ?relation ?termName WHERE {
+                        ?record mesh:hasNameGer ?termName .
+                        ?record mesh:""" + relation + """  ?searchTerm .
+                        ?record ?relation ?termName .
+                    }
+                }
+                """)
+
+        query = self._prefix + \
+            """
+            SELECT ?searchTerm ?record ?relation ?termName WHERE
+            {""" + "UNION".join(subqueries) + """}
+            """
         return self.query_ontology(query)
 
     # # AT(P|N|B)T stands for artificial translated (preffered | narrower | broader) terms
@@ -331,6 +562,7 @@ class GraphDBHandler:
     #     else:
     #         return None
 
+    @traced("graphdb.get_mesh_terms_for_record")
     def get_mesh_terms_for_record(self, record_id):
         query = self._prefix + \
             f"""
@@ -343,8 +575,9 @@ class GraphDBHandler:
                 ?term mesh_entity:hasTermName ?termName .
             }}
             """
-        return self.query_ontology(query)
+        return self.without_hidden_terms(self.query_ontology(query))
 
+    @traced("graphdb.get_parent_record_id_from_mesh_record")
     def get_parent_record_id_from_mesh_record(self, child_record_id):
         query = self._prefix + \
             f"""
@@ -360,7 +593,35 @@ class GraphDBHandler:
     def remove_uri(self, value):
         return value.replace(self._conf.get("mesh_uri"), "")
 
+    def without_hidden_terms(self, query_result):
+        """ Copy of a query result with ?term and ?termName without the bindings hidden by virtual_deletion """
+        hidden = hidden_terms()
+        if len(hidden) == 0:
+            return query_result
+
+        bindings = [binding
+                    for binding in query_result["results"]["bindings"]
+                    if (self.remove_uri(binding["term"]["value"]), binding["termName"]["value"].lower()) not in hidden]
+        return {"head": query_result.get("head"), "results": {"bindings": bindings}}
+
+    def walk_rng(self, seed_key):
+        """
+        Random generator for walk generation. If 'walk_random_seed' is configured, the generator is seeded
+        with the seed and the given key (e.g. the start record), so walks are reproducible across runs.
+        Otherwise the global (unseeded) generator is used.
+        """
+        seed = self._conf.get("walk_random_seed")
+        if not seed:
+            cassette = active_cassette()
+            if cassette is None:
+                return random
+            # replayed walks must request the same records as the recorded ones
+            seed = cassette.seed
+        return random.Random(f"{seed}:{seed_key}")
+
+    @traced("graphdb.find_best_place_for_word_mesh")
     def find_best_place_for_word_mesh(self, start_record_id, word):
+        rng = self.walk_rng(start_record_id)
         iterations = 0
         record_ids = [start_record_id]
         walk_finished = False
@@ -380,17 +641,20 @@ class GraphDBHandler:
                 for binding in term_results["results"]["bindings"]:
                     german_mesh_terms.append(binding["termName"]["value"])
 
-            if word in german_mesh_terms:
-                german_mesh_terms.remove(word)
+            not_used_words = []
+            # word is None for walks that do not exclude any word (see walk_index)
+            if word is not None:
+                if word in german_mesh_terms:
+                    german_mesh_terms.remove(word)
 
-            not_used_words = [pos_word
-                              for pos_word in german_mesh_terms
-                              if word.lower() in pos_word.lower()]
+                not_used_words = [pos_word
+                                  for pos_word in german_mesh_terms
+                                  if word.lower() in pos_word.lower()]
 
             german_mesh_terms = [pos_allowed_word
                                  for pos_allowed_word in german_mesh_terms
                                  if pos_allowed_word not in not_used_words]
-            random.shuffle(german_mesh_terms)
+            rng.shuffle(german_mesh_terms)
             german_mesh_terms += not_used_words
 
             if len(german_mesh_terms) < max_range:
@@ -418,7 +682,9 @@ class GraphDBHandler:
     def find_best_place_for_word(self, start_record_id, word):
         return self.find_best_place_for_word_mesh(start_record_id, word)
 
+    @traced("graphdb.generate_path_comparison_walk_mesh_record_id_list")
     def generate_path_comparison_walk_mesh_record_id_list(self, record_id_list):
+        rng = self.walk_rng(".".join(record_id_list))
         walk = []
         i = 0
         while True:
@@ -442,7 +708,7 @@ class GraphDBHandler:
                     for binding in term_results["results"]["bindings"]:
                         german_mesh_terms.append(binding["termName"]["value"])
 
-                random.shuffle(german_mesh_terms)
+                rng.shuffle(german_mesh_terms)
                 max_range = min(len(german_mesh_terms), max_range)
                 walk += german_mesh_terms[:max_range]
                 i += 1
@@ -454,7 +720,8 @@ class GraphDBHandler:
         return walk
 
     def filter_mesh_onto_query_for_german_terms(self, query_result):
-        query_result["results"]["bindings"] = [binding
-                                               for binding in query_result["results"]["bindings"]
-                                               if "ger" in self.remove_uri(binding["term"]["value"])]
-        return query_result
+        # query results may be shared between concurrent callers, so a filtered copy is returned
+        bindings = [binding
+                    for binding in query_result["results"]["bindings"]
+                    if "ger" in self.remove_uri(binding["term"]["value"])]
+        return {"head": query_result.get("head"), "results": {"bindings": bindings}}
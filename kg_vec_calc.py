@@ -9,11 +9,246 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
+from typing import Iterable, List, Optional, Tuple
+import argparse
+import bisect
+import json
 import os
 import pickle
+import re
+import shutil
 import numpy as np
 from model_request import ModelRequest
+from findings import Binding
 from graphdb_handler import GraphDBHandler
+from lazy_loader import load_conf
+from tracing import traced
+
+GEM_DATA_PATH = os.path.join("resources", "kg_vec_data.pkl")
+GEM_STORE_VERSION = 1
+# file within the store path naming the current store version directory
+GEM_STORE_POINTER = "CURRENT"
+# names of the version directories and of the temporary entries (suffixed with the publisher's pid) in a store path
+_VERSION_NAME = re.compile(r"^v\d+-\d+-\d+$")
+_TMP_NAME = re.compile(r"^(v\d+-\d+-\d+|" + GEM_STORE_POINTER + r")\.tmp(\d+)$")
+
+
+class StringTable:
+    """ Strings stored in one UTF-8 buffer with offsets, so the table can be memory mapped and shared """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def arrays(strings: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+
+def _store_files(path: str, name: str) -> Tuple[str, str]:
+    return os.path.join(path, f"{name}.data.npy"), os.path.join(path, f"{name}.offsets.npy")
+
+
+def _source_info(data_path: str) -> Optional[dict]:
+    if not os.path.exists(data_path):
+        return None
+    stat = os.stat(data_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def write_gem_store(data: dict, path: str, source: dict = None) -> None:
+    """
+    Write the GEM data (wv, idx2term, term2idx, term2record) as a directory of .npy files that can be memory mapped:
+    the matrix, the terms by index, the sorted terms of term2idx for lookups and the records of every term index.
+    """
+    os.makedirs(path, exist_ok=True)
+    idx2term = list(data["idx2term"])
+
+    def save_strings(name, strings):
+        data_file, offsets_file = _store_files(path, name)
+        string_data, offsets = StringTable.arrays(strings)
+        np.save(data_file, string_data)
+        np.save(offsets_file, offsets)
+
+    np.save(os.path.join(path, "wv.npy"), np.ascontiguousarray(data["wv"]))
+    save_strings("terms", idx2term)
+
+    lookup_terms = sorted(data["term2idx"])
+    save_strings("lookup", lookup_terms)
+    np.save(os.path.join(path, "lookup_idx.npy"),
+            np.array([data["term2idx"][term] for term in lookup_terms], dtype=np.int64))
+
+    # records are stored once, every term index refers to its records
+    record_ids = {}
+    term_records = []
+    term_record_offsets = [0]
+    for term in idx2term:
+        for record in data["term2record"].get(term, []):
+            term_records.append(record_ids.setdefault(str(record), len(record_ids)))
+        term_record_offsets.append(len(term_records))
+    save_strings("records", record_ids)
+    np.save(os.path.join(path, "term_records.npy"), np.array(term_records, dtype=np.int32))
+    np.save(os.path.join(path, "term_records.offsets.npy"), np.array(term_record_offsets, dtype=np.int64))
+
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as meta_file:
+        json.dump({"version": GEM_STORE_VERSION, "terms": len(idx2term), "source": source}, meta_file)
+
+
+def _store_version(source: dict) -> str:
+    """ Name of the store directory written from a data file, the same in every process publishing it """
+    return f"v{GEM_STORE_VERSION}-{source['size']}-{int(source['mtime'] * 1e6)}"
+
+
+def current_gem_store(path: str) -> Optional[str]:
+    """ Directory of the store version the pointer file in path refers to, None if nothing is published """
+    try:
+        with open(os.path.join(path, GEM_STORE_POINTER), "r", encoding="utf-8") as pointer_file:
+            version_path = os.path.join(path, pointer_file.read().strip())
+    except OSError:
+        return None
+    return version_path if os.path.isdir(version_path) else None
+
+
+def gem_store_is_current(path: str, data_path: str = None) -> bool:
+    """ True if a store is published and was written from the current data file (or the data file does not exist) """
+    data_path = data_path or GEM_DATA_PATH
+    version_path = current_gem_store(path)
+    if version_path is None:
+        return False
+    try:
+        with open(os.path.join(version_path, "meta.json"), "r", encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+
+    source = _source_info(data_path)
+    return meta.get("version") == GEM_STORE_VERSION and (source is None or meta.get("source") == source)
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid() or os.name != "posix":
+        # there is no harmless way to check other processes on Windows, their leftovers are kept
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _remove_old_versions(path: str, version: str) -> None:
+    """
+    Remove the store versions other than the current one and the temporary files of publishers that died.
+    Only entries written by publish_gem_store are touched, anything else in path is left alone.
+    """
+    # processes still mapping an old version keep its pages. Where mapped files cannot be removed (Windows)
+    # the old version stays until a later publish.
+    for name in os.listdir(path):
+        old_path = os.path.join(path, name)
+        tmp_match = _TMP_NAME.match(name)
+        if tmp_match is not None:
+            if _process_alive(int(tmp_match.group(2))):
+                continue
+        elif _VERSION_NAME.match(name) is None or name == version:
+            continue
+
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def publish_gem_store(path: str, data_path: str = None) -> str:
+    """
+    Convert the GEM pickle to a memory mapped store once, e.g. in the parent process before starting workers.
+    Nothing is done if the store is current.
+
+    Every conversion is written to its own version directory within path, the pointer file naming the current
+    version is replaced atomically afterwards. So the published store never disappears, processes publishing
+    at the same time never see a partial store, and processes mapping the previous version keep working.
+
+    Returns:
+        Directory of the current store version (see GEMStore)
+    """
+    data_path = data_path or GEM_DATA_PATH
+    if gem_store_is_current(path, data_path):
+        return current_gem_store(path)
+
+    source = _source_info(data_path)
+    if source is None:
+        raise FileNotFoundError(f"GEM data {data_path} not found")
+    version = _store_version(source)
+    version_path = os.path.join(path, version)
+    os.makedirs(path, exist_ok=True)
+
+    if not os.path.exists(os.path.join(version_path, "meta.json")):
+        with open(data_path, "rb") as data_file:
+            data = pickle.load(data_file)
+
+        tmp_path = f"{version_path}.tmp{os.getpid()}"
+        write_gem_store(data, tmp_path, source)
+        try:
+            os.replace(tmp_path, version_path)
+        except OSError:
+            # the same version was published by another process meanwhile
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    pointer_tmp_path = os.path.join(path, f"{GEM_STORE_POINTER}.tmp{os.getpid()}")
+    with open(pointer_tmp_path, "w", encoding="utf-8") as pointer_file:
+        pointer_file.write(version)
+    os.replace(pointer_tmp_path, os.path.join(path, GEM_STORE_POINTER))
+
+    _remove_old_versions(path, version)
+    print(f"GEM store published to {version_path}")
+    return version_path
+
+
+class GEMStore:
+    """
+    Memory mapped GEM data of a store version written by publish_gem_store. The pages are shared by all processes
+    attaching to the same version, nothing is copied into the process.
+    """
+
+    def __init__(self, path: str):
+        def load(file_name):
+            return np.load(os.path.join(path, file_name), mmap_mode="r")
+
+        def load_strings(name):
+            data_file, offsets_file = _store_files(path, name)
+            return StringTable(np.load(data_file, mmap_mode="r"), np.load(offsets_file, mmap_mode="r"))
+
+        self.wv = load("wv.npy")
+        self.terms = load_strings("terms")
+        self.lookup_terms = load_strings("lookup")
+        self.lookup_idx = load("lookup_idx.npy")
+        self.record_ids = load_strings("records")
+        self.term_records = load("term_records.npy")
+        self.term_record_offsets = load("term_records.offsets.npy")
+
+    def index(self, term: str) -> Optional[int]:
+        """ Index of a term (as in term2idx), None if it is not in the store """
+        position = bisect.bisect_left(self.lookup_terms, term)
+        if position < len(self.lookup_terms) and self.lookup_terms[position] == term:
+            return int(self.lookup_idx[position])
+        return None
+
+    def records(self, index: int) -> List[str]:
+        start, end = self.term_record_offsets[index], self.term_record_offsets[index + 1]
+        return [self.record_ids[record] for record in self.term_records[start:end]]
 
 
 class GEMsim:
@@ -34,41 +269,55 @@ class GEMsim:
         self.idx2term = None
         self.term2idx = None
         self.term2record = None
+        # memory mapped data shared between processes, if 'gem_store_path' is set
+        self.store = None
         self._load_data()
 
     @staticmethod
     def _dummy_res(records, term):
-        bindings = []
-        for record in records:
-            tmp = {"record": {
-                "type": "uri",
-                "value": "https://www.minds-medical.de/ontologies/tldia#" + str(record)
-                }, "termName": {
-                "type": "string",
-                "value": term
-            }}
-            bindings.append(tmp)
-
-        query_result = {
-            "head": {"vars": []},
-            "results": {"bindings": bindings}
-        }
-        return query_result
+        """ Bindings of the records of a term, like a GraphDB result with ?record and ?termName """
+        return [Binding("https://www.minds-medical.de/ontologies/tldia#" + str(record), term) for record in records]
 
     def _load_data(self):
-        data = pickle.load(open(os.path.join("resources", "kg_vec_data.pkl"), "rb"))
+        store_path = load_conf().get("gem_store_path")
+        if store_path:
+            self.store = GEMStore(publish_gem_store(store_path))
+            self.wv = self.store.wv
+            return
+
+        data = pickle.load(open(GEM_DATA_PATH, "rb"))
         self.wv = data["wv"]
         self.idx2term = data["idx2term"]
         self.term2idx = data["term2idx"]
         self.term2record = data["term2record"]
 
-    def cosine_sim(self, word, topn=None):
+    def _term(self, index):
+        if self.store is not None:
+            return self.store.terms[index]
+        return self.idx2term[index]
+
+    def _term_index(self, term):
+        if self.store is not None:
+            return self.store.index(term)
+        return self.term2idx.get(term)
+
+    def _records(self, index, term):
+        if self.store is not None:
+            return self.store.records(index)
+        return self.term2record[term]
+
+    def _most_similar_indices(self, word, topn=None, min_sim=None):
+        """ (term index, similarity) of the terms most similar to word, best first """
+        if min_sim is None:
+            min_sim = self.min_sim
+
         word_vector = self._model_request.wv(word)
         word_vector = np.array(word_vector)
         all_keys = []
 
-        if word in self.term2idx:
-            all_keys = [self.term2idx[word]]
+        word_index = self._term_index(word)
+        if word_index is not None:
+            all_keys = [word_index]
 
         product = np.dot(self.wv, word_vector)
 
@@ -80,21 +329,21 @@ class GEMsim:
         most_extreme = np.argpartition(x, topn)[:topn]
         best = most_extreme.take(np.argsort(x.take(most_extreme)))  # resort topn into order
 
-        result = [
-            (self.idx2term[sim], float(product[sim]))
-            for sim in best if sim not in all_keys and float(product[sim]) > self.min_sim
-        ]
+        return [(sim, float(product[sim])) for sim in best if sim not in all_keys and float(product[sim]) > min_sim]
 
-        return result
+    def cosine_sim(self, word, topn=None, min_sim=None):
+        return [(self._term(index), sim) for index, sim in self._most_similar_indices(word, topn, min_sim)]
 
+    @traced("gem.find_record")
     def find_record(self, term, best=False, min_sim=None):
         if min_sim is not None:
-            self.min_sim = float(min_sim)
+            min_sim = float(min_sim)
 
-        similarities = self.cosine_sim(term)
+        similarities = self._most_similar_indices(term, min_sim=min_sim)
         res = []
-        for term, sim in similarities:
-            rec = self.term2record[term]
+        for index, sim in similarities:
+            term = self._term(index)
+            rec = self._records(index, term)
             rec = self._dummy_res(rec, term)
             tmp_res = (term, sim, rec)
 
@@ -107,6 +356,14 @@ class GEMsim:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GEM similarity search")
+    parser.add_argument("--publish-store", metavar="PATH",
+                        help="write the memory mapped store for 'gem_store_path' and exit")
+    args = parser.parse_args()
+    if args.publish_store:
+        publish_gem_store(args.publish_store)
+        raise SystemExit(0)
+
     gem = GEMsim(min_sim=0.75)
 
     test_words = ["Calcimycin", "Aspirin", "Hüftknochen"]
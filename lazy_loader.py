@@ -0,0 +1,101 @@
+""" Lazy Loader """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Any, Callable
+import configparser
+import threading
+import time
+import tracemalloc
+
+
+CONFIG_FILE = "config.ini"
+CONFIG_SECTION = "ONTOLOGY_MAPPER"
+
+_load_times = {}
+# memory allocated by loading, only recorded while tracemalloc is tracing (see profiling.trace_memory)
+_load_memory = {}
+_load_times_lock = threading.Lock()
+
+
+class LazyResource:
+    """
+    A resource (model, data file, ...) that is loaded on first use.
+    Loading happens once per process, even if several threads ask for the resource at the same time.
+    The load time is recorded for the startup report.
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.name = name
+        self._loader = loader
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> Any:
+        if self._loaded:
+            return self._value
+
+        with self._lock:
+            if not self._loaded:
+                tracing_memory = tracemalloc.is_tracing()
+                memory_before = tracemalloc.get_traced_memory()[0] if tracing_memory else 0
+                start_time = time.perf_counter()
+                self._value = self._loader()
+                duration = time.perf_counter() - start_time
+
+                with _load_times_lock:
+                    _load_times[self.name] = duration
+                    if tracing_memory:
+                        _load_memory[self.name] = tracemalloc.get_traced_memory()[0] - memory_before
+                self._loaded = True
+
+        return self._value
+
+
+def startup_report() -> dict:
+    """ Returns the load time in seconds of every resource loaded so far, by name """
+    with _load_times_lock:
+        return dict(_load_times)
+
+
+def memory_report() -> dict:
+    """ Returns the memory in bytes allocated by loading each resource loaded while tracemalloc was tracing """
+    with _load_times_lock:
+        return dict(_load_memory)
+
+
+def print_startup_report() -> None:
+    report = startup_report()
+    memory = memory_report()
+    print("Startup time per component:")
+    for name, duration in sorted(report.items(), key=lambda item: item[1], reverse=True):
+        if name in memory:
+            print(f"  {name}: {round(duration, 3)}s, {round(memory[name] / 2 ** 20, 1)} MiB")
+        else:
+            print(f"  {name}: {round(duration, 3)}s")
+    print(f"  total: {round(sum(report.values()), 3)}s")
+
+
+def _read_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return dict(config[CONFIG_SECTION].items())
+
+
+_config = LazyResource("config", _read_config)
+
+
+def load_conf() -> dict:
+    """ Returns a copy of the settings in config.ini. The file is only parsed once per process. """
+    return dict(_config.get())
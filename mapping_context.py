@@ -0,0 +1,98 @@
+""" Mapping Context """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Optional, Tuple
+import time
+
+from cascade_policy import CascadePolicy
+from findings import FindingList, findings_to_dicts
+
+
+class MappingContext:
+    """
+    State of mapping a single term. A new context is created for every TermMapper.find_matches call,
+    so one TermMapper can map several terms at the same time (e.g. from different threads).
+    """
+
+    def __init__(self, base_word: str, context_sentence: str, policy: CascadePolicy):
+        if type(base_word) is not str or len(base_word) == 0:
+            raise ValueError
+        if type(context_sentence) is not str or len(context_sentence) == 0:
+            raise ValueError
+
+        self.base_word = base_word
+        self.context_sentence = context_sentence
+
+        self.policy = policy
+        self.start_time = time.monotonic()
+        self.deadline = policy.deadline()
+        self.match_info = {"partial": False, "stages": [], "stopped_after": None, "stage_times": {},
+                           "stage_calls": {}}
+
+        # Findings while mapping, converted to dicts by results()
+        self.direct_found_terms = FindingList()
+        self.ft_found_terms = FindingList()
+        self.compound_found_terms = FindingList()
+        self.sorted_ft_findings = []
+        self.translated_found_terms = FindingList()
+        self.artificial_found_terms = FindingList()
+        self.sorted_gem_findings = []
+        self.gem_found_terms = FindingList()
+
+        self.all_findings_list = []
+
+        # raw candidates of all walk threshold checks, only recorded for threshold sweeps (see TermMapper.map_term)
+        self.candidates = None
+        self.stage = None
+        self.candidate_group = 0
+        self.candidate_sim = None
+
+    def budget_exceeded(self) -> bool:
+        """ Returns true (and marks the result as partial) if the time budget of the term ran out """
+        if self.deadline is None or time.monotonic() < self.deadline:
+            return False
+
+        self.match_info["partial"] = True
+        return True
+
+    def start_stage(self, stage: str) -> None:
+        self.stage = stage
+        self.candidate_group = 0
+        self.candidate_sim = None
+
+    def record_candidate(self, highest_sim: float, average_sim: float, record: Optional[str]) -> None:
+        """
+        Record a candidate before the walk thresholds are applied.
+
+        Args:
+            highest_sim: similarity of the best walk to the context sentence
+            average_sim: average similarity of the first walk terms to the base word
+            record: MeSH Record ID the candidate would be saved with, None if no binding belongs to the best walk
+        """
+        self.candidates.append({
+            "stage": self.stage,
+            "group": self.candidate_group,
+            "sim": self.candidate_sim,
+            "highest_sim": float(highest_sim),
+            "average_sim": float(average_sim),
+            "record": record
+        })
+
+    def finish(self) -> None:
+        self.match_info["elapsed"] = time.monotonic() - self.start_time
+
+    def results(self) -> Tuple:
+        """ Returns the findings (as dicts) in the order of TermMapper.find_matches """
+        return findings_to_dicts(self.direct_found_terms), \
+            [(finding.to_dict(), sim) for finding, sim in self.sorted_ft_findings], \
+            findings_to_dicts(self.compound_found_terms), \
+            findings_to_dicts(self.artificial_found_terms), \
+            findings_to_dicts(self.translated_found_terms), \
+            [(finding.to_dict(), sim) for finding, sim in self.sorted_gem_findings]
@@ -0,0 +1,308 @@
+"""
+HTTP/JSON service mapping terms with a warm TermMapper
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+from cache import shared_cache_stats
+from enrich_pipeline import summarize_matches
+from lazy_loader import load_conf
+from single_flight import remote_calls
+from term_mapper import TermMapper
+
+
+class ServiceOverloaded(Exception):
+    """ All worker slots are taken, the request should be retried later """
+
+
+class ServiceMetrics:
+    """ Request counters and the latencies of the most recent requests """
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.counts = {"requests": 0, "terms": 0, "errors": 0, "rejected": 0, "timeouts": 0}
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += value
+
+    def observe(self, duration: float) -> None:
+        with self._lock:
+            self._latencies.append(duration)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = dict(self.counts)
+            latencies = np.asarray(self._latencies) * 1000
+
+        if len(latencies) > 0:
+            for percentile in (50, 95, 99):
+                metrics[f"latency_p{percentile}_ms"] = round(float(np.percentile(latencies, percentile)), 3)
+        return metrics
+
+
+class MappingService:
+    """
+    Maps terms on a pool of threads sharing one TermMapper, so models, the GEM matrix and the caches are loaded
+    once and stay warm. At most max_queue terms are queued or running, further requests are rejected
+    (ServiceOverloaded) instead of piling up.
+    """
+
+    def __init__(self, term_mapper: TermMapper = None, workers: int = None, max_queue: int = None,
+                 max_batch: int = None, timeout: float = None):
+        conf = load_conf()
+        self.term_mapper = term_mapper if term_mapper is not None else TermMapper()
+        self.workers = workers or int(conf.get("service_workers", 4))
+        self.max_queue = max_queue or int(conf.get("service_max_queue", 128))
+        self.max_batch = max_batch or int(conf.get("service_max_batch", 64))
+        self.timeout = timeout or float(conf.get("service_request_timeout", 60))
+        if self.max_batch > self.max_queue:
+            # a larger batch could never get enough slots and would be rejected even by an idle service
+            raise ValueError(f"service_max_batch ({self.max_batch}) must not exceed service_max_queue "
+                             f"({self.max_queue})")
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mapping")
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+        self.metrics = ServiceMetrics()
+        self.ready = False
+        self.startup = {}
+        self.startup_error = None
+        self.start_time = time.time()
+
+    def warm_up(self) -> None:
+        """ Load all resources, the service accepts mapping requests afterwards """
+        try:
+            self.startup = self.term_mapper.warm_up()
+        except Exception as e:
+            self.startup_error = repr(e)
+            print(f"Loading the resources failed: {e!r}")
+            raise
+        self.ready = True
+
+    def _map_term(self, term: str, sentence: str) -> List[dict]:
+        try:
+            start_time = time.perf_counter()
+            matches = summarize_matches(self.term_mapper.find_matches(term, sentence))
+            self.metrics.observe(time.perf_counter() - start_time)
+            return matches
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def submit(self, items: List[Tuple[str, str]]) -> List[Future]:
+        """
+        Queue (term, sentence) pairs for mapping. Either all of them are queued or none.
+
+        Raises:
+            ServiceOverloaded: if there are not enough free slots
+        """
+        acquired = 0
+        for _ in items:
+            if not self._slots.acquire(blocking=False):
+                for _ in range(acquired):
+                    self._slots.release()
+                raise ServiceOverloaded(f"more than {self.max_queue} terms in flight")
+            acquired += 1
+
+        with self._in_flight_lock:
+            self._in_flight += acquired
+
+        futures = []
+        try:
+            for term, sentence in items:
+                futures.append(self.executor.submit(self._map_term, term, sentence))
+        except Exception:
+            # e.g. after shutdown: the slots of the items that were not queued are released here
+            not_queued = acquired - len(futures)
+            with self._in_flight_lock:
+                self._in_flight -= not_queued
+            for _ in range(not_queued):
+                self._slots.release()
+            raise
+        return futures
+
+    def map_terms(self, items: List[Tuple[str, str]]) -> List[dict]:
+        """
+        Map (term, sentence) pairs in parallel, identical pairs are mapped once.
+
+        Returns:
+            List of {"term", "matches"} (or {"term", "error"}) in the order of items
+        """
+        unique_items = list(dict.fromkeys(items))
+        futures = dict(zip(unique_items, self.submit(unique_items)))
+        deadline = time.monotonic() + self.timeout
+
+        results = []
+        for term, sentence in items:
+            try:
+                matches = futures[(term, sentence)].result(timeout=max(0.0, deadline - time.monotonic()))
+                results.append({"term": term, "matches": matches})
+            except FutureTimeoutError:
+                self.metrics.count("timeouts")
+                results.append({"term": term, "error": f"timeout after {self.timeout}s"})
+            except Exception as e:
+                self.metrics.count("errors")
+                results.append({"term": term, "error": repr(e)})
+
+        self.metrics.count("terms", len(items))
+        return results
+
+    def health(self) -> dict:
+        status = "ok" if self.ready else "failed" if self.startup_error is not None else "starting"
+        health = {"status": status, "uptime_s": round(time.time() - self.start_time, 1)}
+        if self.startup_error is not None:
+            health["error"] = self.startup_error
+        return health
+
+    def metrics_snapshot(self) -> dict:
+        with self._in_flight_lock:
+            in_flight = self._in_flight
+        return {
+            "service": dict(self.metrics.snapshot(), in_flight=in_flight, max_queue=self.max_queue,
+                            workers=self.workers),
+            "startup_s": self.startup,
+            "caches": shared_cache_stats(),
+            "remote_calls": remote_calls.stats()
+        }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def _parse_items(body: dict, max_batch: int) -> List[Tuple[str, str]]:
+    entries = body.get("terms") if "terms" in body else [body]
+    if not isinstance(entries, list) or len(entries) == 0:
+        raise ValueError("expected {\"term\": ..., \"sentence\": ...} or {\"terms\": [...]}")
+    if len(entries) > max_batch:
+        raise ValueError(f"at most {max_batch} terms per request")
+
+    items = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("term"), str) or entry["term"] == "":
+            raise ValueError("every entry needs a non-empty \"term\"")
+        if not isinstance(entry.get("sentence"), str) or entry["sentence"].strip() == "":
+            raise ValueError("every entry needs a non-empty \"sentence\" (the context of the term)")
+        items.append((entry["term"], entry["sentence"]))
+    return items
+
+
+def make_handler(service: MappingService):
+    """ Request handler class of the service """
+
+    class MappingRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status: int, data: dict, headers: dict = None) -> None:
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                health = service.health()
+                self._send_json(200 if service.ready else 503, health)
+            elif self.path == "/metrics":
+                self._send_json(200, service.metrics_snapshot())
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                if length < 0:
+                    raise ValueError
+            except ValueError:
+                self.close_connection = True
+                self._send_json(400, {"error": "invalid Content-Length"})
+                return
+            raw_body = self.rfile.read(length)
+
+            if self.path != "/map":
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            service.metrics.count("requests")
+            if not service.ready:
+                self._send_json(503, {"error": "service is starting"}, {"Retry-After": "5"})
+                return
+
+            try:
+                body = json.loads(raw_body or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("expected a JSON object")
+                items = _parse_items(body, service.max_batch)
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+
+            try:
+                results = service.map_terms(items)
+            except ServiceOverloaded as e:
+                service.metrics.count("rejected")
+                self._send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+                return
+
+            self._send_json(200, {"results": results} if "terms" in body else results[0])
+
+        def log_message(self, format, *args):
+            # requests are counted in /metrics instead of logged
+            pass
+
+    return MappingRequestHandler
+
+
+def serve(host: str = None, port: int = None, service: MappingService = None) -> None:
+    """ Run the mapping service until interrupted, resources are loaded while /health reports "starting" """
+    conf = load_conf()
+    host = host or conf.get("service_host", "127.0.0.1")
+    port = port or int(conf.get("service_port", 8090))
+    service = service if service is not None else MappingService()
+
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=service.warm_up, name="warm-up", daemon=True).start()
+
+    print(f"Mapping service on http://{host}:{port} ({service.workers} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP/JSON term mapping service")
+    parser.add_argument("--host", help="address to listen on (service_host)")
+    parser.add_argument("--port", type=int, help="port to listen on (service_port)")
+    parser.add_argument("--workers", type=int, help="mapping threads (service_workers)")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, MappingService(workers=args.workers))
@@ -10,31 +10,41 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
+import json
 import logging
-import configparser
 import requests
 import urllib.parse
 
+import numpy as np
+
+from cache import shared_cache
+from cassette import remote_call
+from lazy_loader import load_conf
+from single_flight import remote_calls
+import tracing
+from tracing import traced
+
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read("config.ini")
-conf = config["ONTOLOGY_MAPPER"]
 
-FAST_TEXT_PROTOCOL = conf.get("fasttext_protocol")
-FAST_TEXT_HOST = conf.get("fasttext_host")
-FAST_TEXT_PORT = conf.get("fasttext_port")
-FAST_TEXT_ADDR = None
-if FAST_TEXT_PORT is None:
-    FAST_TEXT_ADDR = FAST_TEXT_PROTOCOL + FAST_TEXT_HOST + "/"
-else:
-    FAST_TEXT_ADDR = FAST_TEXT_PROTOCOL + FAST_TEXT_HOST + ":" + str(FAST_TEXT_PORT) + "/"
+def fasttext_address(conf: dict) -> str:
+    fast_text_protocol = conf.get("fasttext_protocol")
+    fast_text_host = conf.get("fasttext_host")
+    fast_text_port = conf.get("fasttext_port")
+    if fast_text_port is None:
+        return fast_text_protocol + fast_text_host + "/"
+    return fast_text_protocol + fast_text_host + ":" + str(fast_text_port) + "/"
 
 
 class ModelRequest:
     def __init__(self):
-        self.base_url = FAST_TEXT_ADDR
+        conf = load_conf()
+        tracing.configure_from_conf(conf)
+        self.base_url = fasttext_address(conf)
+        self.coalesce_requests = conf.get("request_coalescing", "true").lower() == "true"
+        self.vector_cache = shared_cache("word_vectors", int(conf.get("vector_cache_size", 100000)))
 
+    @traced("fasttext.in_vocab")
     def in_vocab(self, word: str = "") -> bool:
         """
         Check if the word exists in the vocabulary of the model.
@@ -52,6 +62,7 @@ class ModelRequest:
         except Exception:
             return False
 
+    @traced("fasttext.n_similarity")
     def n_similarity(self, reference: list = None, word: list = None) -> float:
         if not type(reference) is list:
             reference = [reference]
@@ -65,8 +76,9 @@ class ModelRequest:
         }
         request_url = self.base_url + "n_similarity"
 
-        return self.req(request_url, data=data)
+        return self.request(request_url, data=data)
 
+    @traced("fasttext.most_similar")
     def most_similar(self, positive: list = None, top_n: int = 1):
         if not type(positive) is list:
             positive = [positive]
@@ -78,8 +90,9 @@ class ModelRequest:
 
         request_url = self.base_url + "most_similar"
 
-        return self.req(request_url, data=data)
+        return self.request(request_url, data=data)
 
+    @traced("fasttext.similarity")
     def similarity(self, base_word, lookup):
         data = {
             "w1": base_word,
@@ -87,15 +100,79 @@ class ModelRequest:
         }
 
         request_url = self.base_url + "similarity"
-        return self.req(request_url, data=data)
+        return self.request(request_url, data=data)
 
+    @traced("fasttext.wv")
     def wv(self, word):
         word = urllib.parse.quote(word, safe="")
         request_url = self.base_url + "wv/" + word
-        return self.req(request_url)
+        return self.request(request_url)
+
+    @traced("fasttext.word_vectors")
+    def word_vectors(self, words: list) -> dict:
+        """
+        Get the word vectors of all given words. Vectors are cached process-wide, so only words
+        that were not requested before cause a call to the model server.
+        :param words: Words to get the vectors for
+        :return: Dict of word to vector (numpy array). Empty words or failed requests are left out.
+        """
+        vectors = {}
+        for word in set(words):
+            if word == "":
+                continue
+
+            vector = self.vector_cache.get(word)
+            if vector is None:
+                tracing.current_span().add("vector_cache_misses")
+                response = self.wv(word)
+                if response is False or response is None:
+                    continue
+                vector = np.asarray(response, dtype=np.float32)
+                self.vector_cache.put(word, vector)
+
+            vectors[word] = vector
+
+        return vectors
+
+    @traced("fasttext.similarities")
+    def similarities(self, base_word: str, lookups: list) -> list:
+        """
+        Cosine similarity of a word to each of the given words, same as calling similarity for each of them,
+        computed locally from the (cached) word vectors in one step.
+        :param base_word: Word to compare to
+        :param lookups: Words to compare with the base word
+        :return: List of similarities in the order of lookups, 0.0 where no vector could be retrieved
+        """
+        if len(lookups) == 0:
+            return []
+
+        vectors = self.word_vectors([base_word] + list(lookups))
+        if base_word not in vectors:
+            return [0.0] * len(lookups)
+
+        base_vector = vectors[base_word]
+        dim = len(base_vector)
+        lookup_matrix = np.array([vectors.get(lookup, np.zeros(dim, dtype=np.float32)) for lookup in lookups])
+
+        norms = np.linalg.norm(lookup_matrix, axis=1) * np.linalg.norm(base_vector)
+        norms[norms == 0] = np.inf
+        return [float(sim) for sim in (lookup_matrix @ base_vector) / norms]
+
+    def request(self, request_url, data=None):
+        """ Send a request to the model server. Concurrent identical requests are merged into one. """
+        if not self.coalesce_requests:
+            return self.req(request_url, data=data)
+
+        key = ("fasttext", request_url, json.dumps(data, sort_keys=True))
+        return remote_calls.do(key, lambda: self.req(request_url, data=data))
 
     @staticmethod
     def req(request_url, data=None):
+        # served from or recorded to the active cassette, if any (see cassette.py)
+        return remote_call("fasttext", [request_url, data], lambda: ModelRequest._send(request_url, data))
+
+    @staticmethod
+    def _send(request_url, data=None):
         if data is not None:
             response = requests.post(url=request_url, json=data)
         else:
@@ -0,0 +1,229 @@
+""" Profiling """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from contextlib import contextmanager
+from typing import List, Optional
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+CPROFILE = "cprofile"
+SAMPLE = "sample"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread samples the stacks of all other threads at a fixed interval.
+    Much less overhead than cProfile, the stacks can be written as collapsed stacks (one "frame;frame;... count"
+    line per stack) for flamegraph.pl, speedscope or inferno.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write_collapsed(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as collapsed_file:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed_file.write(f"{stack} {count}\n")
+
+    def top_functions(self, limit: int = 25) -> List[tuple]:
+        """ (function, share of samples on top of the stack, share of samples anywhere in the stack) """
+        own = {}
+        total = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if len(frames) == 0:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+
+        sample_count = sum(self.stacks.values()) or 1
+        ranked = sorted(total, key=lambda frame: (own.get(frame, 0), total[frame]), reverse=True)[:limit]
+        return [(frame, own.get(frame, 0) / sample_count, total[frame] / sample_count) for frame in ranked]
+
+    def print_top(self, limit: int = 25) -> None:
+        print(f"Sampled {self.samples} times every {self.interval * 1000}ms, functions by own time:")
+        print("   own  total  function")
+        for frame, own_share, total_share in self.top_functions(limit):
+            print(f"{round(own_share * 100, 1):6}% {round(total_share * 100, 1):5}%  {frame}")
+
+
+@contextmanager
+def profile(mode: str, output_path: str = None, interval: float = 0.005, limit: int = 25):
+    """
+    Profile the code within the context and print the hotspots at the end.
+
+    Args:
+        mode: str "cprofile" (deterministic, all calls) or "sample" (statistical, low overhead)
+        output_path: str file for the pstats dump (cprofile) or the collapsed stacks (sample), None for no file
+        interval: float sampling interval in seconds (sample)
+        limit: int number of functions to print
+    """
+    if mode == CPROFILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            stats_output = io.StringIO()
+            pstats.Stats(profiler, stream=stats_output).sort_stats("cumulative").print_stats(limit)
+            print(stats_output.getvalue())
+            if output_path:
+                profiler.dump_stats(output_path)
+                print(f"cProfile stats written to {output_path} (e.g. python -m pstats {output_path})")
+
+    elif mode == SAMPLE:
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            profiler.print_top(limit)
+            if output_path:
+                profiler.write_collapsed(output_path)
+                print(f"Collapsed stacks written to {output_path} (e.g. flamegraph.pl {output_path} > flame.svg)")
+
+    else:
+        raise ValueError(f"Unknown profiling mode: {mode}")
+
+
+@contextmanager
+def trace_memory(label: str, limit: int = 10):
+    """
+    Trace the Python allocations within the context with tracemalloc and print the peak and the
+    allocation sites that grew the most. Resources loaded meanwhile get their size in the startup report.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if started:
+            tracemalloc.stop()
+
+        print(f"Memory {label}: {format_bytes(current)} allocated, peak {format_bytes(peak)}. Top allocation sites:")
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+        differences = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+        for difference in differences[:limit]:
+            print(f"  {format_bytes(difference.size_diff):>10}  {difference.traceback}")
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(size) < 1024:
+            return f"{round(size, 1)} {unit}"
+        size /= 1024
+    return f"{round(size, 1)} GiB"
+
+
+def peak_rss() -> Optional[dict]:
+    """ Peak resident set size in bytes of this process and of its largest (finished) child, None if unknown """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def print_peak_rss() -> None:
+    rss = peak_rss()
+    if rss is None:
+        return
+    print(f"Peak RSS: {format_bytes(rss['self'])}"
+          + (f", largest child process {format_bytes(rss['children'])}" if rss["children"] > 0 else ""))
+
+
+@contextmanager
+def term_timer(timing: dict):
+    """ Store the wall and CPU time (of the current thread) spent within the context in timing """
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield timing
+    finally:
+        timing["wall_s"] = round(time.perf_counter() - wall_start, 6)
+        timing["cpu_s"] = round(time.thread_time() - cpu_start, 6)
+
+
+def print_term_times(results: List[dict], limit: int = 10) -> None:
+    """ Summary of the per-term wall and CPU times of evaluation results, with the slowest terms """
+    timed = [result for result in results if "timing" in result]
+    if len(timed) == 0:
+        return
+
+    wall = np.array([result["timing"]["wall_s"] for result in timed])
+    cpu = np.array([result["timing"]["cpu_s"] for result in timed])
+    print(f"Time per term ({len(timed)} terms): wall mean {round(wall.mean() * 1000, 1)}ms, "
+          f"p50 {round(np.percentile(wall, 50) * 1000, 1)}ms, p95 {round(np.percentile(wall, 95) * 1000, 1)}ms, "
+          f"max {round(wall.max() * 1000, 1)}ms; CPU {round(cpu.sum() / max(wall.sum(), 1e-9) * 100, 1)}% of wall")
+
+    print("Slowest terms:")
+    for position in np.argsort(-wall)[:limit]:
+        result = timed[position]
+        print(f"  {round(wall[position] * 1000, 1)}ms (CPU {round(cpu[position] * 1000, 1)}ms)  "
+              f"{result['base_word']}")
@@ -8,21 +8,46 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
-import sys
+from contextlib import nullcontext
+import argparse
 from os import path
-from GEM_eval import TermMapperEvaluator
+from GEM_eval import TermMapperEvaluator, read_results
+from lazy_loader import print_startup_report
+from profiling import CPROFILE, SAMPLE, print_peak_rss, print_term_times, profile, trace_memory
+from tracing import CHROME, LOG, enable_tracing
 
 if "__main__" == __name__:
     default_mode = "reinsert"
     data_path = "test_data"
+    results_path = "results"
     reinsert_data_file = "reinsert_data.tsv"
     enrich_data_file = "enrich_data.tsv"
 
-    try:
-        mode = sys.argv[1]
-        if mode not in ["reinsert", "enrich"]:
-            mode = default_mode
-    except IndexError:
+    parser = argparse.ArgumentParser(description="Evaluate the term mapping on the test data")
+    parser.add_argument("mode", nargs="?", default=default_mode, help="reinsert (default) or enrich")
+    parser.add_argument("--results", help="JSONL file for the results of every term "
+                                          "(default: results/<experiment prefix>_results.jsonl)")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep the finished terms in the results file and only evaluate the rest")
+    parser.add_argument("--analyse-only", action="store_true",
+                        help="print the metrics of the results file without running the mapping")
+    parser.add_argument("--trace", choices=[LOG, CHROME],
+                        help="trace the stages and service requests: one JSON line per span or a Chrome trace "
+                             "(overrides 'tracing' in config.ini)")
+    parser.add_argument("--trace-output", help="file for the trace (default: stderr for log, trace.json for chrome)")
+    parser.add_argument("--profile", choices=[CPROFILE, SAMPLE],
+                        help="profile the evaluation (of the main process) with cProfile or a sampling profiler "
+                             "and print the hotspots, the time per term and the peak RSS")
+    parser.add_argument("--profile-output",
+                        help="pstats file (cprofile) or collapsed stacks for flamegraphs (sample), "
+                             "default: results/<experiment prefix>_profile.prof or .collapsed")
+    parser.add_argument("--profile-interval", type=float, default=5.0, help="sampling interval in ms (default: 5)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="trace the memory allocated while loading the models with tracemalloc")
+    args = parser.parse_args()
+
+    mode = args.mode
+    if mode not in ["reinsert", "enrich"]:
         mode = default_mode
 
     if mode == "reinsert":
@@ -35,10 +60,35 @@ if "__main__" == __name__:
         do_not_delete = True
         prefix = "enrich"
 
+    results_file = args.results or path.join(results_path, f"{prefix}_results.jsonl")
+
     print("Mode:", mode)
     print("Test Data:", test_data)
     print("Do-not-delete:", do_not_delete)
     print("Experiment Prefix:", prefix)
+    print("Results:", results_file)
+
+    if args.trace:
+        enable_tracing(args.trace, args.trace_output)
 
     tme = TermMapperEvaluator(test_data=test_data, do_not_delete=do_not_delete, exp_prefix=prefix)
-    tme.eval_mesh_mapping()
+    if args.analyse_only:
+        tme.analyse_results_file(results_file)
+    else:
+        with trace_memory("loading the models") if args.profile_memory else nullcontext():
+            tme.TermMapper.warm_up()
+        print_startup_report()
+
+        if args.profile:
+            extension = "prof" if args.profile == CPROFILE else "collapsed"
+            profile_output = args.profile_output or path.join(results_path, f"{prefix}_profile.{extension}")
+            profiler = profile(args.profile, profile_output, args.profile_interval / 1000)
+        else:
+            profiler = nullcontext()
+
+        with profiler:
+            tme.eval_mesh_mapping(results_path=results_file, resume=args.resume)
+
+        if args.profile or args.profile_memory:
+            print_term_times(read_results(results_file))
+            print_peak_rss()
@@ -9,76 +9,127 @@ __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
 from typing import List
-import configparser
-import os
 
-import nltk
 import numpy as np
 
-
-config = configparser.ConfigParser()
-config.read("config.ini")
-conf = config["ONTOLOGY_MAPPER"]
-
-stop_word_file = open(os.path.join(conf.get("resources_dir"), conf.get("stopwords_data")), "r")
-stop_words = stop_word_file.read().split("\n")
+from sentence_preprocessor import default_preprocessor
 
 
 def compute_cosine_similarity(encoded_message_one, encoded_message_two):
-    dot_product = np.dot(encoded_message_one, encoded_message_two)
-    mag_i = np.sqrt(np.dot(encoded_message_one, encoded_message_one))
-    mag_j = np.sqrt(np.dot(encoded_message_two, encoded_message_two))
+    """ Cosine similarity of a vector to another vector, or to every row of a matrix """
+    encoded_message_two = np.asarray(encoded_message_two)
+    dot_product = encoded_message_two @ encoded_message_one
+    mag_i = np.linalg.norm(encoded_message_one)
+    mag_j = np.linalg.norm(encoded_message_two, axis=-1)
 
     cos_theta = dot_product / (mag_i * mag_j)
 
     return cos_theta
 
 
-def find_best_match(encoded_sentence, encoded_possible_trees):
-    highest_index = None
-    highest_sim = -1
-    index = 0
-    for possible_tree_entry in encoded_possible_trees:
-        cos_sim = compute_cosine_similarity(encoded_sentence[0], possible_tree_entry)
-        if cos_sim > highest_sim:
-            highest_sim = cos_sim
-            highest_index = index
-        index += 1
+def _best_index(similarities: np.ndarray):
+    """ Index and value of the highest similarity (first one on ties), (None, -1) if none is above -1 """
+    if len(similarities) == 0:
+        return None, -1
+
+    best_index = int(np.argmax(np.nan_to_num(similarities, nan=-np.inf)))
+    highest_sim = float(similarities[best_index])
+    if not highest_sim > -1:
+        return None, -1
+    return best_index, highest_sim
 
-    return highest_index, highest_sim
+
+def find_best_match(encoded_sentence, encoded_possible_trees):
+    similarities = compute_cosine_similarity(encoded_sentence[0], np.asarray(encoded_possible_trees))
+    return _best_index(np.atleast_1d(similarities))
 
 
 def tokenize_sentence(sentence: str) -> List[str]:
     """
-    Tokenize sentence with NLTK tokenizer and remove stopwords
+    Tokenize sentence with the configured tokenizer (NLTK by default) and remove stopwords
     Args:
         sentence: str to be tokenized
 
     Returns:
         list of str, the tokenized sentence without stopwords
     """
-    tokenized_sentence = nltk.tokenize.word_tokenize(sentence, language='german')
-    tokenized_sentence = [w for w in tokenized_sentence if not w.lower() in stop_words]
+    return default_preprocessor().tokenize(sentence)
 
-    return tokenized_sentence
 
+def unit_vector(vector):
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
 
-def find_best_n_similarity_match(sentence: str, possible_tree: dict, model_request):
-    tokenized_sentence = tokenize_sentence(sentence)
-    tokenized_sentence_no_punct = list(filter(lambda t: "," not in t and "." not in t, tokenized_sentence))
 
-    all_similarities = []
-    best_record = None
-    highest_sim = -1
+def encode_walks(walks: dict, model_request) -> np.ndarray:
+    """
+    Encode every walk as the normalized mean vector of its terms (same as the model server's n_similarity).
+    All terms of all walks are requested in one go.
+    Args:
+        walks: dict of key to walk (comma separated terms)
+        model_request: ModelRequest instance
+
+    Returns:
+        matrix with one row per walk, in the order of the walks dict. Rows of walks without vectors are zero.
+    """
+    walk_terms = [walk.split(", ") for walk in walks.values()]
+    vectors = model_request.word_vectors([term for terms in walk_terms for term in terms])
+    dim = len(next(iter(vectors.values()))) if len(vectors) > 0 else 0
+
+    walk_matrix = np.zeros((len(walk_terms), dim), dtype=np.float32)
+    for row, terms in enumerate(walk_terms):
+        term_vectors = [vectors[term] for term in terms if term in vectors]
+        if len(term_vectors) > 0:
+            walk_matrix[row] = unit_vector(np.mean(term_vectors, axis=0))
+
+    return walk_matrix
+
 
-    for possible_entry in possible_tree:
-        tree_terms = possible_tree[possible_entry].split(", ")
-        n_sim = model_request.n_similarity(tree_terms, tokenized_sentence_no_punct)
+def sentence_tokens(sentence: str) -> List[str]:
+    """ Tokenized sentence without stopwords and punctuation, as used for walk comparison """
+    return default_preprocessor().tokens(sentence)
 
-        all_similarities.append((str(n_sim), possible_entry, possible_tree[possible_entry]))
 
-        if n_sim > highest_sim:
-            highest_sim = n_sim
-            best_record = possible_entry
+def encode_sentence(sentence: str, model_request):
+    """ Normalized mean vector of the sentence tokens (without stopwords and punctuation), None if there is none """
+    return default_preprocessor().vector(sentence, model_request)
+
+
+def find_best_n_similarity_match_encoded(sentence: str, possible_tree: dict, walk_matrix: np.ndarray, model_request):
+    """
+    Same as find_best_n_similarity_match, but with walks already encoded by encode_walks.
+    Scoring all walks is a single matrix-vector product.
+    """
+    sentence_vector = encode_sentence(sentence, model_request)
+    if sentence_vector is None or walk_matrix.shape[1] == 0:
+        similarities = np.zeros(len(possible_tree))
+    else:
+        similarities = walk_matrix @ sentence_vector
+
+    all_similarities = [(str(float(n_sim)), possible_entry, possible_tree[possible_entry])
+                        for possible_entry, n_sim in zip(possible_tree, similarities)]
+
+    best_index, highest_sim = _best_index(similarities)
+    best_record = list(possible_tree)[best_index] if best_index is not None else None
 
     return best_record, highest_sim, all_similarities
+
+
+def find_best_n_similarity_match(sentence: str, possible_tree: dict, model_request):
+    """
+    Find the walk most similar to the sentence. Similarity is the cosine of the mean vectors of the
+    sentence tokens and the walk terms (n_similarity of the model server). The sentence is encoded once,
+    the terms of all walks are fetched together and all walks are scored with one matrix product.
+
+    Args:
+        sentence: str context sentence
+        possible_tree: dict of key (e.g. record id) to walk (comma separated terms)
+        model_request: ModelRequest instance
+
+    Returns:
+        Tuple of the best key, its similarity and a list of (similarity, key, walk) for all walks
+    """
+    walk_matrix = encode_walks(possible_tree, model_request)
+    return find_best_n_similarity_match_encoded(sentence, possible_tree, walk_matrix, model_request)
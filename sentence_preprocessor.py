@@ -0,0 +1,151 @@
+""" Sentence Preprocessor """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Iterable, List, Optional
+import os
+import re
+
+import numpy as np
+
+from cache import shared_cache
+from lazy_loader import LazyResource, load_conf
+
+NLTK_TOKENIZER = "nltk"
+REGEX_TOKENIZER = "regex"
+
+# numbers with separators, words (incl. hyphenated compounds like "S-Adenosyl-L-methionin") or single symbols
+_TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)+|\w+(?:[-'’]\w+)*|[^\w\s]")
+
+
+def _load_stop_words() -> frozenset:
+    conf = load_conf()
+    with open(os.path.join(conf.get("resources_dir"), conf.get("stopwords_data")), "r") as stop_word_file:
+        return frozenset(stop_word_file.read().split("\n"))
+
+
+def _load_nltk_tokenizer():
+    import nltk
+    return nltk.tokenize.word_tokenize
+
+
+stop_words = LazyResource("sentence_stopwords", _load_stop_words)
+nltk_word_tokenize = LazyResource("nltk_tokenizer", _load_nltk_tokenizer)
+
+
+def regex_word_tokenize(sentence: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(sentence)
+
+
+class SentencePreprocessor:
+    """
+    Tokenizes context sentences, removes stopwords and punctuation and encodes them.
+    Tokens and sentence vectors are cached, so a sentence is processed once no matter how often it is
+    compared to walks while mapping a term.
+    """
+
+    def __init__(self, tokenizer: str = NLTK_TOKENIZER, cache_size: int = 10000):
+        if tokenizer not in (NLTK_TOKENIZER, REGEX_TOKENIZER):
+            raise ValueError(f"Unknown tokenizer: {tokenizer}")
+
+        self.tokenizer = tokenizer
+        self._token_cache = shared_cache(f"sentence_tokens_{tokenizer}", cache_size)
+        self._vector_cache = shared_cache(f"sentence_vectors_{tokenizer}", cache_size)
+
+    def tokenize(self, sentence: str) -> List[str]:
+        """ Tokenize sentence and remove stopwords """
+        if self.tokenizer == REGEX_TOKENIZER:
+            tokenized_sentence = regex_word_tokenize(sentence)
+        else:
+            tokenized_sentence = nltk_word_tokenize.get()(sentence, language='german')
+
+        sentence_stop_words = stop_words.get()
+        return [w for w in tokenized_sentence if w.lower() not in sentence_stop_words]
+
+    def tokens(self, sentence: str) -> List[str]:
+        """ Tokenized sentence without stopwords and punctuation, as used for walk comparison (cached) """
+        tokens = self._token_cache.get(sentence)
+        if tokens is None:
+            tokens = [t for t in self.tokenize(sentence) if "," not in t and "." not in t]
+            self._token_cache.put(sentence, tokens)
+        return tokens
+
+    def vector(self, sentence: str, model_request) -> Optional[np.ndarray]:
+        """ Normalized mean vector of the sentence tokens (cached), None if no token has a vector """
+        if sentence in self._vector_cache:
+            return self._vector_cache.get(sentence)
+
+        tokens = self.tokens(sentence)
+        vectors = model_request.word_vectors(tokens)
+        token_vectors = [vectors[token] for token in tokens if token in vectors]
+
+        sentence_vector = None
+        if len(token_vectors) > 0:
+            sentence_vector = np.mean(token_vectors, axis=0)
+            norm = np.linalg.norm(sentence_vector)
+            if norm > 0:
+                sentence_vector = sentence_vector / norm
+
+        self._vector_cache.put(sentence, sentence_vector)
+        return sentence_vector
+
+
+def validate_regex_tokenizer(sentences: Iterable[str]) -> dict:
+    """
+    Compare the tokens of the regex tokenizer with the NLTK tokenizer (after stopword and punctuation removal).
+
+    Args:
+        sentences: sentences to compare on (e.g. the context sentences of the test data)
+
+    Returns:
+        Dict with the number of sentences, the share of sentences with identical tokens and the mismatches
+    """
+    nltk_preprocessor = SentencePreprocessor(NLTK_TOKENIZER)
+    regex_preprocessor = SentencePreprocessor(REGEX_TOKENIZER)
+
+    total = 0
+    mismatches = []
+    for sentence in sentences:
+        total += 1
+        nltk_tokens = nltk_preprocessor.tokens(sentence)
+        regex_tokens = regex_preprocessor.tokens(sentence)
+        if nltk_tokens != regex_tokens:
+            mismatches.append({"sentence": sentence, "nltk": nltk_tokens, "regex": regex_tokens})
+
+    return {
+        "sentences": total,
+        "agreement": round(1 - len(mismatches) / total, 4) if total > 0 else 1.0,
+        "mismatches": mismatches
+    }
+
+
+_default_preprocessor = None
+
+
+def default_preprocessor() -> SentencePreprocessor:
+    """ The preprocessor configured by 'sentence_tokenizer' and 'sentence_cache_size' """
+    global _default_preprocessor
+    if _default_preprocessor is None:
+        conf = load_conf()
+        _default_preprocessor = SentencePreprocessor(conf.get("sentence_tokenizer", NLTK_TOKENIZER),
+                                                     int(conf.get("sentence_cache_size", 10000)))
+    return _default_preprocessor
+
+
+if __name__ == "__main__":
+    import sys
+
+    test_data_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join("test_data", "reinsert_data.tsv")
+    with open(test_data_path) as f:
+        context_sentences = [line.split("\t")[2] for line in f.read().split("\n") if line.count("\t") == 2]
+
+    report = validate_regex_tokenizer(context_sentences)
+    print(f"Sentences: {report['sentences']}, agreement: {report['agreement']}")
+    for mismatch in report["mismatches"]:
+        print(mismatch)
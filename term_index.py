@@ -0,0 +1,157 @@
+""" Local index of the term names in the Knowledge Graph """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import AbstractSet, Iterable, List, Tuple
+import os
+import pickle
+import sys
+import threading
+
+_UMLAUT_FOLDING = str.maketrans({"ä": "a", "ö": "o", "ü": "u"})
+
+
+def normalize_term(term: str, fold_umlauts: bool = False) -> str:
+    """ Key of a term in the index: casefolded (ß becomes ss), optionally without umlauts """
+    key = term.casefold()
+    if fold_umlauts:
+        key = key.translate(_UMLAUT_FOLDING)
+    return key
+
+
+class TermIndex:
+    """
+    In-memory hash index from normalized term name to the (record, term, term name) entries of the graph.
+
+    Lookups return the same bindings as GraphDBHandler.get_record_using_exact_matching: all entries whose
+    term name equals one of the case variants of the term. The normalized key only narrows down the candidates.
+    """
+
+    def __init__(self, fold_umlauts: bool = False, fingerprint: dict = None):
+        self.fold_umlauts = fold_umlauts
+        # graph the index was built from (see GraphDBHandler.graph_fingerprint)
+        self.fingerprint = fingerprint
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._entries.values())
+
+    def add(self, record_uri: str, term_id: str, term_name: str) -> None:
+        key = normalize_term(term_name, self.fold_umlauts)
+        entry = (sys.intern(record_uri), sys.intern(term_id), term_name)
+        with self._lock:
+            self._entries.setdefault(key, []).append(entry)
+
+    def remove(self, term_id: str, term_name: str) -> None:
+        """ Remove the term name of a term (case insensitive, like GraphDBHandler.delete_specific_term_from_mesh) """
+        key = normalize_term(term_name, self.fold_umlauts)
+        with self._lock:
+            entries = self._entries.get(key, [])
+            entries = [entry for entry in entries
+                       if not (entry[1] == term_id and entry[2].lower() == term_name.lower())]
+            if len(entries) > 0:
+                self._entries[key] = entries
+            else:
+                self._entries.pop(key, None)
+
+    def entries(self, term_variants: Iterable[str]) -> List[Tuple[str, str, str]]:
+        """ All (record uri, term id, term name) entries whose term name is one of the given variants """
+        term_variants = set(term_variants)
+        keys = {normalize_term(variant, self.fold_umlauts) for variant in term_variants}
+
+        with self._lock:
+            candidates = [entry for key in keys for entry in self._entries.get(key, [])]
+
+        return [entry for entry in candidates if entry[2] in term_variants]
+
+    def lookup(self, term_variants: Iterable[str], hidden: AbstractSet[Tuple[str, str]] = frozenset()) -> dict:
+        """
+        Same as entries, as SPARQL JSON result with ?record and ?termName.
+        Entries in hidden, given as (term id, lowercased term name) pairs, are left out (see virtual_deletion).
+        """
+        bindings = [{"record": {"type": "uri", "value": record_uri},
+                     "termName": {"type": "literal", "value": term_name}}
+                    for record_uri, term_id, term_name in self.entries(term_variants)
+                    if (term_id, term_name.lower()) not in hidden]
+        return {"head": {"vars": ["record", "termName"]}, "results": {"bindings": bindings}}
+
+    @classmethod
+    def build(cls, graphdb, fold_umlauts: bool = False) -> "TermIndex":
+        """ Build the index from all term names in GraphDB """
+        index = cls(fold_umlauts, graphdb.graph_fingerprint())
+        result = graphdb.get_all_record_term_names()
+        for binding in result["results"]["bindings"]:
+            index.add(binding["record"]["value"],
+                      graphdb.remove_uri(binding["term"]["value"]),
+                      binding["termName"]["value"])
+        return index
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as index_file:
+            pickle.dump({"fold_umlauts": self.fold_umlauts, "fingerprint": self.fingerprint,
+                         "entries": self._entries}, index_file)
+
+    @classmethod
+    def load(cls, path: str) -> "TermIndex":
+        with open(path, "rb") as index_file:
+            data = pickle.load(index_file)
+        index = cls(data["fold_umlauts"], data.get("fingerprint"))
+        index._entries = data["entries"]
+        return index
+
+
+def load_term_index(graphdb, conf: dict) -> TermIndex:
+    """
+    Load the term index from 'term_index_path' if the file exists and was built from the current graph,
+    otherwise build it from GraphDB (and save it there, if a path is configured).
+    """
+    path = conf.get("term_index_path")
+    fold_umlauts = conf.get("term_index_fold_umlauts", "false").lower() == "true"
+
+    if path and os.path.exists(path):
+        index = TermIndex.load(path)
+        if index.fold_umlauts == fold_umlauts:
+            if index.fingerprint == graphdb.graph_fingerprint():
+                return index
+            print(f"Term index {path} was built from another state of the graph, rebuilding it")
+
+    index = TermIndex.build(graphdb, fold_umlauts)
+    if path:
+        index.save(path)
+    return index
+
+
+class ArtificialRelationIndex:
+    """
+    Inverted index from lowercased search term to the records with an artificial relation
+    (artificial_similar_term or artificial_compound_from) to it. Lookups return the same bindings as
+    GraphDBHandler.get_records_with_artificial_relation without scanning all relation literals in GraphDB.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self) -> int:
+        return sum(len(bindings) for bindings in self._entries.values())
+
+    def lookup(self, term: str) -> dict:
+        bindings = list(self._entries.get(term.lower(), []))
+        return {"head": {"vars": ["record", "relation", "termName"]}, "results": {"bindings": bindings}}
+
+    @classmethod
+    def build(cls, graphdb) -> "ArtificialRelationIndex":
+        """ Build the index from all artificial relations in GraphDB """
+        index = cls()
+        result = graphdb.get_all_artificial_relations()
+        for binding in result["results"]["bindings"]:
+            binding = dict(binding)
+            search_term = binding.pop("searchTerm")["value"]
+            index._entries.setdefault(search_term.lower(), []).append(binding)
+        return index
@@ -8,85 +8,133 @@ __maintainer__ = "Daniel Bruneß"
 __email__ = "daniel.bruness@kite.thm.de"
 __status__ = "Development"
 
-from typing import List, Any, Tuple
-import configparser
+from typing import List, Any, Tuple, Union
 import os
+import time
 
-from nltk.corpus import stopwords
+import numpy as np
 import requests
-import spacy
 
-from graphdb_handler import GraphDBHandler
+from cache import shared_cache
+from cascade_policy import CascadePolicy
+from cassette import count_remote_calls, remote_call
+from findings import Binding, Finding, FindingList, as_bindings
+from graphdb_handler import GraphDBHandler, all_terms_visible, hidden_terms
 from kg_vec_calc import GEMsim
+from lazy_loader import LazyResource, load_conf, startup_report
+from mapping_context import MappingContext
 from model_request import ModelRequest
-from sentence_encoder import find_best_n_similarity_match
+import sentence_preprocessor
+import tracing
+from tracing import traced
+from sentence_encoder import encode_walks, find_best_n_similarity_match, find_best_n_similarity_match_encoded
+from walk_index import load_walk_index
+
+
+def _load_lemma_data():
+    conf = load_conf()
+    return TermMapper._load_lemma_data(os.path.join(conf.get("resources_dir"), conf.get("lemma_data")))
+
+
+def _load_stop_words():
+    from nltk.corpus import stopwords
+    return set(stopwords.words('german'))
+
+
+def _load_spacy_model():
+    # python -m spacy download de_core_news_lg
+    # if missing...
+    import spacy
+    return spacy.load("de_core_news_lg")
+
+
+# heavy resources are loaded on first use, once per process
+_lemma_data = LazyResource("lemma_data", _load_lemma_data)
+_stop_words = LazyResource("nltk_stopwords", _load_stop_words)
+_gem_sim = LazyResource("gem_matrix", GEMsim)
+_nlp = LazyResource("spacy_model", _load_spacy_model)
+_walk_index = LazyResource("walk_index", load_walk_index)
+
+
+def walk_contains_hidden(walk: str, hidden_names: set) -> bool:
+    """ Returns true if a walk (comma separated terms) contains one of the lowercased hidden term names """
+    return len(hidden_names) > 0 and any(term.lower() in hidden_names for term in walk.split(", "))
 
 
 class TermMapper:
     """
     Attempting to map a given term the best way possible into a given knowledge graph.
+
+    The state of mapping a term lives in a MappingContext, the mapper itself only holds
+    configuration and read-only resources. One instance can be shared by many threads.
     """
 
     def __init__(self):
         self._conf = dict()
         self._set_conf_from_config()
+        tracing.configure_from_conf(self._conf)
 
-        self._base_word = None
-        self._context_sentence = None
-
-        lemma_data_path = os.path.join(self._conf.get("resources_dir"), self._conf.get("lemma_data"))
-        self.lemma_data = self._load_lemma_data(lemma_data_path)
-        self.stop_words = stopwords.words('german')
         self.model_request = ModelRequest()  # FastText request service
         self.graphdb = GraphDBHandler()  # GraphDB handler
-        self.GEMsim = GEMsim()
-        # python -m spacy download de_core_news_lg
-        # if missing...
-        self.nlp = spacy.load("de_core_news_lg")
-
-        self.direct_found_terms = []
-        self.ft_found_terms = []
-        self.compound_found_terms = []
-        self.sorted_ft_findings = []
-        self.translated_found_terms = []
-        self.artificial_found_terms = []
-        # self.all_found_terms = []
-        self.sorted_gem_findings = []
-        self.gem_found_terms = []
-
-        self.finding_list = []
-        self.all_findings_list = []
-        self.already_tested = dict()
+
+        self.cascade_policy = CascadePolicy.from_conf(self._conf)
+
+        # walks only depend on the graph and the excluded word, so they are kept across terms. They are always built
+        # on the whole graph, ignoring virtual_deletion: if the walk contains a hidden term, a walk without it is
+        # built and cached under a key including the hidden set, so walks of the reduced graph are never shared.
+        self.walk_cache = shared_cache("walks", int(self._conf.get("walk_cache_size")))
+        # abstraction path walks (and their embeddings) only depend on the record, hidden terms as above
+        self.abstraction_cache = shared_cache("abstraction_paths", int(self._conf.get("abstraction_cache_size")))
 
     def _set_conf_from_config(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        conf = config["ONTOLOGY_MAPPER"]
-        self._conf = dict(conf.items())
+        self._conf = load_conf()
 
-    def set_conf_values(self, values: dict):
-        self._conf.update(values)
-        self.graphdb.set_conf_values(values)
+    @property
+    def lemma_data(self) -> set:
+        return _lemma_data.get()
 
     @property
-    def context_sentence(self) -> str:
-        return self._context_sentence
+    def stop_words(self) -> set:
+        return _stop_words.get()
 
-    @context_sentence.setter
-    def context_sentence(self, sentence: str) -> None:
-        if type(sentence) is not str or len(sentence) == 0:
-            raise ValueError
-        self._context_sentence = sentence
+    @property
+    def GEMsim(self) -> GEMsim:
+        return _gem_sim.get()
+
+    @property
+    def nlp(self):
+        return _nlp.get()
 
     @property
-    def base_word(self) -> str:
-        return self._base_word
+    def walk_index(self):
+        return _walk_index.get()
 
-    @base_word.setter
-    def base_word(self, base_word: str) -> None:
-        if type(base_word) is not str or len(base_word) == 0:
-            raise ValueError
-        self._base_word = base_word
+    def warm_up(self, nlp: bool = False) -> dict:
+        """
+        Load all resources needed for mapping now instead of on first use, e.g. before serving requests.
+
+        Args:
+            nlp: bool, also load the spaCy model (not needed for mapping)
+
+        Returns:
+            Dict of load time in seconds by component
+        """
+        resources = [_lemma_data, _stop_words, _gem_sim, _walk_index, sentence_preprocessor.stop_words,
+                     sentence_preprocessor.nltk_word_tokenize]
+        if nlp:
+            resources.append(_nlp)
+
+        for resource in resources:
+            resource.get()
+        # only loaded if enabled in the config
+        _ = self.graphdb.term_index
+
+        return startup_report()
+
+    def set_conf_values(self, values: dict):
+        self._conf.update(values)
+        self.graphdb.set_conf_values(values)
+        self.cascade_policy = CascadePolicy.from_conf(self._conf)
 
     @staticmethod
     def _load_lemma_data(path_to_lemma_file):
@@ -115,6 +163,7 @@ class TermMapper:
         value = record_entry[key]["value"]
         return value[value.rfind("#") + 1:]
 
+    @traced("secos.decompound")
     def decompound(self, term: str) -> List[str]:
         """
         Decompound given term
@@ -125,14 +174,17 @@ class TermMapper:
         Returns:
             List of stems or empty list if term equals only stem
         """
-        res = requests.get(self._conf.get("secos_server_url") + term)
-        decoded = res.content.decode().strip()
+        decoded = remote_call("secos", term, lambda: self._request_decompound(term))
         if decoded == term:
             return []
 
         stems = decoded.replace("'", "").strip().split(" ")
         return stems
 
+    def _request_decompound(self, term: str) -> str:
+        res = requests.get(self._conf.get("secos_server_url") + term)
+        return res.content.decode().strip()
+
     def split_word_in_all_comps(self, term: str) -> List[str]:
         """
         Split given term in all possible stems
@@ -156,7 +208,7 @@ class TermMapper:
 
         return all_stems
 
-    def modify_and_test_word(self, cur_finding_list, term, finding_type):
+    def modify_and_test_word(self, ctx: MappingContext, cur_finding_list, term, finding_type):
         modifications = self.generate_transitional_modifications(word=term)
 
         for mod_as_token in modifications:
@@ -165,33 +217,31 @@ class TermMapper:
             result = self.graphdb.get_record_using_exact_matching(mod)
 
             if self.match_found(result):
-                threshold_reached, result, cor_walk = self.check_match_results(result, self.base_word)
+                threshold_reached, result, cor_walk = self.check_match_results(ctx, result, ctx.base_word)
                 if threshold_reached:
-                    self.save_finding(cur_finding_list, term, result, cor_walk, finding_type)
+                    self.save_finding(ctx, cur_finding_list, term, result, cor_walk, finding_type)
                     return True
 
         return False
 
-    def sort_ft_similar_word_findings(self, ft_found_terms):
+    def sort_ft_similar_word_findings(self, ctx: MappingContext, ft_found_terms):
         """ Legacy Code
 
         For multiple matches in FT, sort based on similarity to base word
 
         """
-        similarity_scores = []
-        for entry in ft_found_terms:
-            corresponding_term = entry["corresponding_term"]
-
-            similarity = self.model_request.similarity(self.base_word, corresponding_term)
-            similarity_scores.append((entry, similarity))
+        corresponding_terms = [finding.corresponding_term for finding in ft_found_terms]
+        similarities = self.model_request.similarities(ctx.base_word, corresponding_terms)
+        similarity_scores = list(zip(ft_found_terms, similarities))
 
         similarity_scores.sort(reverse=True, key=lambda tup: tup[1])
 
         return similarity_scores
 
-    def save_finding(self, cur_finding_list: List = None,
+    def save_finding(self, ctx: MappingContext,
+                     cur_finding_list: FindingList = None,
                      term: str = None,
-                     query_result: dict = None,
+                     query_result: Union[dict, List[Binding]] = None,
                      cor_walk: Any = None,
                      finding_type: str = None) -> None:
         """
@@ -200,38 +250,29 @@ class TermMapper:
         Args:
             cur_finding_list: The list, the current match should be saved in (e.g. list of direct matches)
             term: The term that was used for lookup
-            query_result: Return value of the search in GraphDB
+            query_result: Return value of the search in GraphDB (or its Bindings)
             cor_walk: The corresponding best walk (path) for the term
             finding_type: Type the led to that finding
 
         Returns:
             None
         """
+        new_findings = []
+        for binding in as_bindings(query_result):
+            mesh_record_id = binding.record_id
 
-        current_finding_ids = [finding["corresponding_id"] for finding in cur_finding_list]
-
-        for record_entry in query_result["results"]["bindings"]:
-            mesh_record_id = self.get_record_value(record_entry, "record")
-
-            if mesh_record_id in current_finding_ids:
+            # only records saved before this call count as duplicates
+            if mesh_record_id in cur_finding_list.record_ids:
                 print("record id already in list")
             else:
-                entry = {
-                    "base_word": self.base_word,
-                    "queried_term": term,
-                    "corresponding_id": mesh_record_id,
-                    "corresponding_term": self.get_record_value(record_entry, "termName"),
-                    "cor_walk": cor_walk,
-                    "finding_type": finding_type,
-                    "context_sentence": self.context_sentence
-                }
-
-                best_abstraction_path, all_similarities = self.calculate_best_mesh_abstraction_path(mesh_record_id)
-                entry["best_abstraction_path"] = best_abstraction_path
-                entry["all_abstraction_path_similarities"] = all_similarities
-
-                cur_finding_list.append(entry)
-                self.all_findings_list.append(entry)
+                finding = Finding(ctx.base_word, term, mesh_record_id, binding.stripped_term_name, cor_walk,
+                                  finding_type, ctx.context_sentence)
+                finding.best_abstraction_path, finding.all_abstraction_path_similarities = \
+                    self.calculate_best_mesh_abstraction_path(ctx, mesh_record_id)
+                new_findings.append(finding)
+
+        cur_finding_list.extend_findings(new_findings)
+        ctx.all_findings_list.extend(new_findings)
 
     def split_word_using_simple_dict_search(self, base_word: str):
         """ Find Partial Lemma in Base Word
@@ -257,64 +298,108 @@ class TermMapper:
 
         return lemmas_in_base_word
 
-    def check_match_results(self, result, base_word=None):
+    @traced("walks.check_match_results")
+    def check_match_results(self, ctx: MappingContext, result, base_word=None):
         walks = {}
 
         if base_word is None:
-            base_word = self.base_word
+            base_word = ctx.base_word
 
-        if type(result) == dict and "results" in result:
-            records = [self.graphdb.remove_uri(binding["record"]["value"])
-                       for binding
-                       in result["results"]["bindings"]]
-        else:
-            records = result
+        # query results (shared between threads) are only read, the check works on their Bindings
+        result = as_bindings(result)
+        records = [self.graphdb.remove_uri(binding.record_uri) for binding in result]
+
+        walk_index = self.walk_index
+        indexed_vectors = {}
+        hidden = hidden_terms()
+        hidden_names = {term_name for _, term_name in hidden}
 
         for record in records:
-            if record not in self.already_tested:
-                best_position = self.graphdb.find_best_place_for_word(record, base_word)
-                walks[record] = best_position
-                self.already_tested[record] = best_position
+            if walk_index is not None and walk_index.has_record(record):
+                walks[record], indexed_vectors[record] = \
+                    walk_index.contextual_walk(record, base_word, self.model_request, hidden_names)
+                continue
+
+            best_position = self.walk_cache.get((record, base_word))
+            if best_position is None:
+                tracing.current_span().add("walk_cache_misses")
+                with all_terms_visible():
+                    best_position = self.graphdb.find_best_place_for_word(record, base_word)
+                self.walk_cache.put((record, base_word), best_position)
+            if walk_contains_hidden(best_position, hidden_names):
+                hidden_key = (record, base_word, hidden)
+                best_position = self.walk_cache.get(hidden_key)
+                if best_position is None:
+                    tracing.current_span().add("walk_cache_misses")
+                    best_position = self.graphdb.find_best_place_for_word(record, base_word)
+                    self.walk_cache.put(hidden_key, best_position)
+            walks[record] = best_position
+
+        if len(indexed_vectors) == 0:
+            return self.calculate_best_fitting_word_group(ctx, result, walks)
+
+        # encode the walks that are not in the index and combine them with the indexed ones
+        online_walks = {record: walk for record, walk in walks.items() if record not in indexed_vectors}
+        online_matrix = encode_walks(online_walks, self.model_request)
+        walk_matrix = np.zeros((len(walks), walk_index.dim), dtype=np.float32)
+        online_row = 0
+        for row, record in enumerate(walks):
+            if record in indexed_vectors:
+                walk_matrix[row] = indexed_vectors[record]
             else:
-                walks[record] = self.already_tested[record]
+                if online_matrix.shape[1] == walk_index.dim:
+                    walk_matrix[row] = online_matrix[online_row]
+                online_row += 1
 
-        return self.calculate_best_fitting_word_group(result, walks)
+        return self.calculate_best_fitting_word_group(ctx, result, walks, walk_matrix)
 
-    def calculate_best_fitting_word_group(self, result, walks):  # noqa: C901
+    def calculate_best_fitting_word_group(self, ctx: MappingContext, result, walks, walk_matrix=None):  # noqa: C901
         min_random_walk_sim_threshold = float(self._conf.get("min_random_walk_sim_threshold"))
         min_average_ft_sim_of_walk = float(self._conf.get("min_average_ft_sim_of_walk"))
 
-        best_synset, highest_sim, all_similarities = find_best_n_similarity_match(self.context_sentence, walks,
-                                                                                  self.model_request)
+        if walk_matrix is None:
+            best_synset, highest_sim, all_similarities = find_best_n_similarity_match(ctx.context_sentence, walks,
+                                                                                      self.model_request)
+        else:
+            best_synset, highest_sim, all_similarities = \
+                find_best_n_similarity_match_encoded(ctx.context_sentence, walks, walk_matrix, self.model_request)
         if best_synset is not None:
             walk_split = walks[best_synset].split(", ")
-            average_sim = 0
-            iteration_count = 0
+            compared_terms = []
 
             for split in walk_split:
                 if split == "":
                     break
-                average_sim += self.model_request.similarity(self.base_word, split)
-                iteration_count += 1
-                if iteration_count == 3:
+                compared_terms.append(split)
+                if len(compared_terms) == 3:
                     break
 
-            if iteration_count == 0:
+            if len(compared_terms) == 0:
                 average_sim = 99
             else:
-                average_sim = average_sim / iteration_count
+                average_sim = sum(self.model_request.similarities(ctx.base_word, compared_terms)) / len(compared_terms)
 
         else:
             average_sim = 99
 
+        if ctx.candidates is not None and result is not None:
+            # recording for a threshold sweep: every check fails, so all candidates of a stage are tried
+            best_record = None
+            for binding in result:
+                if best_synset is not None and best_synset in binding.record_uri:
+                    best_record = binding.record_id
+                    break
+            ctx.record_candidate(highest_sim, average_sim, best_record)
+            return False, None, None
+
         if highest_sim > min_random_walk_sim_threshold and average_sim > min_average_ft_sim_of_walk:
             best_binding = []
             if result is not None:
-                for binding in result["results"]["bindings"]:
-                    if best_synset in binding["record"]["value"]:
+                for binding in result:
+                    if best_synset in binding.record_uri:
                         best_binding.append(binding)
                         break
-                result["results"]["bindings"] = best_binding
+                result = best_binding
             else:
                 result = all_similarities
 
@@ -322,15 +407,58 @@ class TermMapper:
 
         return False, None, None
 
-    def calculate_best_mesh_abstraction_path(self, record_id: str) -> Tuple:
+    @traced("walks.get_mesh_abstraction_walks")
+    def get_mesh_abstraction_walks(self, record_id: str) -> Tuple:
         """
-        If multiple abstractions paths are available for a record, try to find the best matching one.
+        Get one walk per abstraction path (tree number) of a record and the encoded walks.
+        Both only depend on the record (and the terms hidden by virtual_deletion), so they are taken from the
+        walk index or cached.
 
         Args:
             record_id: str MeSH Record ID
 
         Returns:
-            Tuple of best abstraction path and all similarity measures
+            Tuple of dict (tree number to walk) and the matrix of encoded walks
+        """
+        hidden = hidden_terms()
+        hidden_names = {term_name for _, term_name in hidden}
+
+        walk_index = self.walk_index
+        if walk_index is not None and walk_index.has_record(record_id):
+            indexed = walk_index.abstraction_walks(record_id, hidden_names)
+            if indexed is not None:
+                tracing.current_span().set("abstraction_cache", "index")
+                return indexed
+
+        cached = self.abstraction_cache.get(record_id)
+        tracing.current_span().set("abstraction_cache", "hit" if cached is not None else "miss")
+        if cached is None:
+            with all_terms_visible():
+                walks = self.build_mesh_abstraction_walks(record_id)
+            cached = (walks, encode_walks(walks, self.model_request))
+            self.abstraction_cache.put(record_id, cached)
+        if not any(walk_contains_hidden(walk, hidden_names) for walk in cached[0].values()):
+            return cached
+
+        hidden_key = (record_id, hidden)
+        cached = self.abstraction_cache.get(hidden_key)
+        if cached is None:
+            tracing.current_span().set("abstraction_cache", "miss")
+            walks = self.build_mesh_abstraction_walks(record_id)
+            cached = (walks, encode_walks(walks, self.model_request))
+            self.abstraction_cache.put(hidden_key, cached)
+
+        return cached
+
+    def build_mesh_abstraction_walks(self, record_id: str) -> dict:
+        """
+        Build one walk per abstraction path (tree number) of a record
+
+        Args:
+            record_id: str MeSH Record ID
+
+        Returns:
+            Dict of tree number to walk
         """
         base_indexes = {}
         # get all abstractions paths from recordID
@@ -370,7 +498,22 @@ class TermMapper:
             walks[parent_path] = self.graphdb.generate_path_comparison_walk_mesh_record_id_list(
                 parent_record_paths[parent_path])
 
-        threshold_reached, all_similarities, cor_walk = self.calculate_best_fitting_word_group(None, walks)
+        return walks
+
+    def calculate_best_mesh_abstraction_path(self, ctx: MappingContext, record_id: str) -> Tuple:
+        """
+        If multiple abstractions paths are available for a record, try to find the best matching one.
+
+        Args:
+            record_id: str MeSH Record ID
+
+        Returns:
+            Tuple of best abstraction path and all similarity measures
+        """
+        walks, walk_matrix = self.get_mesh_abstraction_walks(record_id)
+
+        threshold_reached, all_similarities, cor_walk = \
+            self.calculate_best_fitting_word_group(ctx, None, walks, walk_matrix)
         walk_key_list = list(walks.keys())
         walk_val_list = list(walks.values())
         if cor_walk in walk_val_list:
@@ -381,67 +524,76 @@ class TermMapper:
         else:
             return None, None
 
-    def find_direct_match(self, fuzzy: bool = False):
+    def find_direct_match(self, ctx: MappingContext, fuzzy: bool = False):
 
         if fuzzy:
             finding_type = self._conf.get("FUZZY_MATCH")
-            finding_list = self.direct_found_terms
+            finding_list = ctx.direct_found_terms
             result = \
-                self.graphdb.get_record_using_fuzzy_matching(self.base_word,
+                self.graphdb.get_record_using_fuzzy_matching(ctx.base_word,
                                                              method=self._conf.get("fuzzy_method_norm_levensthein"))
         else:
             finding_type = self._conf.get("DIRECT")
-            finding_list = self.direct_found_terms
-            result = self.graphdb.get_record_using_exact_matching(self.base_word)
+            finding_list = ctx.direct_found_terms
+            result = self.graphdb.get_record_using_exact_matching(ctx.base_word)
 
         if not self.match_found(result):
             return False
 
-        threshold_reached, result, cor_walk = self.check_match_results(result)
+        threshold_reached, result, cor_walk = self.check_match_results(ctx, result)
         if threshold_reached:
-            self.save_finding(finding_list, self.base_word, result, cor_walk, finding_type)
+            self.save_finding(ctx, finding_list, ctx.base_word, result, cor_walk, finding_type)
 
         return True
 
-    def find_artificial_relation_match(self) -> bool:
+    def find_artificial_relation_match(self, ctx: MappingContext) -> bool:
         # 1.1
-        artificial_results = self.graphdb.get_records_with_artificial_relation(self.base_word)
+        artificial_results = self.graphdb.get_records_with_artificial_relation(ctx.base_word)
 
         if len(artificial_results["results"]["bindings"]) > 0:
             cor_walk = None
-            self.save_finding(self.artificial_found_terms, self.base_word, artificial_results, cor_walk,
+            self.save_finding(ctx, ctx.artificial_found_terms, ctx.base_word, artificial_results, cor_walk,
                               self._conf.get("ARTIFICIAL_MATCH"))
             return True
 
         return False
 
-    def similar_matching(self):
+    def similar_matching(self, ctx: MappingContext):
         min_sim_thresh = float(self._conf.get("min_gem_sim_threshold"))
-        most_similar_words = self.GEMsim.find_record(self.base_word, min_sim=min_sim_thresh)
+        most_similar_words = self.GEMsim.find_record(ctx.base_word, min_sim=min_sim_thresh)
 
         # iterate through the most similar word list
         match_found = False
         for similar_word, sim, record in most_similar_words:
+            if ctx.budget_exceeded():
+                break
+
+            ctx.candidate_sim = sim
             if not match_found:
-                threshold_reached, result, cor_walk = self.check_match_results(record)
+                threshold_reached, result, cor_walk = self.check_match_results(ctx, record)
                 if threshold_reached:
                     match_found = True
-                    self.save_finding(self.gem_found_terms, similar_word, result,
+                    self.save_finding(ctx, ctx.gem_found_terms, similar_word, result,
                                       cor_walk, self._conf.get("FT_DIRECT"))
 
                 else:
                     # 4.2 - Convert word into lemma and find exact match in ontology.
-                    match_found = self.modify_and_test_word(self.gem_found_terms, similar_word,
+                    match_found = self.modify_and_test_word(ctx, ctx.gem_found_terms, similar_word,
                                                             self._conf.get("MOD_FT"))
 
+                # only the words the loop reaches are looked up (a dict lookup with the local artificial index)
                 artificial_results = self.graphdb.get_records_with_artificial_relation(similar_word)
                 if len(artificial_results["results"]["bindings"]) > 0:
-                    self.save_finding(self.artificial_found_terms, similar_word, artificial_results,
+                    self.save_finding(ctx, ctx.artificial_found_terms, similar_word, artificial_results,
                                       None, self._conf.get("ARTIFICIAL_MATCH"))
 
-        self.sorted_gem_findings = self.sort_ft_similar_word_findings(self.gem_found_terms)
+                # the matched word is fully handled, the remaining words would not be checked anyway
+                if match_found and not ctx.policy.is_exhaustive:
+                    break
 
-    def most_similar_matching(self):
+        ctx.sorted_gem_findings = self.sort_ft_similar_word_findings(ctx, ctx.gem_found_terms)
+
+    def most_similar_matching(self, ctx: MappingContext):
         """
         find match using a list of the most similar words of the base word.
         for example: Nierenzellenkarzinom -> Nierenkarzinom
@@ -449,101 +601,153 @@ class TermMapper:
         Returns:
         """
         min_sim_thresh = float(self._conf.get("min_similarity_threshold"))
-        most_similar_words = self.model_request.most_similar(positive=[self.base_word],
+        most_similar_words = self.model_request.most_similar(positive=[ctx.base_word],
                                                              top_n=self._conf.get("max_similar_terms_threshold"))
 
         # iterate through the most similar word list
         match_found = False
         for similar_word, sim in most_similar_words:
+            if ctx.budget_exceeded():
+                break
+
+            ctx.candidate_sim = sim
             if sim > min_sim_thresh and not match_found:
 
                 # 4.1 - find exact match in ontology.
                 result = self.graphdb.get_record_using_exact_matching(similar_word)
 
                 if self.match_found(result):
-                    threshold_reached, result, cor_walk = self.check_match_results(result)
+                    threshold_reached, result, cor_walk = self.check_match_results(ctx, result)
                     if threshold_reached:
                         match_found = True
-                        self.save_finding(self.ft_found_terms, similar_word, result,
+                        self.save_finding(ctx, ctx.ft_found_terms, similar_word, result,
                                           cor_walk, self._conf.get("FT_DIRECT"))
 
                 else:
                     # 4.2 - Convert word into lemma and find exact match in ontology.
-                    match_found = self.modify_and_test_word(self.ft_found_terms, similar_word, self._conf.get("MOD_FT"))
+                    match_found = self.modify_and_test_word(ctx, ctx.ft_found_terms, similar_word,
+                                                            self._conf.get("MOD_FT"))
 
+                # only the words the loop reaches are looked up (a dict lookup with the local artificial index)
                 artificial_results = self.graphdb.get_records_with_artificial_relation(similar_word)
                 if len(artificial_results["results"]["bindings"]) > 0:
-                    self.save_finding(self.artificial_found_terms, similar_word, artificial_results,
+                    self.save_finding(ctx, ctx.artificial_found_terms, similar_word, artificial_results,
                                       None, self._conf.get("ARTIFICIAL_MATCH"))
 
-        self.sorted_ft_findings = self.sort_ft_similar_word_findings(self.ft_found_terms)
+                # the matched word is fully handled, the remaining words would not be checked anyway
+                if match_found and not ctx.policy.is_exhaustive:
+                    break
+
+        ctx.sorted_ft_findings = self.sort_ft_similar_word_findings(ctx, ctx.ft_found_terms)
 
-    def find_compound_match(self):
+    def find_compound_match(self, ctx: MappingContext):
         """ 4. """
-        compounds = self.split_word_in_all_comps(self.base_word)
+        compounds = self.split_word_in_all_comps(ctx.base_word)
         lowered_compounds = [compound.lower() for compound in compounds]
 
-        dict_split_results = self.split_word_using_simple_dict_search(self.base_word)
+        dict_split_results = self.split_word_using_simple_dict_search(ctx.base_word)
 
         for dict_split in dict_split_results:
             dict_word = dict_split["word"]
             if dict_word.lower() not in lowered_compounds:
                 compounds.append(dict_word)
 
-        for compound in compounds:
+        for group, compound in enumerate(compounds):
+            if ctx.budget_exceeded():
+                break
+
+            ctx.candidate_group = group
+
             # 5.1  - look for a direct match
             result = self.graphdb.get_record_using_exact_matching(compound)
             if self.match_found(result):
-                threshold_reached, result, cor_walk = self.check_match_results(result, compound)
+                threshold_reached, result, cor_walk = self.check_match_results(ctx, result, compound)
                 if threshold_reached:
-                    self.save_finding(self.compound_found_terms, compound, result,
+                    self.save_finding(ctx, ctx.compound_found_terms, compound, result,
                                       cor_walk, self._conf.get("COMPOUND"))
             else:
                 method = self._conf.get("fuzzy_method_norm_levensthein_punished")
                 result = self.graphdb.get_record_using_fuzzy_matching(compound, method)
                 if self.match_found(result):
-                    threshold_reached, result, cor_walk = self.check_match_results(result, compound)
+                    threshold_reached, result, cor_walk = self.check_match_results(ctx, result, compound)
                     if threshold_reached:
-                        self.save_finding(self.compound_found_terms, compound,
+                        self.save_finding(ctx, ctx.compound_found_terms, compound,
                                           result, cor_walk, self._conf.get("COMPOUND_FUZZY"))
 
                 else:
                     # 5.2 - Convert word into lemma and find exact match in ontology.
-                    self.modify_and_test_word(self.compound_found_terms, compound, self._conf.get("MOD_COMPOUND"))
-
-    def _clear_result_lists(self) -> None:
-        self.direct_found_terms = []
-        self.sorted_ft_findings = []
-        self.compound_found_terms = []
-        self.artificial_found_terms = []
-        self.translated_found_terms = []
-        self.all_findings_list = []
-        self.ft_found_terms = []
-        self.already_tested = {}
-        self.all_found_terms = []
-        self.finding_list = []
-        self.sorted_gem_findings = []
-        self.gem_found_terms = []
-
-    def find_matches(self, base_word: str, context_sentence: str):  # noqa: C901
-        self.base_word = base_word
-        self.context_sentence = context_sentence
-        self._clear_result_lists()
-
-        # 2 - find match using Levenshtein distance measure. Tries to ignore typos
-        self.find_direct_match(fuzzy=True)
-
-        # 3 Most Similar Matching
-        self.most_similar_matching()
-
-        # 3.1 Similar Matching
-        self.similar_matching()
+                    self.modify_and_test_word(ctx, ctx.compound_found_terms, compound, self._conf.get("MOD_COMPOUND"))
+
+    def _run_stage(self, ctx: MappingContext, stage: str) -> List:
+        """ Run a single stage of the matching cascade and return the list of its findings """
+        if stage == "fuzzy_direct":
+            # 2 - find match using Levenshtein distance measure. Tries to ignore typos
+            self.find_direct_match(ctx, fuzzy=True)
+            return ctx.direct_found_terms
+
+        if stage == "most_similar":
+            # 3 Most Similar Matching
+            self.most_similar_matching(ctx)
+            return ctx.ft_found_terms
+
+        if stage == "similar":
+            # 3.1 Similar Matching
+            self.similar_matching(ctx)
+            return ctx.gem_found_terms
 
         # 5 - Split the base word into all compounds in order to test them
-        self.find_compound_match()
+        self.find_compound_match(ctx)
+        return ctx.compound_found_terms
+
+    def map_term(self, base_word: str, context_sentence: str, policy: CascadePolicy = None,
+                 record_candidates: bool = False) -> MappingContext:
+        """
+        Run the matching cascade for a term.
+
+        Args:
+            base_word: str term to map
+            context_sentence: str sentence the term occurs in
+            policy: CascadePolicy to use for this term, defaults to the policy from the config
+            record_candidates: bool, record the scores of all candidates in ctx.candidates instead of applying
+                the walk thresholds (no findings are saved then, see threshold_sweep)
 
-        return self.direct_found_terms, self.sorted_ft_findings, self.compound_found_terms,\
-            self.artificial_found_terms, self.translated_found_terms, self.sorted_gem_findings
+        Returns:
+            MappingContext holding the findings, which stages ran and whether the time budget cut the result short
+        """
+        ctx = MappingContext(base_word, context_sentence, policy if policy is not None else self.cascade_policy)
+        if record_candidates:
+            ctx.candidates = []
+
+        with tracing.span("map_term", term=base_word) as term_span:
+            for stage in CascadePolicy.STAGES:
+                if ctx.budget_exceeded():
+                    term_span.set("budget_exceeded", True)
+                    break
+
+                ctx.start_stage(stage)
+                stage_start = time.perf_counter()
+                with tracing.span(f"stage.{stage}") as stage_span, count_remote_calls() as stage_calls:
+                    stage_findings = self._run_stage(ctx, stage)
+                    stage_span.set("findings", len(stage_findings))
+                ctx.match_info["stages"].append(stage)
+                ctx.match_info["stage_times"][stage] = time.perf_counter() - stage_start
+                ctx.match_info["stage_calls"][stage] = stage_calls
+
+                if ctx.policy.stop_after_stage(stage, len(stage_findings)):
+                    ctx.match_info["stopped_after"] = stage
+                    break
+
+            ctx.finish()
+        return ctx
+
+    def find_matches(self, base_word: str, context_sentence: str, policy: CascadePolicy = None):
+        """
+        Run the matching cascade for a term.
+
+        Returns:
+            Tuple of direct, similar, compound, artificial, translated and GEM findings
+        """
+        return self.map_term(base_word, context_sentence, policy).results()
 
     def generate_transitional_modifications(self, word: str = "") -> list:  # noqa: C901
         """
@@ -0,0 +1,76 @@
+""" Tests of the benchmark summary and the regression check against a baseline """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from contextlib import redirect_stdout
+import io
+import unittest
+
+from benchmark import _summary, compare
+
+
+def run(datasets):
+    return {"datasets": datasets}
+
+
+def metrics(terms_per_s=10.0, p50=100.0, p95=200.0, p99=300.0):
+    return {"terms_per_s": terms_per_s, "latency_p50_ms": p50, "latency_p95_ms": p95, "latency_p99_ms": p99}
+
+
+class SummaryTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        # 1ms ... 100ms
+        summary = _summary([milliseconds / 1000 for milliseconds in range(1, 101)])
+        self.assertEqual(summary, {"latency_mean_ms": 50.5, "latency_p50_ms": 50.5, "latency_p95_ms": 95.05,
+                                   "latency_p99_ms": 99.01, "latency_max_ms": 100.0})
+
+    def test_single_duration(self):
+        summary = _summary([0.25])
+        self.assertEqual(set(summary.values()), {250.0})
+
+    def test_no_durations(self):
+        self.assertEqual(_summary([]), {})
+
+
+class CompareTest(unittest.TestCase):
+
+    def compare(self, current, baseline, threshold=0.1):
+        with redirect_stdout(io.StringIO()):
+            return compare(current, baseline, threshold)
+
+    def test_throughput_regression(self):
+        regressions = self.compare(run({"reinsert": metrics(terms_per_s=8.0)}), run({"reinsert": metrics()}))
+        self.assertEqual(regressions, ["reinsert terms_per_s: 10.0 -> 8.0"])
+
+    def test_latency_regression(self):
+        regressions = self.compare(run({"enrich": metrics(p95=250.0, p99=320.0)}), run({"enrich": metrics()}))
+        self.assertEqual(regressions, ["enrich latency_p95_ms: 200.0 -> 250.0"])
+
+    def test_within_tolerance(self):
+        current = run({"reinsert": metrics(terms_per_s=9.5, p50=105.0, p95=210.0, p99=329.0)})
+        self.assertEqual(self.compare(current, run({"reinsert": metrics()})), [])
+
+    def test_improvements_are_no_regressions(self):
+        current = run({"reinsert": metrics(terms_per_s=20.0, p50=10.0, p95=20.0, p99=30.0)})
+        self.assertEqual(self.compare(current, run({"reinsert": metrics()})), [])
+
+    def test_threshold(self):
+        current = run({"reinsert": metrics(terms_per_s=9.5)})
+        self.assertEqual(self.compare(current, run({"reinsert": metrics()}), threshold=0.01),
+                         ["reinsert terms_per_s: 10.0 -> 9.5"])
+
+    def test_missing_baseline_values_are_skipped(self):
+        current = run({"reinsert": metrics(terms_per_s=1.0), "enrich": metrics(terms_per_s=1.0)})
+        baseline = run({"reinsert": dict(metrics(), terms_per_s=0.0)})
+        self.assertEqual(self.compare(current, baseline), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+""" Tests of the compact bindings and findings used while mapping a term """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+import unittest
+
+from cascade_policy import CascadePolicy
+from findings import Binding, Finding, FindingList, as_bindings, findings_to_dicts
+from mapping_context import MappingContext
+from term_mapper import TermMapper
+
+URI = "https://www.minds-medical.de/ontologies/tldia#"
+
+
+def sparql_result(rows):
+    """ SPARQL JSON result as returned by GraphDBHandler, rows of (record id, term name or None) """
+    bindings = []
+    for record_id, term_name in rows:
+        binding = {"record": {"type": "uri", "value": URI + record_id}}
+        if term_name is not None:
+            binding["termName"] = {"type": "literal", "value": term_name}
+        bindings.append(binding)
+    return {"head": {"vars": ["record", "termName"]}, "results": {"bindings": bindings}}
+
+
+def finding(record_id, term="Herzinfarkt"):
+    return Finding("Infarkt", term, record_id, term, None, "direct", "Patient mit Infarkt.")
+
+
+class BindingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        bindings = as_bindings(sparql_result([("D009203", "Herzinfarkt"), ("D009203", URI + "Myokardinfarkt"),
+                                              ("D006331", None)]))
+
+        self.assertEqual([binding.record_uri for binding in bindings],
+                         [URI + "D009203", URI + "D009203", URI + "D006331"])
+        self.assertEqual([binding.record_id for binding in bindings], ["D009203", "D009203", "D006331"])
+        self.assertEqual([binding.term_name for binding in bindings],
+                         ["Herzinfarkt", URI + "Myokardinfarkt", None])
+        # same as TermMapper.get_record_value on the SPARQL binding
+        self.assertEqual([binding.stripped_term_name for binding in bindings],
+                         ["Herzinfarkt", "Myokardinfarkt", None])
+
+    def test_bindings_are_returned_as_they_are(self):
+        bindings = [Binding(URI + "D009203", "Herzinfarkt")]
+        self.assertIs(as_bindings(bindings), bindings)
+        self.assertEqual(as_bindings(sparql_result([])), [])
+
+    def test_query_result_is_not_modified(self):
+        result = sparql_result([("D009203", "Herzinfarkt")])
+        expected = sparql_result([("D009203", "Herzinfarkt")])
+        as_bindings(result)
+        self.assertEqual(result, expected)
+
+
+class FindingTest(unittest.TestCase):
+
+    def test_to_dict(self):
+        finding_dict = finding("D009203").to_dict()
+        self.assertEqual(list(finding_dict), ["base_word", "queried_term", "corresponding_id", "corresponding_term",
+                                              "cor_walk", "finding_type", "context_sentence", "best_abstraction_path",
+                                              "all_abstraction_path_similarities"])
+        self.assertEqual(finding_dict["corresponding_id"], "D009203")
+        self.assertIsNone(finding_dict["best_abstraction_path"])
+
+    def test_finding_list_record_ids(self):
+        findings = FindingList([finding("D009203")])
+        self.assertEqual(findings.record_ids, {"D009203"})
+
+        findings.extend_findings([finding("D006331"), finding("D009203", "Myokardinfarkt")])
+        self.assertEqual(len(findings), 3)
+        self.assertEqual(findings.record_ids, {"D009203", "D006331"})
+        self.assertEqual([f["corresponding_id"] for f in findings_to_dicts(findings)],
+                         ["D009203", "D006331", "D009203"])
+
+
+class SaveFindingTest(unittest.TestCase):
+
+    def setUp(self):
+        # save_finding only needs the abstraction paths, which come from GraphDB otherwise
+        self.term_mapper = TermMapper.__new__(TermMapper)
+        self.term_mapper.calculate_best_mesh_abstraction_path = lambda ctx, record_id: (f"{record_id}-path", [])
+        self.ctx = MappingContext("Infarkt", "Patient mit Infarkt.", CascadePolicy.exhaustive())
+
+    def test_records_saved_before_are_skipped(self):
+        findings = self.ctx.direct_found_terms
+        self.term_mapper.save_finding(self.ctx, findings, "Infarkt",
+                                      sparql_result([("D009203", "Herzinfarkt")]), None, "direct")
+        self.term_mapper.save_finding(self.ctx, findings, "Infarkt",
+                                      sparql_result([("D009203", "Myokardinfarkt"), ("D006331", "Herzkrankheit")]),
+                                      None, "direct")
+
+        self.assertEqual([(f.corresponding_id, f.corresponding_term) for f in findings],
+                         [("D009203", "Herzinfarkt"), ("D006331", "Herzkrankheit")])
+        self.assertEqual(findings.record_ids, {"D009203", "D006331"})
+        self.assertEqual(self.ctx.all_findings_list, list(findings))
+        self.assertEqual(findings[1].best_abstraction_path, "D006331-path")
+
+    def test_duplicates_within_one_result_are_kept(self):
+        # only records saved by earlier calls count as duplicates (as before the findings were compacted)
+        findings = self.ctx.artificial_found_terms
+        self.term_mapper.save_finding(self.ctx, findings, "Infarkt",
+                                      [Binding(URI + "D009203", "Herzinfarkt"), Binding(URI + "D009203", "Infarkt")],
+                                      None, "artificial")
+
+        self.assertEqual([f.corresponding_id for f in findings], ["D009203", "D009203"])
+        self.assertEqual(findings.record_ids, {"D009203"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+""" Tests of the vectorized MeSH tree distances against the original per-pair formulas """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+import unittest
+
+from GEM_eval import TermMapperEvaluator, TreeNumberEncoder, tree_distances
+
+PAIRS = {
+    "identical": ("C04.588.274", "C04.588.274"),
+    "ancestor": ("C04", "C04.588.274"),
+    "descendant": ("C04.588.274.120", "C04.588"),
+    "siblings": ("C04.588.274", "C04.588.531"),
+    "cousins": ("C04.557.337", "C04.588.274"),
+    "different top categories": ("C04.588", "D02.241"),
+    "same letter, different category": ("C04.588", "C01.150"),
+    "string prefix": ("C01.2", "C01.23"),
+}
+
+
+def baseline_evaluator():
+    # the per-pair formulas only use static helpers, no GraphDB or TermMapper is needed
+    return TermMapperEvaluator.__new__(TermMapperEvaluator)
+
+
+class TreeDistancesTest(unittest.TestCase):
+
+    def distances(self, match_listings, base_listings):
+        encoder = TreeNumberEncoder()
+        match_paths, match_lengths = encoder.encode(match_listings, padding=-1)
+        base_paths, base_lengths = encoder.encode(base_listings, padding=-2)
+        return tree_distances(match_paths, match_lengths, base_paths, base_lengths)
+
+    def test_pairs(self):
+        evaluator = baseline_evaluator()
+        for name, (match_listing, base_listing) in PAIRS.items():
+            with self.subTest(name):
+                similarities, hops = self.distances([match_listing], [base_listing])
+                self.assertAlmostEqual(float(similarities[0, 0]),
+                                       evaluator.mesh_conceptual_sim(match_listing, base_listing))
+                if name != "string prefix":
+                    self.assertEqual(int(hops[0, 0]), evaluator.calc_hops(match_listing, base_listing))
+
+    def test_string_prefix_is_not_an_ancestor(self):
+        # calc_hops compares strings, so "C.01.2" counts as contained in "C.01.23" and it never terminates.
+        # Tree numbers are compared level by level: C01.2 and C01.23 are siblings below C01.
+        similarities, hops = self.distances(["C01.2"], ["C01.23"])
+        self.assertEqual(int(hops[0, 0]), 2)
+        self.assertAlmostEqual(float(similarities[0, 0]), 2 * 2 / 6)
+
+    def test_all_pairs(self):
+        evaluator = baseline_evaluator()
+        match_listings = [match_listing for match_listing, _ in PAIRS.values()]
+        base_listings = [base_listing for _, base_listing in PAIRS.values()]
+        similarities, hops = self.distances(match_listings, base_listings)
+
+        self.assertEqual(similarities.shape, (len(match_listings), len(base_listings)))
+        for row, match_listing in enumerate(match_listings):
+            for column, base_listing in enumerate(base_listings):
+                self.assertAlmostEqual(float(similarities[row, column]),
+                                       evaluator.mesh_conceptual_sim(match_listing, base_listing))
+                # calc_hops does not terminate for this pair, see test_string_prefix_is_not_an_ancestor
+                if (match_listing, base_listing) != PAIRS["string prefix"]:
+                    self.assertEqual(int(hops[row, column]), evaluator.calc_hops(match_listing, base_listing))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+""" Tests of the vectorized walk scoring against the per-walk n_similarity of the model server """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+import unittest
+
+import numpy as np
+
+from cache import clear_shared_caches
+from model_request import ModelRequest
+import sentence_encoder
+import sentence_preprocessor
+
+VECTORS = {
+    "Patient": [0.2, 0.9, -0.1],
+    "Fieber": [0.7, 0.1, 0.3],
+    "Husten": [0.5, 0.4, -0.6],
+    "Herz": [0.9, -0.2, 0.1],
+    "Infarkt": [0.3, 0.3, 0.8],
+    "Kardiologie": [-0.4, 0.6, 0.2],
+    "Null": [0.0, 0.0, 0.0],
+}
+
+
+def unitvec(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def baseline_n_similarity(ws1, ws2):
+    """ n_similarity of the model server (gensim): cosine of the unit mean vectors, 0 if a list is empty """
+    if len(ws1) == 0 or len(ws2) == 0:
+        # the server fails on empty lists, the baseline then compared False, i.e. 0
+        return 0.0
+    v1 = np.mean([VECTORS[w] for w in ws1], axis=0)
+    v2 = np.mean([VECTORS[w] for w in ws2], axis=0)
+    return float(np.dot(unitvec(v1), unitvec(v2)))
+
+
+def baseline_find_best_n_similarity_match(sentence, possible_tree):
+    """ The per-walk loop find_best_n_similarity_match replaced """
+    tokens = sentence_encoder.sentence_tokens(sentence)
+    all_similarities = []
+    best_record = None
+    highest_sim = -1
+    for possible_entry in possible_tree:
+        tree_terms = [term for term in possible_tree[possible_entry].split(", ") if term != ""]
+        n_sim = baseline_n_similarity(tree_terms, tokens)
+        all_similarities.append((n_sim, possible_entry, possible_tree[possible_entry]))
+        if n_sim > highest_sim:
+            highest_sim = n_sim
+            best_record = possible_entry
+    return best_record, highest_sim, all_similarities
+
+
+def fake_model_request():
+    model_request = ModelRequest()
+    model_request.wv = lambda word: VECTORS.get(word)
+    return model_request
+
+
+class WalkScoringTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_shared_caches()
+        # regex tokenizer and fixed stopwords, so no NLTK data is needed
+        stop_words = sentence_preprocessor.stop_words
+        self._saved = (sentence_preprocessor._default_preprocessor, stop_words._value, stop_words._loaded)
+        sentence_preprocessor._default_preprocessor = sentence_preprocessor.SentencePreprocessor(
+            sentence_preprocessor.REGEX_TOKENIZER)
+        stop_words._value, stop_words._loaded = frozenset({"der", "hat", "und"}), True
+        self.model_request = fake_model_request()
+
+    def tearDown(self):
+        stop_words = sentence_preprocessor.stop_words
+        sentence_preprocessor._default_preprocessor, stop_words._value, stop_words._loaded = self._saved
+        clear_shared_caches()
+
+    def assert_same_scores(self, sentence, walks):
+        expected = baseline_find_best_n_similarity_match(sentence, walks)
+        best_record, highest_sim, all_similarities = \
+            sentence_encoder.find_best_n_similarity_match(sentence, walks, self.model_request)
+
+        self.assertEqual(best_record, expected[0])
+        self.assertAlmostEqual(highest_sim, expected[1], places=5)
+        self.assertEqual([(entry, walk) for _, entry, walk in all_similarities],
+                         [(entry, walk) for _, entry, walk in expected[2]])
+        for (sim, _, _), (expected_sim, _, _) in zip(all_similarities, expected[2]):
+            self.assertAlmostEqual(float(sim), expected_sim, places=5)
+
+    def test_walks(self):
+        walks = {"D001": "Herz, Infarkt", "D002": "Kardiologie, Husten, Fieber", "D003": "Patient"}
+        self.assert_same_scores("Der Patient hat Fieber und Husten.", walks)
+
+    def test_empty_walk(self):
+        walks = {"D001": "", "D002": "Herz, Infarkt"}
+        self.assert_same_scores("Der Patient hat Fieber.", walks)
+
+    def test_zero_vectors(self):
+        walks = {"D001": "Null", "D002": "Null, Herz", "D003": "Fieber"}
+        self.assert_same_scores("Der Patient hat Fieber.", walks)
+
+    def test_sentence_without_vectors(self):
+        walks = {"D001": "Herz", "D002": "Fieber"}
+        self.assert_same_scores("Der Null hat Null.", walks)
+
+    def test_encoded_walks(self):
+        walks = {"D001": "Herz, Infarkt", "D002": "Fieber, Null", "D003": ""}
+        walk_matrix = sentence_encoder.encode_walks(walks, self.model_request)
+        self.assertEqual(walk_matrix.shape, (3, 3))
+        self.assertEqual(sentence_encoder.find_best_n_similarity_match_encoded(
+            "Patient mit Fieber", walks, walk_matrix, self.model_request),
+            sentence_encoder.find_best_n_similarity_match("Patient mit Fieber", walks, self.model_request))
+
+
+class SimilaritiesTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_shared_caches()
+        self.model_request = fake_model_request()
+
+    def tearDown(self):
+        clear_shared_caches()
+
+    def test_same_as_similarity(self):
+        lookups = ["Fieber", "Husten", "Herz", "Null", "Unbekannt"]
+        similarities = self.model_request.similarities("Infarkt", lookups)
+
+        self.assertEqual(len(similarities), len(lookups))
+        for lookup, sim in zip(lookups, similarities):
+            expected = baseline_n_similarity(["Infarkt"], [lookup]) if lookup in VECTORS else 0.0
+            self.assertAlmostEqual(sim, expected, places=5)
+
+    def test_zero_base_vector(self):
+        self.assertEqual(self.model_request.similarities("Null", ["Herz", "Fieber"]), [0.0, 0.0])
+
+    def test_unknown_base_word_and_no_lookups(self):
+        self.assertEqual(self.model_request.similarities("Unbekannt", ["Herz"]), [0.0])
+        self.assertEqual(self.model_request.similarities("Herz", []), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
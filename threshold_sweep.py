@@ -0,0 +1,296 @@
+"""
+Offline threshold sweep over recorded mapping candidates
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Dict, List
+import argparse
+import itertools
+import json
+import os
+
+import numpy as np
+
+from lazy_loader import load_conf
+
+# match types of analyse_results, in the order of the matching cascade
+MATCH_TYPES = ("lexical", "gem", "revgem", "compound")
+STAGE_MATCH_TYPES = {"fuzzy_direct": "lexical", "most_similar": "gem", "similar": "revgem", "compound": "compound"}
+
+SIM_THRESHOLD = "min_similarity_threshold"
+GEM_SIM_THRESHOLD = "min_gem_sim_threshold"
+WALK_SIM_THRESHOLD = "min_random_walk_sim_threshold"
+AVERAGE_SIM_THRESHOLD = "min_average_ft_sim_of_walk"
+SWEEP_PARAMS = (SIM_THRESHOLD, GEM_SIM_THRESHOLD, WALK_SIM_THRESHOLD, AVERAGE_SIM_THRESHOLD)
+
+# similarity threshold that gates the candidates of a stage
+_NO_GATE = 0
+_SIM_GATE = 1
+_GEM_GATE = 2
+_STAGE_GATES = {"most_similar": _SIM_GATE, "similar": _GEM_GATE}
+
+
+class CandidateTable:
+    """
+    Candidates recorded by TermMapperEvaluator.record_candidates as flat arrays.
+
+    Candidates are sorted by term, match type and group (all candidates of a stage form one group, except for
+    compounds where every compound is a group). Within a group they keep the order the matching cascade tried
+    them in: for every threshold setting the first candidate of a group that passes the thresholds is the
+    finding of that group, exactly like TermMapper stops at the first match.
+    """
+
+    def __init__(self, results: List[dict]):
+        self.n_terms = len(results)
+
+        self.floors = {SIM_THRESHOLD: -np.inf, GEM_SIM_THRESHOLD: -np.inf}
+        rows = []
+        for term_index, result in enumerate(results):
+            for threshold, value in result.get("thresholds", {}).items():
+                self.floors[threshold] = max(self.floors[threshold], float(value))
+
+            for order, candidate in enumerate(result["candidates"]):
+                rows.append((term_index, MATCH_TYPES.index(STAGE_MATCH_TYPES[candidate["stage"]]),
+                             candidate["group"], order, candidate))
+
+        rows.sort(key=lambda row: row[:4])
+
+        self.term = np.array([row[0] for row in rows], dtype=np.int64)
+        self.match_type = np.array([row[1] for row in rows], dtype=np.int64)
+        group_keys = [row[:3] for row in rows]
+
+        candidates = [row[4] for row in rows]
+        self.highest_sim = np.array([c["highest_sim"] for c in candidates], dtype=np.float64)
+        self.average_sim = np.array([c["average_sim"] for c in candidates], dtype=np.float64)
+        self.sim = np.array([np.nan if c["sim"] is None else c["sim"] for c in candidates], dtype=np.float64)
+        self.gate = np.array([_STAGE_GATES.get(c["stage"], _NO_GATE) for c in candidates], dtype=np.int64)
+        self.has_record = np.array([c["record"] is not None for c in candidates], dtype=bool)
+        self.conceptual_sim = np.array([c["conceptual_sim"] if c["record"] is not None else 0.0
+                                        for c in candidates], dtype=np.float64)
+        self.hops = np.array([c["hops"] if c["record"] is not None else 0 for c in candidates], dtype=np.float64)
+
+        # index of the first candidate of the group of every candidate
+        self.group_start = np.zeros(len(rows), dtype=np.int64)
+        # index of the first candidate of the (term, match type) segment of every candidate
+        self.segment_start = np.zeros(len(rows), dtype=np.int64)
+        for i in range(1, len(rows)):
+            self.group_start[i] = self.group_start[i - 1] if group_keys[i] == group_keys[i - 1] else i
+            self.segment_start[i] = self.segment_start[i - 1] if group_keys[i][:2] == group_keys[i - 1][:2] else i
+
+        # save_finding keeps one finding per record and list: a compound finding is dropped if an earlier
+        # compound of the same term found the same record
+        self.duplicate_pairs = self._duplicate_compound_pairs(candidates)
+
+    def __len__(self) -> int:
+        return len(self.term)
+
+    def _duplicate_compound_pairs(self, candidates: List[dict]) -> np.ndarray:
+        compound = MATCH_TYPES.index("compound")
+        by_record = {}
+        for i, candidate in enumerate(candidates):
+            if self.match_type[i] == compound and candidate["record"] is not None:
+                by_record.setdefault((self.term[i], candidate["record"]), []).append(i)
+
+        pairs = [(first, second)
+                 for indices in by_record.values()
+                 for first, second in itertools.combinations(indices, 2)
+                 if self.group_start[first] != self.group_start[second]]
+        return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+    def check_floors(self, grid: Dict[str, np.ndarray]) -> None:
+        """ Candidates were only recorded above the similarity thresholds used for recording """
+        for threshold, floor in self.floors.items():
+            if len(grid[threshold]) > 0 and grid[threshold].min() < floor:
+                raise ValueError(f"{threshold} below {floor} (the value the candidates were recorded with)")
+
+    def findings(self, grid: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Which candidates become findings for each grid point.
+
+        Args:
+            grid: dict of threshold name to array of values (one per grid point)
+
+        Returns:
+            Boolean matrix (grid points x candidates)
+        """
+        passed = (self.highest_sim[None, :] > grid[WALK_SIM_THRESHOLD][:, None]) & \
+                 (self.average_sim[None, :] > grid[AVERAGE_SIM_THRESHOLD][:, None])
+
+        sim_gate = self.sim[None, :] > grid[SIM_THRESHOLD][:, None]
+        gem_gate = self.sim[None, :] > grid[GEM_SIM_THRESHOLD][:, None]
+        passed &= np.where(self.gate == _SIM_GATE, sim_gate, np.where(self.gate == _GEM_GATE, gem_gate, True))
+
+        # first passing candidate of each group: the number of passing candidates of the group up to and
+        # including the candidate is 1
+        passed_count = np.concatenate([np.zeros((len(passed), 1), dtype=np.int64), np.cumsum(passed, axis=1)],
+                                      axis=1)
+        in_group = passed_count[:, 1:] - passed_count[:, self.group_start]
+        findings = passed & (in_group == 1) & self.has_record[None, :]
+
+        if len(self.duplicate_pairs) > 0:
+            duplicates = np.zeros(findings.shape, dtype=np.int64)
+            np.add.at(duplicates, (slice(None), self.duplicate_pairs[:, 1]), findings[:, self.duplicate_pairs[:, 0]])
+            findings &= duplicates == 0
+
+        return findings
+
+    def metrics(self, grid: Dict[str, np.ndarray]) -> List[dict]:
+        """ Metrics of TermMapperEvaluator.compute_metrics for each grid point """
+        findings = self.findings(grid)
+        n_points = len(findings)
+
+        metrics = [{"dataset_len": self.n_terms} for _ in range(n_points)]
+
+        finding_count = np.concatenate([np.zeros((n_points, 1), dtype=np.int64), np.cumsum(findings, axis=1)],
+                                       axis=1)
+        segment_end = np.nonzero(np.append(self.segment_start[1:] != self.segment_start[:-1], True))[0] \
+            if len(self) > 0 else np.zeros(0, dtype=np.int64)
+        segment_counts = finding_count[:, segment_end + 1] - finding_count[:, self.segment_start[segment_end]]
+        segment_types = self.match_type[segment_end]
+        segment_terms = self.term[segment_end]
+
+        matched_terms = np.zeros((n_points, self.n_terms), dtype=np.int64)
+        np.add.at(matched_terms, (slice(None), segment_terms), segment_counts)
+        no_match = (matched_terms == 0).sum(axis=1)
+
+        cs = np.where(findings, self.conceptual_sim[None, :], 0.0)
+        hops = np.where(findings, self.hops[None, :], 0.0)
+        correct = findings & (self.conceptual_sim[None, :] == 1.0)
+
+        totals = {}
+        for type_index, match_type in enumerate(MATCH_TYPES):
+            columns = self.match_type == type_index
+            totals[match_type] = (findings[:, columns].sum(axis=1), cs[:, columns].sum(axis=1),
+                                  hops[:, columns].sum(axis=1))
+            multiple = (segment_counts[:, segment_types == type_index] > 1).sum(axis=1)
+            correct_count = correct[:, columns].sum(axis=1)
+
+            for point in range(n_points):
+                metrics[point][f"matches_{match_type}"] = int(totals[match_type][0][point])
+                metrics[point][f"multiple_{match_type}"] = int(multiple[point])
+                metrics[point][f"correct_{match_type}"] = int(correct_count[point])
+
+        totals["all"] = (findings.sum(axis=1), cs.sum(axis=1), hops.sum(axis=1))
+
+        for point in range(n_points):
+            metrics[point]["no_match"] = int(no_match[point])
+            metrics[point]["matches_all"] = int(totals["all"][0][point])
+            for match_type in ("all",) + MATCH_TYPES:
+                count, cs_sum, hops_sum = (total[point] for total in totals[match_type])
+                metrics[point][f"avg_cs_{match_type}"] = float(cs_sum / count) if count > 0 else None
+                metrics[point][f"avg_hops_{match_type}"] = float(hops_sum / count) if count > 0 else None
+
+        return metrics
+
+
+def parse_values(spec: str) -> List[float]:
+    """ Threshold values as comma separated list ("0.5,0.6") or range with step ("0.5:0.9:0.1", inclusive) """
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        return [round(float(v), 10) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in spec.split(",")]
+
+
+def build_grid(values: Dict[str, List[float]]) -> Dict[str, np.ndarray]:
+    """ Cartesian product of the values of all thresholds, as one array per threshold """
+    points = list(itertools.product(*(values[param] for param in SWEEP_PARAMS)))
+    return {param: np.array([point[i] for point in points], dtype=np.float64) for i, param in enumerate(SWEEP_PARAMS)}
+
+
+def sweep(results: List[dict], values: Dict[str, List[float]], batch_size: int = 256) -> List[dict]:
+    """
+    Evaluate all combinations of threshold values on recorded candidates.
+
+    Args:
+        results: recorded candidates per term (see TermMapperEvaluator.record_candidates)
+        values: dict of threshold name to the values to try
+        batch_size: int number of grid points evaluated at once
+
+    Returns:
+        List of dicts with the thresholds and the metrics of every grid point
+    """
+    table = CandidateTable(results)
+    grid = build_grid(values)
+    table.check_floors(grid)
+
+    n_points = len(grid[SIM_THRESHOLD])
+    points = []
+    for start in range(0, n_points, batch_size):
+        batch = {param: grid[param][start:start + batch_size] for param in SWEEP_PARAMS}
+        for i, metrics in enumerate(table.metrics(batch)):
+            thresholds = {param: float(batch[param][i]) for param in SWEEP_PARAMS}
+            points.append(dict(thresholds, **metrics))
+
+    return points
+
+
+def _print_points(points: List[dict], sort_by: str, top: int) -> None:
+    ranked = sorted(points, key=lambda p: p[sort_by] if p[sort_by] is not None else -np.inf, reverse=True)
+    print(f"{len(points)} grid points, best {min(top, len(points))} by {sort_by}:")
+    print("sim\tgem\twalk\tavg\tmatches\tcorrect\tno_match\tavg_cs\tavg_hops")
+    for point in ranked[:top]:
+        correct = sum(point[f"correct_{match_type}"] for match_type in MATCH_TYPES)
+        avg_cs = round(point["avg_cs_all"], 3) if point["avg_cs_all"] is not None else "-"
+        avg_hops = round(point["avg_hops_all"], 3) if point["avg_hops_all"] is not None else "-"
+        print(f"{point[SIM_THRESHOLD]}\t{point[GEM_SIM_THRESHOLD]}\t{point[WALK_SIM_THRESHOLD]}\t"
+              f"{point[AVERAGE_SIM_THRESHOLD]}\t{point['matches_all']}\t{correct}\t{point['no_match']}\t"
+              f"{avg_cs}\t{avg_hops}")
+
+
+if __name__ == "__main__":
+    test_data_by_mode = {
+        "reinsert": (os.path.join("test_data", "reinsert_data.tsv"), False, "re_insert"),
+        "enrich": (os.path.join("test_data", "enrich_data.tsv"), True, "enrich")
+    }
+
+    parser = argparse.ArgumentParser(description="Record mapping candidates once, then sweep thresholds offline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="map the test data and record all candidates")
+    record_parser.add_argument("mode", nargs="?", default="reinsert", choices=list(test_data_by_mode))
+    record_parser.add_argument("--candidates", help="JSONL file for the candidates "
+                                                    "(default: results/<experiment prefix>_candidates.jsonl)")
+    record_parser.add_argument("--resume", action="store_true", help="only record the terms not in the file yet")
+
+    sweep_parser = subparsers.add_parser("sweep", help="apply a grid of thresholds to recorded candidates")
+    sweep_parser.add_argument("mode", nargs="?", default="reinsert", choices=list(test_data_by_mode))
+    sweep_parser.add_argument("--candidates", help="recorded candidates (default as for record)")
+    for sweep_param in SWEEP_PARAMS:
+        sweep_parser.add_argument(f"--{sweep_param}", help="values as '0.5,0.6' or 'start:stop:step' "
+                                                           "(default: value from config.ini)")
+    sweep_parser.add_argument("--output", help="JSON file for the metrics of all grid points")
+    sweep_parser.add_argument("--sort-by", default="avg_cs_all", help="metric to rank the grid points by")
+    sweep_parser.add_argument("--top", type=int, default=20, help="number of grid points to print")
+    args = parser.parse_args()
+
+    test_data, do_not_delete, prefix = test_data_by_mode[args.mode]
+    candidates_path = args.candidates or os.path.join("results", f"{prefix}_candidates.jsonl")
+    conf = load_conf()
+
+    if args.command == "record":
+        from GEM_eval import TermMapperEvaluator
+
+        record_params = {SIM_THRESHOLD: conf.get("sweep_min_similarity_floor"),
+                         GEM_SIM_THRESHOLD: conf.get("sweep_min_gem_sim_floor")}
+        print("Recording candidates to", candidates_path, "with", record_params)
+        tme = TermMapperEvaluator(test_data=test_data, do_not_delete=do_not_delete, exp_prefix=prefix)
+        tme.record_candidates(candidates_path, params=record_params, resume=args.resume)
+
+    else:
+        from GEM_eval import load_results
+
+        sweep_values = {sweep_param: parse_values(getattr(args, sweep_param) or conf.get(sweep_param))
+                        for sweep_param in SWEEP_PARAMS}
+        sweep_points = sweep(load_results(candidates_path), sweep_values)
+        _print_points(sweep_points, args.sort_by, args.top)
+
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output_file:
+                json.dump(sweep_points, output_file, indent=1)
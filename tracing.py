@@ -0,0 +1,223 @@
+""" Tracing """
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import Any, Callable, Optional
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+LOG = "log"
+CHROME = "chrome"
+
+
+class Span:
+    """ A timed section (a stage, a request, ...) with attributes like payload sizes and cache hits """
+
+    __slots__ = ("name", "span_id", "parent_id", "attrs", "start_ns", "_token", "_tracer")
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(tracer.span_ids)
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self._tracer = tracer
+        self._token = None
+        self.start_ns = 0
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+    def add(self, key: str, value: int = 1) -> None:
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self._tracer.finish(self, duration_ns)
+
+
+class _NoSpan:
+    """ Returned while tracing is disabled, does nothing """
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def add(self, key: str, value: int = 1) -> None:
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+class Tracer:
+    """
+    Collects finished spans. In "log" mode every span is written as one JSON line (to the file or stderr),
+    in "chrome" mode the spans are written as Chrome trace (chrome://tracing, Perfetto) on flush.
+    """
+
+    def __init__(self, mode: str, path: str = None):
+        if mode not in (LOG, CHROME):
+            raise ValueError(f"Unknown tracing mode: {mode}")
+
+        self.mode = mode
+        self.path = path
+        self.span_ids = itertools.count(1)
+        self.start_ns = time.perf_counter_ns()
+
+        self._lock = threading.Lock()
+        self._events = []
+        self._log_file = None
+        if mode == LOG and path:
+            self._log_file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def finish(self, span: Span, duration_ns: int) -> None:
+        if self.mode == LOG:
+            line = json.dumps({"name": span.name, "span": span.span_id, "parent": span.parent_id,
+                               "thread": threading.get_ident(), "pid": os.getpid(),
+                               "start_ms": round((span.start_ns - self.start_ns) / 1e6, 3),
+                               "duration_ms": round(duration_ns / 1e6, 3), **span.attrs},
+                              ensure_ascii=False, default=str)
+            with self._lock:
+                if self._log_file is not None:
+                    self._log_file.write(line + "\n")
+                else:
+                    print(line, file=sys.stderr)
+            return
+
+        event = {"name": span.name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": (span.start_ns - self.start_ns) / 1000, "dur": duration_ns / 1000, "args": span.attrs}
+        with self._lock:
+            self._events.append(event)
+
+    def flush(self) -> None:
+        """ Write the Chrome trace (or close the log file) """
+        if self.mode == CHROME:
+            with self._lock:
+                events = list(self._events)
+            path = self.path or "trace.json"
+            with open(path, "w", encoding="utf-8") as trace_file:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file, ensure_ascii=False,
+                          default=str)
+            print(f"Trace with {len(events)} spans written to {path}")
+        elif self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+_tracer = None  # type: Optional[Tracer]
+_current_span = contextvars.ContextVar("current_span", default=None)
+_NO_SPAN = _NoSpan()
+_configured = False
+
+
+def enable_tracing(mode: str, path: str = None) -> Tracer:
+    """
+    Start tracing for the process, the trace is written on disable_tracing or at exit.
+
+    Args:
+        mode: str "log" (one JSON line per span) or "chrome" (Chrome trace JSON)
+        path: str file to write to (default: stderr for "log", trace.json for "chrome")
+
+    Returns:
+        The Tracer
+    """
+    global _tracer, _configured
+    disable_tracing()
+    _tracer = Tracer(mode, path)
+    _configured = True
+    atexit.register(_tracer.flush)
+    return _tracer
+
+
+def disable_tracing() -> None:
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None:
+        tracer.flush()
+        atexit.unregister(tracer.flush)
+
+
+def configure_from_conf(conf: dict) -> None:
+    """ Enable tracing as configured in 'tracing' and 'tracing_path' (only the first call has an effect) """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    mode = conf.get("tracing", "")
+    if mode in (LOG, CHROME):
+        enable_tracing(mode, conf.get("tracing_path") or None)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attrs):
+    """ Context manager timing a section, does nothing while tracing is disabled """
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return Span(tracer, name, attrs)
+
+
+def current_span():
+    """ The innermost open span of the current thread/task (a span that does nothing if there is none) """
+    if _tracer is None:
+        return _NO_SPAN
+    open_span = _current_span.get()
+    return open_span if open_span is not None else _NO_SPAN
+
+
+def _result_size(result: Any) -> Optional[int]:
+    if isinstance(result, dict) and "results" in result:
+        return len(result["results"].get("bindings", []))
+    if isinstance(result, (list, tuple, dict, str)):
+        return len(result)
+    return None
+
+
+def traced(name: str) -> Callable:
+    """ Decorator running a function in a span, the size of the result is recorded as 'result_size' """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+
+            with span(name) as fn_span:
+                result = fn(*args, **kwargs)
+                size = _result_size(result)
+                if size is not None:
+                    fn_span.set("result_size", size)
+                return result
+
+        return wrapper
+
+    return decorator
+
@@ -0,0 +1,211 @@
+"""
+Precomputed walks and walk embeddings for all records of the Knowledge Graph
+"""
+
+__author__ = "Jannik Geyer, Daniel Bruneß, Matthias Bay"
+__copyright__ = "Copyright 2021, MINDS medical GmbH"
+# __license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Daniel Bruneß"
+__email__ = "daniel.bruness@kite.thm.de"
+__status__ = "Development"
+
+from typing import AbstractSet, List, Optional, Tuple
+import json
+import os
+import sys
+
+import numpy as np
+
+from lazy_loader import load_conf
+from sentence_encoder import unit_vector
+
+CONTEXT_WALK = ""  # path key of the walk used for contextual disambiguation
+
+
+class WalkIndex:
+    """
+    Walk term lists and their mean embeddings for every record of the graph.
+
+    For every record the index holds the walk used for contextual disambiguation (find_best_place_for_word_mesh,
+    built without excluding a word) and one walk per tree number (abstraction path). The mean vectors of the
+    walk terms are stored in a memory-mapped matrix, the term lists and row numbers in a JSON file.
+
+    If the queried word (or terms containing it) are part of a stored contextual walk, they are taken out of
+    the walk online: their vectors are subtracted from the stored mean. The online walk would have picked
+    other terms instead, so this is an approximation of the original walk.
+    """
+
+    def __init__(self, matrix: np.ndarray, counts: np.ndarray, entries: List[dict]):
+        self.matrix = matrix
+        self.counts = counts
+        self.entries = entries
+
+        self._rows = {}
+        for row, entry in enumerate(entries):
+            self._rows.setdefault(entry["record"], {})[entry["path"]] = row
+
+    @staticmethod
+    def _file_paths(path: str) -> Tuple[str, str]:
+        return path + ".npy", path + ".json"
+
+    @classmethod
+    def load(cls, path: str) -> "WalkIndex":
+        matrix_path, meta_path = cls._file_paths(path)
+        with open(meta_path, "r", encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+
+        matrix = np.load(matrix_path, mmap_mode="r")
+        return cls(matrix, np.asarray(meta["counts"]), meta["entries"])
+
+    def save(self, path: str) -> None:
+        matrix_path, meta_path = self._file_paths(path)
+        np.save(matrix_path, np.asarray(self.matrix, dtype=np.float32))
+        with open(meta_path, "w", encoding="utf-8") as meta_file:
+            json.dump({"counts": [int(c) for c in self.counts], "entries": self.entries}, meta_file,
+                      ensure_ascii=False)
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def has_record(self, record_id: str) -> bool:
+        return record_id in self._rows
+
+    def contextual_walk(self, record_id: str, word: str, model_request,
+                        hidden_names: AbstractSet[str] = frozenset()) -> Tuple[str, np.ndarray]:
+        """
+        Walk of a record for contextual disambiguation, leaving out the queried word.
+
+        Args:
+            record_id: str MeSH Record ID
+            word: str queried word that must not be part of the walk
+            model_request: ModelRequest instance, to get the vectors of the terms that are left out
+            hidden_names: lowercased term names hidden by virtual_deletion, also left out
+
+        Returns:
+            Tuple of the walk (comma separated terms) and its normalized mean vector
+        """
+        row = self._rows[record_id][CONTEXT_WALK]
+        terms = self.entries[row]["terms"]
+        vector = np.array(self.matrix[row], dtype=np.float32)
+
+        excluded = [term for term in terms
+                    if term == word or word.lower() in term.lower() or term.lower() in hidden_names]
+        if len(excluded) > 0:
+            terms = [term for term in terms if term not in excluded]
+
+            count = int(self.counts[row])
+            excluded_vectors = model_request.word_vectors(excluded)
+            excluded_vectors = [excluded_vectors[term] for term in excluded if term in excluded_vectors]
+            if count - len(excluded_vectors) > 0:
+                vector = (vector * count - np.sum(excluded_vectors, axis=0)) / (count - len(excluded_vectors))
+            else:
+                vector = np.zeros(self.dim, dtype=np.float32)
+
+        return ", ".join(terms), unit_vector(vector)
+
+    def abstraction_walks(self, record_id: str,
+                          hidden_names: AbstractSet[str] = frozenset()) -> Optional[Tuple[dict, np.ndarray]]:
+        """
+        Walks of all abstraction paths of a record.
+
+        Args:
+            record_id: str MeSH Record ID
+            hidden_names: lowercased term names hidden by virtual_deletion
+
+        Returns:
+            Tuple of dict (tree number to walk) and the matrix of normalized walk vectors,
+            None if a walk contains a hidden term name (the walks have to be built online then)
+        """
+        rows = {path: row for path, row in self._rows[record_id].items() if path != CONTEXT_WALK}
+        if len(hidden_names) > 0 and any(term.lower() in hidden_names
+                                         for row in rows.values() for term in self.entries[row]["terms"]):
+            return None
+
+        walks = {path: ", ".join(self.entries[row]["terms"]) for path, row in rows.items()}
+        walk_matrix = np.array(self.matrix[list(rows.values())], dtype=np.float32).reshape(len(rows), self.dim)
+
+        norms = np.linalg.norm(walk_matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+
+        return walks, walk_matrix / norms
+
+
+def _mean_vector(terms: List[str], vectors: dict) -> Tuple[Optional[np.ndarray], int]:
+    term_vectors = [vectors[term] for term in terms if term in vectors]
+    if len(term_vectors) == 0:
+        return None, 0
+    return np.mean(term_vectors, axis=0), len(term_vectors)
+
+
+def build_walk_index(term_mapper, record_ids: List[str] = None) -> WalkIndex:
+    """
+    Build the walk index for the given records (all records of the graph by default).
+    Set 'walk_random_seed' to get the same index on every build.
+
+    Args:
+        term_mapper: TermMapper instance (used for its GraphDB handler and model request)
+        record_ids: List of MeSH Record IDs
+
+    Returns:
+        WalkIndex
+    """
+    graphdb = term_mapper.graphdb
+    model_request = term_mapper.model_request
+
+    if record_ids is None:
+        result = graphdb.get_all_mesh_record_ids()
+        record_ids = [graphdb.remove_uri(binding["record"]["value"]) for binding in result["results"]["bindings"]]
+
+    entries = []
+    rows = []
+    counts = []
+
+    for i, record_id in enumerate(record_ids):
+        walks = {CONTEXT_WALK: graphdb.find_best_place_for_word_mesh(record_id, None)}
+        walks.update(term_mapper.build_mesh_abstraction_walks(record_id))
+
+        walk_terms = {path: [term for term in walk.split(", ") if term != ""] for path, walk in walks.items()}
+        vectors = model_request.word_vectors([term for terms in walk_terms.values() for term in terms])
+
+        for path, terms in walk_terms.items():
+            mean_vector, count = _mean_vector(terms, vectors)
+            entries.append({"record": record_id, "path": path, "terms": terms})
+            rows.append(mean_vector)
+            counts.append(count)
+
+        if i % 1000 == 0:
+            print(f"Walk index: {i} of {len(record_ids)} records")
+
+    dim = next((len(row) for row in rows if row is not None), 0)
+    matrix = np.zeros((len(rows), dim), dtype=np.float32)
+    for row, mean_vector in enumerate(rows):
+        if mean_vector is not None:
+            matrix[row] = mean_vector
+
+    return WalkIndex(matrix, np.asarray(counts), entries)
+
+
+def load_walk_index() -> Optional[WalkIndex]:
+    """ Load the walk index configured in 'walk_index_path', None if no index is configured """
+    path = load_conf().get("walk_index_path")
+    if not path:
+        return None
+    if not os.path.exists(path + ".npy"):
+        print(f"Warning: Walk index {path} not found, walks are built online")
+        return None
+    return WalkIndex.load(path)
+
+
+if __name__ == "__main__":
+    from term_mapper import TermMapper
+
+    index_path = sys.argv[1] if len(sys.argv) > 1 else load_conf().get("walk_index_path")
+    if not index_path:
+        print("Usage: python walk_index.py <index path>  (or set 'walk_index_path' in config.ini)")
+        sys.exit(1)
+
+    index = build_walk_index(TermMapper())
+    index.save(index_path)
+    print(f"Saved walk index with {len(index.entries)} walks to {index_path}")